@@ -25,9 +25,12 @@
 #(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 #SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import sys, datetime, sqlite3, traceback, time, json, socket, subprocess, logging
+import sys, datetime, sqlite3, traceback, time, json, socket, subprocess, logging, signal
 import os
-import RPi.GPIO as GPIO
+try:
+    import RPi.GPIO as GPIO
+except ImportError:  # only on the Raspberry Pi of the bench, the proxy alone runs without it
+    GPIO = None
 from logging.handlers import RotatingFileHandler
 
 if sys.platform == "win32":
@@ -45,15 +48,23 @@ DB_FILE_PROXY = config["file"]["database_proxy"]
 DB_FILE_CONTROLLER = config["file"]["database_controller"]
 DB_FILE_BACKUP = config["file"]["database_backup"]
 FILE_PC_CONTEXT = config["file"]["pc_context"]
+FILE_PROXY_CONTEXT = config["file"].get("proxy_context", "tmp" + splitter + "proxy_context.json")
 
 POWER_FOLDER = config["folder"]["power"] + splitter
 CACHE_FOLDER = config["folder"]["cache"]
 PCAP_FOLDER = config["folder"]["pcap"]
 
 DB_BACKUP_INTERVAL = 3600
+DB_WRITER_INTERVAL = 0.05
+DB_WRITER_BATCH = 200
+DB_WRITER_QUEUE_SIZE = 10000
 POWER_TB_BACKUP_INTERVAL = 600
 
 LOG_FILE = 'tmp' + splitter + 'log.log'
+STATS_FILE_PROXY = 'tmp' + splitter + 'proxy.prom'
+STATS_INTERVAL = 10
+PROXY_CHECKPOINT_INTERVAL = 1
+SESSION_FLUSH_INTERVAL = 1
 
 addr_ns = (config["network_address"]["network_server"]["ip"], config["network_address"]["network_server"]["port"])
 addr_tc = (config["network_address"]["test_controller"]["ip"], config["network_address"]["test_controller"]["port"])
@@ -62,6 +73,20 @@ addr_pf = (config["network_address"]["packet_forwarder"]["ip"], config["network_
 addr_report = (config["network_address"]["error_report"]["ip"], config["network_address"]["error_report"]["port"])
 udp_ports = (addr_ns[1], addr_tc[1], addr_pc[1], addr_pf[1])
 deduplication_threshold = float(config["deduplication_threshold"])
+# the proxy dedup window is derived from the frame time on air, see proxy.get_dedup_window
+DEDUP_GUARD = float(config.get("deduplication_guard", 0.03))
+DEDUP_TOA_RATIO = float(config.get("deduplication_toa_ratio", 0.1))
+DEDUP_MAX_WINDOW = float(config.get("deduplication_max_window", 0.5))
+PROXY_RCVBUF = 4 * 1024 * 1024
+# a downlink handed to the gateway with less time left before its RX window is counted late
+DOWNLINK_MIN_LEAD = float(config.get("downlink_min_lead", 0.03))
+# uplink airtime of a device under test is checked against the duty cycle of its sub-band over this window
+DUTY_CYCLE_WINDOW = float(config.get("duty_cycle_window", 3600))
+# scheduling of the proxy process started by start.py, a negative nice value needs root
+PROXY_NICE = int(config.get("proxy_nice", -10))
+PROXY_CPUS = config.get("proxy_cpus", [])
+# more than one runs the proxy as a receiver process and that many workers, see proxy.run_sharded_proxy
+PROXY_WORKERS = int(config.get("proxy_workers", 0))
 
 gw_mac = bytes.fromhex(config["gateway_id"])
 use_internal_gateway = config["use_internal_gateway"]
@@ -84,7 +109,10 @@ PROC_MSG = {
     "WB_POST_SEQUENCE":    11,
     "WB_GET_SEQUENCE":     12,
     "WB_DEL_SEQUENCE":     13,
-    "WB_QUERY_TEST_STATE": 14
+    "WB_QUERY_TEST_STATE": 14,
+    "TC_GET_STATS":        15,
+    "TC_GET_AIRTIME":      16,
+    "WB_DEVICE_UPDATE":    17
 }
 
 TEST_STATE = {
@@ -113,18 +141,28 @@ PROPRIETARY           = '111'
 UPLINK_PACKETS        = [JOIN_REQUEST, UNCONFIRMED_DATA_UP, CONFIRMED_DATA_UP]
 DNLINK_PACKETS        = [JOIN_ACCEPT, UNCONFIRMED_DATA_DOWN, CONFIRMED_DATA_DOWN]
 
-def config_logger(file=None):
+log_name = "ctb"
+
+
+def config_logger(file=None, name=None):
+    # each process rotates its own file, the renames of a file shared between processes race
+    global log_name
+    if name:
+        log_name = name
     if not os.path.exists("log"):
         os.mkdir("log")
 
     logger = logging.getLogger()
     logger.setLevel(logging.NOTSET)
+    for handler in [h for h in logger.handlers if isinstance(h, RotatingFileHandler)]:
+        logger.removeHandler(handler)
+        handler.close()
 
     timestamp = time.strftime("%Y-%m-%d-%H-%M-%S", time.localtime())
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 
     if not file:
-        file = os.path.join("log", "ctb_" + timestamp + ".log")
+        file = os.path.join("log", log_name + "_" + timestamp + ".log")
     fh = RotatingFileHandler(file, maxBytes=100000, backupCount=128)
     fh.setLevel(logging.DEBUG)
     fh.setFormatter(formatter)
@@ -215,6 +253,19 @@ datrLUTrev = {
     }
 }
 
+# sub-bands (name, lowest MHz, highest MHz, duty cycle) of ETSI EN 300 220 and the US915 sub-bands of
+# 8 + 1 channels, which have no duty cycle but a dwell time in seconds
+DUTY_CYCLE_BANDS = {
+    "US": tuple((str(i + 1), 902.2 + 1.6 * i, 903.8 + 1.6 * i, None) for i in range(8)),
+    "EU": (("h1.3", 863.0, 865.0, 0.001),
+           ("h1.4", 865.0, 868.0, 0.01),
+           ("h1.5", 868.0, 868.6, 0.01),
+           ("h1.6", 868.7, 869.2, 0.001),
+           ("h1.7", 869.4, 869.65, 0.1),
+           ("h1.9", 869.7, 870.0, 0.01))
+}
+DWELL_TIME = {"US": 0.4}
+
 
 def reverse_eui(dev_eui):
     reversed_dev_eui = ""
@@ -223,11 +274,22 @@ def reverse_eui(dev_eui):
     return reversed_dev_eui.lower()
 
 
+def install_term_handler():
+    # SIGTERM unwinds like sys.exit, the finally blocks flush the pending rows and close the files
+    def term_handler(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)  # a second SIGTERM must not cut the teardown short
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, term_handler)
+
+
 def reliable_run(method, loop = False):
     if loop:
         while True:
             try:
                 method()
+            except SystemExit:
+                raise
             except:
                 error_str = traceback.format_exc()
                 for line in error_str.split("\n"):
@@ -245,6 +307,8 @@ def reliable_run(method, loop = False):
     else:
         try:
             method()
+        except SystemExit:
+            raise
         except:
             error_str = traceback.format_exc()
             for line in error_str.split("\n"):
@@ -29,26 +29,186 @@
 #(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 #SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from Crypto.Hash import CMAC
+import struct
+import functools
+import threading
+
 from Crypto.Cipher import AES
 import numpy as np
 
+# keys whose prepared AES and CMAC contexts are kept, a few per device under test
+CRYPTO_CACHE_SIZE = 64
+BLOCK_SIZE = 16
+# messages of a key whose CMACs are computed together, bounds the memory of verify_mics
+CMAC_BATCH_SIZE = 4096
+# 0x49, ConfFCnt, RFU, Dir, DevAddr, FCnt, 0x00, message size
+B0 = struct.Struct("<BHHB4sIBB")
+CMAC_RB = 0x87
+MASK_128 = (1 << 128) - 1
+
+
+def cmac_subkey(l):
+    return ((l << 1) & MASK_128) ^ (CMAC_RB if l >> 127 else 0)
+
+
+class KeyContext():
+    '''
+    The prepared AES contexts of one key. The CBC context is kept from call to call: each call XORs
+    the chaining value left by the previous one into its first block, so every CBC encryption and CMAC
+    of the key is a single call on it as if with a zero IV. Never shared between threads, see key_context.
+    '''
+    __slots__ = ("ecb", "cbc", "chain", "k1", "k2")
+
+    def __init__(self, key):
+        self.ecb = AES.new(key, AES.MODE_ECB)
+        self.cbc = AES.new(key, AES.MODE_CBC, iv=bytes(BLOCK_SIZE))
+        self.chain = 0
+        self.k1 = cmac_subkey(int.from_bytes(self.ecb.encrypt(bytes(BLOCK_SIZE)), "big"))
+        self.k2 = cmac_subkey(self.k1)
+
+    def cbc_encrypt(self, data):
+        if len(data) % BLOCK_SIZE:
+            raise ValueError("Data must be padded to 16 byte boundary in CBC mode")
+        if not data:
+            return b""
+        first = int.from_bytes(data[:BLOCK_SIZE], "big") ^ self.chain
+        encrypted = self.cbc.encrypt(first.to_bytes(BLOCK_SIZE, "big") + data[BLOCK_SIZE:])
+        self.chain = int.from_bytes(encrypted[-BLOCK_SIZE:], "big")
+        return encrypted
+
+    def cmac(self, data):
+        # RFC 4493, the last block XORed with a subkey and chained with the others in one CBC call
+        size = len(data)
+        if size and size % BLOCK_SIZE == 0:
+            body = size - BLOCK_SIZE
+            last = int.from_bytes(data[body:], "big") ^ self.k1
+        else:
+            body = size - size % BLOCK_SIZE
+            last = int.from_bytes((bytes(data[body:]) + b"\x80").ljust(BLOCK_SIZE, b"\0"), "big") ^ self.k2
+        return self.cbc_encrypt(bytes(data[:body]) + last.to_bytes(BLOCK_SIZE, "big"))[-BLOCK_SIZE:]
+
+    def cmac_many(self, messages):
+        # the CMACs of messages, block i of every message in one ECB call, as an array of one row per message
+        count = len(messages)
+        sizes = np.fromiter(map(len, messages), dtype=np.int64, count=count)
+        blocks = np.maximum(-(-sizes // BLOCK_SIZE), 1)
+        complete = (sizes > 0) & (sizes % BLOCK_SIZE == 0)
+        rounds = int(blocks.max(initial=0))
+        width = rounds * BLOCK_SIZE
+
+        # each message at the start of its row, padded with 0x80 and zeros
+        data = np.zeros(count * width, dtype=np.uint8)
+        starts = np.arange(count) * width
+        data[np.repeat(starts - (np.cumsum(sizes) - sizes), sizes) + np.arange(sizes.sum())] = \
+            np.frombuffer(b"".join(messages), dtype=np.uint8)
+        data[(starts + sizes)[~complete]] = 0x80
+        data = data.reshape(count, rounds, BLOCK_SIZE)
+        subkeys = np.frombuffer(self.k1.to_bytes(BLOCK_SIZE, "big") + self.k2.to_bytes(BLOCK_SIZE, "big"),
+                                dtype=np.uint8).reshape(2, BLOCK_SIZE)
+        data[np.arange(count), blocks - 1] ^= subkeys[np.where(complete, 0, 1)]
+
+        # longest messages first, the ones still running in round i are the first rows
+        order = np.argsort(-blocks, kind="stable")
+        data = data[order]
+        running = np.searchsorted(-blocks[order], -np.arange(rounds), side="left")
+        state = np.zeros((count, BLOCK_SIZE), dtype=np.uint8)
+        for i in range(rounds):
+            rows = running[i]
+            state[:rows] = np.frombuffer(self.ecb.encrypt((state[:rows] ^ data[:rows, i]).tobytes()),
+                                         dtype=np.uint8).reshape(rows, BLOCK_SIZE)
+        macs = np.empty_like(state)
+        macs[order] = state
+        return macs
+
+
+contexts = threading.local()
+
+
+def key_context(key):
+    # one cache per thread, the CBC chaining value of a context shared between threads would be mixed
+    try:
+        cache = contexts.cache
+    except AttributeError:
+        cache = contexts.cache = functools.lru_cache(maxsize=CRYPTO_CACHE_SIZE)(KeyContext)
+    return cache(key)
+
+
+def cmac_bytes(key, data):
+    return key_context(key).cmac(data)[:4]
+
+
+def encrypt_aes_bytes(key, data):
+    # AES-CBC with a zero IV
+    return key_context(key).cbc_encrypt(data)
+
+
+def decrypt_aes_bytes(key, data):
+    return key_context(key).ecb.decrypt(data)
+
+
+def crypt_frame_payload_bytes(frm_payload, key, direction, dev_addr, f_cnt):
+    # FRMPayload encryption and decryption alike, direction 0 uplink and 1 downlink, dev_addr as on air
+    size = len(frm_payload)
+    if not size:
+        return b""
+    blocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    a = bytearray((b"\x01\x00\x00\x00\x00" + bytes([direction]) + bytes(dev_addr) +
+                   (f_cnt & 0xffffffff).to_bytes(4, "little") + b"\x00\x00") * blocks)
+    a[BLOCK_SIZE - 1::BLOCK_SIZE] = range(1, blocks + 1)  # the block counters
+    keystream = key_context(key).ecb.encrypt(bytes(a))  # pycryptodome takes bytes faster than a bytearray
+    return (int.from_bytes(frm_payload, "big") ^ int.from_bytes(keystream[:size], "big")).to_bytes(size, "big")
+
+
+def b0_block(direction, dev_addr, f_cnt_int, size, conf_f_cnt=0):
+    return B0.pack(0x49, int(conf_f_cnt) & 0xffff, 0, direction, bytes(dev_addr), f_cnt_int & 0xffffffff, 0, size)
+
+
+def mic_up_bytes(msg, key, dev_addr, f_cnt_int):
+    return cmac_bytes(key, b0_block(0, dev_addr, f_cnt_int, len(msg)) + msg)
+
+
+def mic_down_bytes(msg, key, dev_addr, f_cnt_int, conf_f_cnt=0):
+    return cmac_bytes(key, b0_block(1, dev_addr, f_cnt_int, len(msg), conf_f_cnt) + msg)
+
+
+def verify_mics(frames):
+    '''
+    MIC check of many data frames, each (key, dev_addr, f_cnt, direction, msg) with msg the PHYPayload
+    and its MIC, the other fields as for mic_up_bytes and mic_down_bytes. The frames are grouped by key
+    and the CMACs of a group computed together. Returns a bool array, one per frame in their order.
+    '''
+    by_key = {}
+    for index, frame in enumerate(frames):
+        if 0 <= len(frame[4]) - 4 <= 0xff:  # longer ones do not fit B0, never valid
+            by_key.setdefault(frame[0], []).append(index)
+    results = np.zeros(len(frames), dtype=bool)
+    for key, indexes in by_key.items():
+        context = key_context(key)
+        for start in range(0, len(indexes), CMAC_BATCH_SIZE):
+            batch = indexes[start:start + CMAC_BATCH_SIZE]
+            messages = []
+            mics = []
+            for index in batch:
+                _, dev_addr, f_cnt, direction, msg = frames[index]
+                size = len(msg) - 4
+                messages.append(B0.pack(0x49, 0, 0, direction, bytes(dev_addr), f_cnt & 0xffffffff, 0, size) +
+                                msg[:size])
+                mics.append(msg[size:])
+            mics = np.frombuffer(b"".join(mics), dtype=np.uint8).reshape(len(batch), 4)
+            results[batch] = (context.cmac_many(messages)[:, :4] == mics).all(axis=1)
+    return results
 
-def calc_cmac(key, data):
-    cmac = CMAC.new(bytes.fromhex(key), ciphermod=AES).update(bytes.fromhex(data))
 
-    return cmac.hexdigest()[:8]
+def calc_cmac(key, data):
+    return cmac_bytes(bytes.fromhex(key), bytes.fromhex(data)).hex()
 
 
 def encrypt_aes(key, data):
-    encryptor = AES.new(bytes.fromhex(key), AES.MODE_CBC, IV=bytes.fromhex('00000000000000000000000000000000'))
-    return encryptor.encrypt(bytes.fromhex(data)).hex()
+    return encrypt_aes_bytes(bytes.fromhex(key), bytes.fromhex(data)).hex()
 
 
 def decrypt_aes(key, data):
-    #encryptor = AES.new(bytes.fromhex(key), AES.MODE_CBC, IV=bytes.fromhex('00000000000000000000000000000000'))
-    encryptor = AES.new(bytes.fromhex(key), AES.MODE_ECB)
-    return encryptor.decrypt(bytes.fromhex(data)).hex()
+    return decrypt_aes_bytes(bytes.fromhex(key), bytes.fromhex(data)).hex()
 
 
 def pad16(data):
@@ -63,25 +223,14 @@ def get_fcnt_string(cnt):
 
 
 def decrypt_frame_payload(frm_payload, key, direction, dev_addr, f_cnt):
-    k = int(np.ceil(len(frm_payload) / 32))
-    s = ''
-    for i in range(k):
-        s = s + encrypt_aes(key, '01' + '00000000' + direction + dev_addr + get_fcnt_string(f_cnt) + '00' +
-                            '%02x' % (i + 1))
-    decrypted = ''
-    for i in range(len(frm_payload)):
-        decrypted = decrypted + '%1x' % (int(s[i], 16) ^ int(frm_payload[i], 16))
-    return decrypted
+    return crypt_frame_payload_bytes(bytes.fromhex(frm_payload), bytes.fromhex(key), int(direction, 16),
+                                     bytes.fromhex(dev_addr), int(f_cnt)).hex()
 
 
 def calc_mic_up(msg, key, dev_addr, f_cnt_int):
-    b0 = '49' + '00000000' + '00' + dev_addr + get_fcnt_string(f_cnt_int) + '00' + '%02x' % int(len(msg) / 2)
-    mic = calc_cmac(key, b0 + msg)
-    return mic
+    return mic_up_bytes(bytes.fromhex(msg), bytes.fromhex(key), bytes.fromhex(dev_addr), f_cnt_int).hex()
 
 
 def calc_mic_down(msg, key, dev_addr, f_cnt_int, conf_f_cnt='00'):
-    b0 = '49' + get_fcnt_string(conf_f_cnt)[:4] + '0000' + '01' + dev_addr + get_fcnt_string(f_cnt_int) + '00' + \
-         '%02x' % int(len(msg) / 2)
-    mic = calc_cmac(key, b0 + msg)
-    return mic
+    return mic_down_bytes(bytes.fromhex(msg), bytes.fromhex(key), bytes.fromhex(dev_addr), f_cnt_int,
+                          conf_f_cnt).hex()
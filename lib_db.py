@@ -34,10 +34,12 @@ import os, sys
 import logging
 import numpy as np
 import threading
+import queue
+import time
 
 
 from lib_base import DB_FILE_PROXY, DB_FILE_BACKUP, DB_FILE_CONTROLLER, log_time, POWER_FOLDER, \
-    deduplication_threshold, CACHE_STATE
+    deduplication_threshold, CACHE_STATE, DB_WRITER_INTERVAL, DB_WRITER_BATCH, DB_WRITER_QUEUE_SIZE
 
 
 TABLES = {
@@ -50,7 +52,7 @@ TABLES = {
                 "UNIQUE(BenchID, StartTime) ON CONFLICT IGNORE)"),
         'nKeys': 20,
         'has_link': True,
-        'linked_table': ('session', 'packet', 'delay', 'power'),
+        'linked_table': ('session', 'packet', 'delay', 'power', 'reception', 'downlink', 'trace', 'dutycycle'),
         'primary_key': 'TestInstID',
         'unique_key': ('BenchID', 'StartTime')
     },
@@ -86,6 +88,34 @@ TABLES = {
                 "dst TEXT, UNIQUE (TestInstID, time_gen) ON CONFLICT IGNORE)"),
         'nKeys': 6
     },
+    'reception': {
+        'sql': ("CREATE TABLE IF NOT EXISTS reception (receptionID INTEGER PRIMARY KEY, "
+                "TestInstID INTEGER REFERENCES testInstance (TestInstID) ON DELETE CASCADE ON UPDATE CASCADE NOT NULL, "
+                "time REAL NOT NULL, gw TEXT, tmst INTEGER, chan INTEGER, rssi INTEGER, lsnr REAL, "
+                "UNIQUE (TestInstID, time, gw) ON CONFLICT IGNORE)"),
+        'nKeys': 8
+    },
+    'downlink': {
+        'sql': ("CREATE TABLE IF NOT EXISTS downlink (downlinkID INTEGER PRIMARY KEY, "
+                "TestInstID INTEGER REFERENCES testInstance (TestInstID) ON DELETE CASCADE ON UPDATE CASCADE NOT NULL, "
+                "time REAL NOT NULL, gw TEXT, tmst_up INTEGER, tmst_down INTEGER, rx_delay REAL, path REAL, "
+                "slack REAL, late INTEGER, UNIQUE (TestInstID, time) ON CONFLICT IGNORE)"),
+        'nKeys': 10
+    },
+    'trace': {
+        'sql': ("CREATE TABLE IF NOT EXISTS trace (traceID INTEGER PRIMARY KEY, "
+                "TestInstID INTEGER REFERENCES testInstance (TestInstID) ON DELETE CASCADE ON UPDATE CASCADE NOT NULL, "
+                "trace INTEGER NOT NULL, time REAL NOT NULL, direction TEXT, origin TEXT, "
+                "tc_tx REAL, tc_rx REAL, fwd REAL, ack REAL, UNIQUE (TestInstID, trace) ON CONFLICT IGNORE)"),
+        'nKeys': 10
+    },
+    'dutycycle': {
+        'sql': ("CREATE TABLE IF NOT EXISTS dutycycle (dutycycleID INTEGER PRIMARY KEY, "
+                "TestInstID INTEGER REFERENCES testInstance (TestInstID) ON DELETE CASCADE ON UPDATE CASCADE NOT NULL, "
+                "time REAL NOT NULL, kind TEXT, band TEXT, freq REAL, toa REAL, airtime REAL, allowed REAL, "
+                "UNIQUE (TestInstID, time, kind) ON CONFLICT IGNORE)"),
+        'nKeys': 9
+    },
     'power': {
         'sql': ("CREATE TABLE IF NOT EXISTS power (powerID INTEGER PRIMARY KEY, "
                 "TestInstID INTEGER REFERENCES testInstance (TestInstID) ON DELETE CASCADE ON UPDATE CASCADE NOT NULL, "
@@ -223,6 +253,13 @@ def create_db_tables_proxy():
         conn.execute("CREATE INDEX IF NOT EXISTS packet_time ON packet(time)")
         conn.execute(TABLES['delay']['sql'])
         conn.execute("CREATE INDEX IF NOT EXISTS delay_time ON delay(time_gen)")
+        conn.execute(TABLES['reception']['sql'])
+        conn.execute("CREATE INDEX IF NOT EXISTS reception_time ON reception(time)")
+        conn.execute(TABLES['downlink']['sql'])
+        conn.execute("CREATE INDEX IF NOT EXISTS downlink_time ON downlink(time)")
+        conn.execute(TABLES['trace']['sql'])
+        conn.execute("CREATE INDEX IF NOT EXISTS trace_time ON trace(time)")
+        conn.execute(TABLES['dutycycle']['sql'])
         conn.commit()
         conn.close()
 
@@ -276,15 +313,15 @@ def backup_db_proxy():
     logging.debug("start proxy db backup")
 
     data = {}
-    for table in ["packet", "session", "delay"]:
+    for table in ["packet", "session", "delay", "reception", "downlink", "trace", "dutycycle"]:
         data[table] = conn_src.execute("SELECT * FROM " + table).fetchall()
-        if table in ["packet", "delay"]:
+        if table in ["packet", "delay", "reception", "downlink", "trace", "dutycycle"]:
             conn_src.executemany("DELETE FROM " + table + " WHERE rowid = (?)", [(p[0], ) for p in data[table]])
         conn_src.commit()
     
     logging.debug("done proxy db reading")
 
-    for table in ["packet", "session", "delay"]:
+    for table in ["packet", "session", "delay", "reception", "downlink", "trace", "dutycycle"]:
         conn_dst.executemany("INSERT OR REPLACE INTO "+table+" VALUES (" + "?,"*(TABLES[table]['nKeys']-1) + "?)",
                              [((None,)+p[1:]) for p in data[table]])
     conn_dst.commit()
@@ -298,6 +335,89 @@ def backup_db_proxy():
     conn_src.close()
 
 
+class DbWriter():
+    '''
+    Write-behind queue, a writer thread commits the queued statements in one
+    transaction every DB_WRITER_INTERVAL seconds or DB_WRITER_BATCH rows. The
+    rows that fail are counted in dropped, with those the full queue refused.
+    '''
+    STOP = None
+
+    def __init__(self, db_file, interval=DB_WRITER_INTERVAL, batch=DB_WRITER_BATCH,
+                 queue_size=DB_WRITER_QUEUE_SIZE):
+        self.db_file = db_file
+        self.interval = interval
+        self.batch = batch
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()  # counted by the caller and the writer thread
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def execute(self, sql, params):
+        try:
+            self.queue.put_nowait((sql, params))
+        except queue.Full:
+            logging.error("[db writer] queue is full, row dropped, {} dropped in total".format(self.drop()))
+
+    def drop(self):
+        with self.dropped_lock:
+            self.dropped += 1
+            return self.dropped
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def flush(self):
+        # blocks until the queued rows are committed
+        if self.thread.is_alive():
+            self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(self.STOP)
+            self.thread.join()
+
+    def run(self):
+        conn = sqlite3.connect(self.db_file, timeout=60)
+        running = True
+        while running:
+            rows = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(rows) < self.batch and rows[-1] is not self.STOP:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    rows.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            if rows[-1] is self.STOP:
+                running = False
+                rows.pop()
+                self.queue.task_done()
+            try:
+                with conn:
+                    for row in rows:
+                        conn.execute(*row)
+            except sqlite3.Error:
+                # the batch is rolled back, written again one row per transaction so only the bad rows are lost
+                logging.exception("[db writer] failed to write {} rows, retrying one by one".format(len(rows)))
+                self.write_each(conn, rows)
+            for _ in rows:
+                self.queue.task_done()
+        conn.close()
+
+    def write_each(self, conn, rows):
+        for row in rows:
+            try:
+                with conn:
+                    conn.execute(*row)
+            except sqlite3.Error as e:
+                logging.error("[db writer] row dropped, {} dropped in total: {} {}".format(self.drop(), e, row))
+
+
 def recover_db_proxy():
     if not os.path.exists(DB_FILE_PROXY):
         create_db_tables_proxy()
@@ -371,14 +491,14 @@ def calc_db_pm(test_inst_id, conn=None):
         end_time -= step
 
         data_insert = []
-        for time in range(start_time, end_time, step):
+        for start in range(start_time, end_time, step):
             avg = conn.execute('SELECT AVG(average) FROM power WHERE testInstID=(?) AND duration=1 AND time >= (?) AND time < (?)',
-                               (test_inst_id, time, time + step)).fetchone()["AVG(average)"]
+                               (test_inst_id, start, start + step)).fetchone()["AVG(average)"]
 
             if avg is not None:
                 peak = conn.execute('SELECT MAX(max) FROM power WHERE testInstID=(?) AND duration=1 AND time >= (?) AND time < (?)',
-                                    (test_inst_id, time, time + step)).fetchone()["MAX(max)"]
-                data_insert.append((test_inst_id, time, int(avg), peak, step))
+                                    (test_inst_id, start, start + step)).fetchone()["MAX(max)"]
+                data_insert.append((test_inst_id, start, int(avg), peak, step))
 
         conn.executemany("INSERT OR REPLACE INTO power (TestInstID, time,average,max,duration) VALUES (?,?,?,?,?)", data_insert)
         conn.commit()
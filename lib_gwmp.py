@@ -0,0 +1,93 @@
+#file      lib_gwmp.py
+
+#brief      Semtech UDP (GWMP) frames read and rewritten in place
+
+#Revised BSD License
+
+#Copyright Semtech Corporation 2021. All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#Redistributions of source code must retain the above copyright
+#notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright
+#notice, this list of conditions and the following disclaimer in the
+#documentation and/or other materials provided with the distribution.
+#Neither the name of the Semtech corporation nor the
+#names of its contributors may be used to endorse or promote products
+#derived from this software without specific prior written permission.
+
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL SEMTECH CORPORATION. BE LIABLE FOR ANY DIRECT,
+#INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import json
+import socket
+import struct
+
+from lib_base import PROC_MSG
+
+# version, token, identifier, then the EUI of the gateway for the frames a gateway sends
+GWMP_HEADER = struct.Struct(">B2sB")
+GWMP_EUI_SIZE = 8
+GWMP_EUI_IDENTS = frozenset((PROC_MSG["GW_PUSH_DATA"], PROC_MSG["GW_PULL_DATA"], PROC_MSG["GW_TX_ACK"]))
+GWMP_VERSION = 2
+SENDMSG = hasattr(socket.socket, "sendmsg")  # not on windows
+
+
+def parse_header(byte_data):
+    # version, token and identifier, without copying the datagram
+    return GWMP_HEADER.unpack_from(byte_data)
+
+
+def body_offset(ident):
+    return GWMP_HEADER.size + (GWMP_EUI_SIZE if ident in GWMP_EUI_IDENTS else 0)
+
+
+def gateway_eui(byte_data):
+    return byte_data[GWMP_HEADER.size:GWMP_HEADER.size + GWMP_EUI_SIZE]
+
+
+def json_body(byte_data):
+    return json.loads(byte_data[body_offset(byte_data[3]):])
+
+
+def build(token, ident, gateway=b"", body=b""):
+    return GWMP_HEADER.pack(GWMP_VERSION, token, ident) + gateway + body
+
+
+def rewrite(byte_data, gateway=None, token=None, ident=None):
+    '''
+    The frame with a new header as a list of buffers for send_frame, the body is a view of the datagram.
+    '''
+    version, old_token, old_ident = GWMP_HEADER.unpack_from(byte_data)
+    view = memoryview(byte_data)
+    offset = body_offset(old_ident)
+    header = view[:GWMP_HEADER.size] if token is None and ident is None else \
+        GWMP_HEADER.pack(version, old_token if token is None else token, old_ident if ident is None else ident)
+    if offset == GWMP_HEADER.size:
+        return [header, view[offset:]]
+    return [header, view[GWMP_HEADER.size:offset] if gateway is None else gateway, view[offset:]]
+
+
+def join(byte_data):
+    return b"".join(byte_data) if isinstance(byte_data, list) else byte_data
+
+
+def send_frame(sock, byte_data, addr):
+    # a list of buffers is gathered by the kernel instead of joined first
+    if not isinstance(byte_data, list):
+        sock.sendto(byte_data, addr)
+    elif SENDMSG:
+        sock.sendmsg(byte_data, (), 0, addr)
+    else:
+        sock.sendto(b"".join(byte_data), addr)
@@ -0,0 +1,152 @@
+#file      lib_ipc.py
+
+#brief      message framing between the proxy and the test controller
+
+#Revised BSD License
+
+#Copyright Semtech Corporation 2021. All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#Redistributions of source code must retain the above copyright
+#notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright
+#notice, this list of conditions and the following disclaimer in the
+#documentation and/or other materials provided with the distribution.
+#Neither the name of the Semtech corporation nor the
+#names of its contributors may be used to endorse or promote products
+#derived from this software without specific prior written permission.
+
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL SEMTECH CORPORATION. BE LIABLE FOR ANY DIRECT,
+#INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import base64
+import struct
+
+# TC_DATA body: json {"rxpk": pkt} / {"txpk": pkt}, or a binary frame starting with TC_FRAME_MAGIC
+# (a json body always starts with '{'). The binary frame is a fixed header with the radio fields
+# flagged in a mask, the strings, the raw PHYPayload, then whatever is left of the packet as json.
+TC_FRAME_MAGIC = 0xC7
+TC_FRAME_VERSION = 2
+TC_FRAME_KINDS = ("rxpk", "txpk")
+TC_FRAME_FIELDS = (("tmst", "I"), ("freq", "d"), ("rssi", "h"), ("lsnr", "d"), ("powe", "b"), ("rfch", "B"),
+                   ("chan", "B"), ("stat", "b"), ("size", "h"), ("time", "d"), ("trace", "Q"))
+TC_FRAME_STRINGS = ("modu", "datr", "codr")
+TC_FRAME_DATA_BIT = len(TC_FRAME_FIELDS) + len(TC_FRAME_STRINGS)
+TC_FRAME_HEADER = struct.Struct(">BBBH" + "".join(code for _, code in TC_FRAME_FIELDS))
+TC_FRAME_DATA_LEN = struct.Struct(">H")
+
+# TC_GET_PACKET reply: GWMP style header, cursor header, then length prefixed json records
+PACKET_CHUNK_HEADER = struct.Struct(">dHB")
+PACKET_RECORD_LEN = struct.Struct(">H")
+PACKET_CHUNK_SIZE = 8192
+
+
+def pack_packet_chunk(header, records, next_since, more):
+    chunks = [header, PACKET_CHUNK_HEADER.pack(next_since, len(records), more)]
+    for record in records:
+        chunks.append(PACKET_RECORD_LEN.pack(len(record)))
+        chunks.append(record)
+    return b"".join(chunks)
+
+
+def unpack_packet_chunk(byte_data):
+    next_since, count, more = PACKET_CHUNK_HEADER.unpack_from(byte_data, 4)
+    offset = 4 + PACKET_CHUNK_HEADER.size
+    records = []
+    for _ in range(count):
+        length = PACKET_RECORD_LEN.unpack_from(byte_data, offset)[0]
+        offset += PACKET_RECORD_LEN.size
+        records.append(byte_data[offset:offset + length])
+        offset += length
+    return records, next_since, bool(more)
+
+
+def pack_tc_data(header, kind, pkt, binary=True, decoded=True):
+    if not decoded and pkt and "json" in pkt:
+        pkt = {key: value for key, value in pkt.items() if key != "json"}
+    if not binary or not pkt:
+        return header + json.dumps({kind: pkt}).encode()
+
+    extras = dict(pkt)
+    mask = 0
+    values = []
+    for bit, (key, _) in enumerate(TC_FRAME_FIELDS):
+        value = extras.pop(key, None)
+        if value is None:
+            values.append(0)
+        else:
+            mask |= 1 << bit
+            values.append(value)
+
+    chunks = []
+    for bit, key in enumerate(TC_FRAME_STRINGS, len(TC_FRAME_FIELDS)):
+        value = extras.get(key)
+        if isinstance(value, str) and len(value) < 256 and value.isascii():
+            mask |= 1 << bit
+            chunks.append(bytes([len(value)]) + value.encode())
+            del extras[key]
+
+    data = extras.get("data")
+    if isinstance(data, str):
+        try:
+            phy_payload = base64.b64decode(data, validate=True)
+        except ValueError:
+            phy_payload = None
+        if phy_payload is not None and base64.b64encode(phy_payload).decode() == data:
+            mask |= 1 << TC_FRAME_DATA_BIT
+            chunks.append(TC_FRAME_DATA_LEN.pack(len(phy_payload)) + phy_payload)
+            del extras["data"]
+
+    try:
+        fixed = TC_FRAME_HEADER.pack(TC_FRAME_MAGIC, TC_FRAME_VERSION, TC_FRAME_KINDS.index(kind), mask, *values)
+    except struct.error:  # a field out of range or of another type, json keeps it as it is
+        return header + json.dumps({kind: pkt}).encode()
+    chunks.insert(0, fixed)
+    if extras:
+        chunks.append(json.dumps(extras).encode())
+    return header + b"".join(chunks)
+
+
+def unpack_tc_data(byte_data):
+    body = byte_data[4:]
+    if not body or body[0] != TC_FRAME_MAGIC:
+        json_data = json.loads(body.decode())
+        for kind in TC_FRAME_KINDS:
+            if kind in json_data:
+                return kind, json_data[kind]
+        return None, None
+
+    fields = TC_FRAME_HEADER.unpack_from(body)
+    if fields[1] != TC_FRAME_VERSION:
+        raise ValueError("unsupported TC_DATA frame version {}".format(fields[1]))
+    mask = fields[3]
+    pkt = {}
+    for bit, ((key, _), value) in enumerate(zip(TC_FRAME_FIELDS, fields[4:])):
+        if mask >> bit & 1:
+            pkt[key] = value
+
+    offset = TC_FRAME_HEADER.size
+    for bit, key in enumerate(TC_FRAME_STRINGS, len(TC_FRAME_FIELDS)):
+        if mask >> bit & 1:
+            length = body[offset]
+            pkt[key] = body[offset + 1:offset + 1 + length].decode()
+            offset += 1 + length
+    if mask >> TC_FRAME_DATA_BIT & 1:
+        length = TC_FRAME_DATA_LEN.unpack_from(body, offset)[0]
+        offset += TC_FRAME_DATA_LEN.size
+        pkt["data"] = base64.b64encode(body[offset:offset + length]).decode()
+        offset += length
+    if offset < len(body):
+        pkt.update(json.loads(body[offset:].decode()))
+    return TC_FRAME_KINDS[fields[2]], pkt
@@ -37,31 +37,196 @@ Created on Mon Oct 15 17:24:14 2018
 """
 import sqlite3
 import time
+import json
 import base64
 import math
 import random
 import logging
 
-from lib_base import DB_FILE_PROXY
+from lib_base import DB_FILE_PROXY, SESSION_FLUSH_INTERVAL
 import lib_packet_command
 
-from lib_crypto import calc_cmac, encrypt_aes, decrypt_aes, pad16, decrypt_frame_payload, calc_mic_up, calc_mic_down
+from lib_crypto import cmac_bytes, encrypt_aes_bytes, decrypt_aes_bytes, crypt_frame_payload_bytes, mic_up_bytes, \
+    mic_down_bytes, BLOCK_SIZE
+
+
+# MType and single bits as the decoded frames show them
+M_TYPES = tuple(format(m_type, "03b") for m_type in range(8))
+BITS = ("0", "1")
+MIC_SIZE = 4
+DATA_HEADER_SIZE = 8  # MHDR, DevAddr, FCtrl and FCnt
+
+
+class PHYPayload:
+    '''
+    A frame read as bytes and ints, the MACPayload fields of a data frame once read_mac_payload is called.
+    Views of the frame, not copies, until a field is turned into the hex of the decoded frame.
+    '''
+    __slots__ = ("data", "m_type", "major", "mic", "dev_addr", "f_ctrl", "f_opts_len", "f_cnt", "f_opts",
+                 "f_port", "frm_payload")
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.m_type = data[0] >> 5
+        self.major = data[0] & 0x01
+        self.mic = self.data[-MIC_SIZE:]
+
+    def uplink(self):
+        return self.m_type in (2, 4)  # unconfirmed/confirmed uplink
+
+    def read_mac_payload(self):
+        data = self.data
+        self.dev_addr = data[1:5]
+        self.f_ctrl = data[5]
+        self.f_opts_len = self.f_ctrl & 0x0f
+        self.f_cnt = int.from_bytes(data[6:8], "little")
+        end = DATA_HEADER_SIZE + self.f_opts_len
+        self.f_opts = data[DATA_HEADER_SIZE:end]
+        port_payload = data[end:-MIC_SIZE]
+        self.f_port = port_payload[0] if port_payload else None
+        self.frm_payload = port_payload[1:]
+
+
+def read_frame(pkt):
+    return PHYPayload(base64.b64decode(pkt['data']))
+
+
+class DataFrame():
+    '''
+    A data frame whose MIC checked, decoded up to its FCnt. fields() decrypts the FRMPayload with the key
+    of the session it was checked with and reads the MAC commands, the decoded frame of decode_data_frame.
+    When the test controller does not get the decoded fields, the proxy keeps the record until the
+    DbWriter thread stores it as json.
+    '''
+    __slots__ = ("frame", "packet", "direction", "key", "decoded")
+
+    def __init__(self, frame, packet, direction, key):
+        self.frame = frame
+        self.packet = packet
+        self.direction = direction
+        self.key = key
+        self.decoded = None
+
+    def __contains__(self, name):
+        return name in self.packet
+
+    def get(self, name, default=None):
+        return self.packet.get(name, default)
+
+    def fields(self):
+        # built once, into a new dict as the DbWriter thread may read it while the proxy asks again
+        if self.decoded is None:
+            self.decoded = self.read_fields(dict(self.packet))
+        return self.decoded
+
+    def read_fields(self, packet):
+        frame = self.frame
+        packet['FOpts'] = frame.f_opts.hex()
+
+        mac_commands = packet['FOpts']
+
+        if frame.f_port is not None:
+            packet['FPort'] = frame.f_port
+            decrypted = crypt_frame_payload_bytes(frame.frm_payload, bytes.fromhex(self.key),
+                                                  0 if self.direction else 1, frame.dev_addr, frame.f_cnt).hex()
+            packet['FRMPayload'] = decrypted
+            if frame.f_port == 0:
+                if mac_commands:
+                    packet['error'] = "Error, FOpts and port 0 used in the same packet"
+                    return packet
+                else:
+                    mac_commands = decrypted
+        else:
+            packet['FPort'] = -1
+            packet['FRMPayload'] = ""
+
+        packet['MAC Commands'] = lib_packet_command.MacCommandDecoder(mac_commands, self.direction)
+
+        return packet
+
+
+def decoded_fields(obj):
+    # json.dumps default of the packets that hold a DataFrame
+    if isinstance(obj, DataFrame):
+        return obj.fields()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+sqlite3.register_adapter(DataFrame, lambda record: json.dumps(record.fields()))
+
+
+def mhdr_byte(packet):
+    return int(packet['MType'], 2) << 5 | int(packet['Major'])
+
+
+SESSION_UPDATE = ('UPDATE session SET FCntUp=(?),NFCntDown=(?),AFCntDown=(?), AppSKey=(?),FNwkSIntKey=(?),'
+                  'SNwkSIntKey=(?),NwkSEncKey=(?),JoinNonce=(?),Home_NetID=(?),DevAddr=(?),RxDelay=(?),'
+                  'OptNeg=(?),RX1DRoffset=(?),RX2DataRate=(?), RX2Freq=(?) WHERE rowid=(?)')
+
+
+def session_row(session):
+    return (session['FCntUp'], session['NFCntDown'], session['AFCntDown'], session['AppSKey'],
+            session['FNwkSIntKey'], session['SNwkSIntKey'], session['NwkSEncKey'], session['JoinNonce'],
+            session['Home_NetID'], session['DevAddr'], session['RxDelay'], session['OptNeg'],
+            session['RX1DRoffset'], session['RX2DataRate'], session['RX2Freq'], session['rowid'])
+
+
+class SessionStore():
+    '''
+    The counters and keys of the joined sessions live in memory with their codec. The sessions that
+    changed are written to the session table in one transaction every SESSION_FLUSH_INTERVAL seconds,
+    and when their test stops.
+    '''
+    def __init__(self, conn, interval=SESSION_FLUSH_INTERVAL):
+        self.conn = conn
+        self.interval = interval
+        self.dirty = {}  # rowid -> session to write
+        self.deadline = time.monotonic() + interval
+
+    def changed(self, session):
+        self.dirty[session['rowid']] = session
+
+    def next_deadline(self):
+        return self.deadline if self.dirty else float("inf")
+
+    def flush(self, force=False):
+        if not force and time.monotonic() < self.deadline:
+            return
+        self.deadline = time.monotonic() + self.interval
+        if not self.dirty:
+            return
+        rows = [session_row(session) for session in self.dirty.values()]
+        self.dirty = {}
+        try:
+            with self.conn:
+                self.conn.executemany(SESSION_UPDATE, rows)
+        except sqlite3.Error as e:
+            logging.error("[session] cannot write {} session(s): {}".format(len(rows), e))
+
+    def close(self, session):
+        # the test of the session stops, write it now
+        if session.get('rowid') in self.dirty:
+            self.flush(force=True)
 
 
 class Codec:
-    def __init__(self, conn, test_inst_id, device=None):
+    def __init__(self, conn, test_inst_id, device=None, store=None):
         self.conn = conn
         self.test_inst_id = test_inst_id
         self.device = device
+        self.store = store  # SessionStore that writes the session, written at each frame without
         self.sessions = []
         self.session = {}
 
 
     def decode_join_request(self, pkt):
+        return self.decode_join_request_frame(read_frame(pkt))
+
+
+    def decode_join_request_frame(self, frame):
         packet = {}
-        phy_payload = base64.b64decode(pkt['data']).hex()
-        join_request_payload = phy_payload[2:-8]
-        packet['DevEui'] = join_request_payload[16:32]
+        join_request_payload = frame.data[1:-MIC_SIZE]
+        packet['DevEui'] = join_request_payload[8:16].hex()
 
         if not self.device or packet["DevEui"] != self.device["DevEui"]:
             logging.warning("DevEui {} is not the device under test".format(packet["DevEui"]))
@@ -72,35 +237,37 @@ class Codec:
 
         packet["region"] = self.device["region"]
 
-        cmac = calc_cmac(self.device["NwkKey"], phy_payload[:-8])
-        packet["mic"] = phy_payload[-8:]
+        cmac = cmac_bytes(bytes.fromhex(self.device["NwkKey"]), frame.data[:-MIC_SIZE])
+        packet["mic"] = frame.mic.hex()
 
-        if cmac != packet["mic"]:
+        if cmac != frame.mic:
             packet['error'] = 'MIC error'
             return packet
 
-        packet['JoinEUI'] = join_request_payload[:16]
-        packet['DevNonce'] = join_request_payload[32:36]
-
-        if 'error' not in packet:
-            self.session = {}
-            self.session['DevEui'] = packet['DevEui']
-            self.session['JoinEUI'] = packet['JoinEUI']
-            self.session['DevNonce'] = packet['DevNonce']
-            self.session['JoinDelay'] = 5
-            self.session['JoinReqType'] = 'ff'
-            self.session['time'] = time.time()
-            self.session['region'] = self.device['region']
-            self.sessions.append(self.session)
-            self.add_session()
-            logging.debug("new session: {}".format(self.session))
+        packet['JoinEUI'] = join_request_payload[:8].hex()
+        packet['DevNonce'] = join_request_payload[16:18].hex()
+
+        self.session = {}
+        self.session['DevEui'] = packet['DevEui']
+        self.session['JoinEUI'] = packet['JoinEUI']
+        self.session['DevNonce'] = packet['DevNonce']
+        self.session['JoinDelay'] = 5
+        self.session['JoinReqType'] = 'ff'
+        self.session['time'] = time.time()
+        self.session['region'] = self.device['region']
+        self.sessions.append(self.session)
+        self.add_session()
+        logging.debug("new session: {}".format(self.session))
 
         return packet
 
 
     def decode_join_accept(self, pkt):
+        return self.decode_join_accept_frame(read_frame(pkt))
+
+
+    def decode_join_accept_frame(self, frame):
         packet = {}
-        phy_payload = base64.b64decode(pkt['data']).hex()
 
         if 'DevNonce' not in self.session or 'JoinNonce' in self.session:
             packet['error'] = 'no session information'
@@ -110,182 +277,133 @@ class Codec:
         packet['DevEui'] = self.session['DevEui']
         packet["device"] = self.device
 
-        mhdr = phy_payload[:2]
-        mhdr_bin = bin(int(mhdr, 16))[2:].zfill(8)
-
-        major = mhdr_bin[7]
-        if major == "1":
+        if frame.major:
             packet['error'] = 'mayjor bit error'
             return packet
 
-        decrypted = encrypt_aes(self.device['NwkKey'], phy_payload[2:])
-        mic = decrypted[-8:]
-        packet["mic"] = mic
-        packet['JoinNonce'] = decrypted[:6]
-        packet['Home_NetID'] = decrypted[6:12]
-        packet['DevAddr'] = decrypted[12:20]
-
-        dl_settings = decrypted[20:22]
-        dl_settings_bin = bin(int(dl_settings, 16))[2:].zfill(8)
+        nwk_key = bytes.fromhex(self.device['NwkKey'])
+        decrypted = encrypt_aes_bytes(nwk_key, frame.data[1:])
+        packet["mic"] = decrypted[-MIC_SIZE:].hex()
+        packet['JoinNonce'] = decrypted[0:3].hex()
+        packet['Home_NetID'] = decrypted[3:6].hex()
+        packet['DevAddr'] = decrypted[6:10].hex()
 
-        packet['OptNeg'] = dl_settings_bin[0]
-        packet['RX1DRoffset'] = int(dl_settings_bin[1:4], 2)
-        packet['RX2DataRate'] = int(dl_settings_bin[4:8], 2)
+        dl_settings = decrypted[10] if len(decrypted) > 10 else 0
+        packet['OptNeg'] = BITS[dl_settings >> 7]
+        packet['RX1DRoffset'] = dl_settings >> 4 & 0x07
+        packet['RX2DataRate'] = dl_settings & 0x0f
 
-        packet['RxDelay'] = int(decrypted[22:24], 16)
-        packet['CFList'] = decrypted[24:-8]
+        packet['RxDelay'] = decrypted[11] if len(decrypted) > 11 else 0
+        packet['CFList'] = decrypted[12:-MIC_SIZE].hex()
 
         if packet['OptNeg'] == '0':
-            packet['AppSKey'] = encrypt_aes(self.device['NwkKey'],
-                                            pad16('02' + packet['JoinNonce'] + packet['Home_NetID'] + self.session['DevNonce']))
-            packet['FNwkSIntKey'] = encrypt_aes(self.device['NwkKey'], pad16(
-                '01' + packet['JoinNonce'] + packet['Home_NetID'] + self.session['DevNonce']))
+            key_input = (decrypted[0:6] + bytes.fromhex(self.session['DevNonce'])).ljust(BLOCK_SIZE - 1, b"\0")
+            packet['AppSKey'] = encrypt_aes_bytes(nwk_key, b"\x02" + key_input).hex()
+            packet['FNwkSIntKey'] = encrypt_aes_bytes(nwk_key, b"\x01" + key_input).hex()
             packet['SNwkSIntKey'] = packet['FNwkSIntKey']
             packet['NwkSEncKey'] = packet['FNwkSIntKey']
-
-            # pldCmac = phy_payload[:2] + decrypted[:-8]
-            # cmac = calCMAC(device['NwkKey'], pldCmac)
         else:
             packet['error'] = "LoRaWAN 1.1 not supported"
             return packet
 
-        if 'error' not in packet:
-            self.session['FCntUp'] = 0
-            self.session['NFCntDown'] = 0
-            self.session['AFCntDown'] = 0
-            for key in ['AppSKey', 'FNwkSIntKey', 'SNwkSIntKey', 'NwkSEncKey', 'JoinNonce',
-                        'Home_NetID', 'DevAddr', 'RxDelay', 'OptNeg', 'RX1DRoffset', 'RX2DataRate']:
-                self.session[key] = packet[key]
-            self.session['RX2Freq'] = 923.3
-            self.update_session()
-            logging.debug("update session: {}".format(self.session))
+        self.session['FCntUp'] = 0
+        self.session['NFCntDown'] = 0
+        self.session['AFCntDown'] = 0
+        for key in ['AppSKey', 'FNwkSIntKey', 'SNwkSIntKey', 'NwkSEncKey', 'JoinNonce',
+                    'Home_NetID', 'DevAddr', 'RxDelay', 'OptNeg', 'RX1DRoffset', 'RX2DataRate']:
+            self.session[key] = packet[key]
+        self.session['RX2Freq'] = 923.3
+        self.update_session()
+        logging.debug("update session: {}".format(self.session))
         return packet
 
 
-    def encode_join_accept(self, packet):
-        mhdr = "%02x" % int(packet['MType'] + '0000' + packet['Major'], 2)
+    def check_join_accept(self, pkt):
+        # tells whether a join accept answers the pending join request of this device
+        if not self.device or 'DevNonce' not in self.session or 'JoinNonce' in self.session:
+            return False
+        frame = read_frame(pkt)
+        nwk_key = bytes.fromhex(self.device['NwkKey'])
+        decrypted = encrypt_aes_bytes(nwk_key, frame.data[1:])
+        return cmac_bytes(nwk_key, bytes(frame.data[:1]) + decrypted[:-MIC_SIZE]) == decrypted[-MIC_SIZE:]
 
-        dl_settings = "%02x" % int(
-            packet['OptNeg'] + bin(packet['RX1DRoffset'])[2:].zfill(3) + bin(packet['RX2DataRate'])[2:].zfill(4), 2)
 
-        mic_cal = mhdr + packet['JoinNonce'] + packet['Home_NetID'] + packet['DevAddr'] + dl_settings + "%02x" % packet['RxDelay'] + packet['CFList']
+    def encode_join_accept(self, packet):
+        dl_settings = int(packet['OptNeg']) << 7 | (packet['RX1DRoffset'] & 0x07) << 4 | packet['RX2DataRate'] & 0x0f
+        mhdr = bytes([mhdr_byte(packet)])
+        decrypted = bytes.fromhex(packet['JoinNonce'] + packet['Home_NetID'] + packet['DevAddr']) + \
+            bytes([dl_settings, packet['RxDelay']]) + bytes.fromhex(packet['CFList'])
 
+        nwk_key = bytes.fromhex(self.device['NwkKey'])
         if packet["mic"] == "random":
             packet["mic"] = ('%08x' % random.randint(0, 2 ** 32 - 1)).lower()
         else:
-            packet["mic"] = calc_cmac(self.device['NwkKey'], mic_cal)
-        decrypted = packet['JoinNonce'] + packet['Home_NetID'] + packet['DevAddr'] + dl_settings + "%02x" % packet['RxDelay'] + packet['CFList'] + packet["mic"]
-        encrypted = decrypt_aes(self.device['NwkKey'], decrypted)
+            packet["mic"] = cmac_bytes(nwk_key, mhdr + decrypted).hex()
+        encrypted = decrypt_aes_bytes(nwk_key, decrypted + bytes.fromhex(packet["mic"]))
 
-        print(mhdr + encrypted)
-        return base64.b64encode(bytes.fromhex(mhdr + encrypted)).decode(), len(mhdr + encrypted) // 2
+        phy_payload = mhdr + encrypted
+        logging.debug("join accept {}".format(phy_payload.hex()))
+        return base64.b64encode(phy_payload).decode(), len(phy_payload)
 
 
     def encode_data(self, packet):
-        mhdr = "%02x" % int(packet['MType'] + '0000' + packet['Major'], 2)
+        mhdr = mhdr_byte(packet)
 
         if self.session['DevAddr'] != packet['DevAddr']:
             packet['error'] = 'no session information'
             return None
 
-        mac_payload = packet['DevAddr']
+        direction = packet['MType'] == '010' or packet['MType'] == '100'  # unconfirmed/confirmed uplink
 
-        if packet['MType'] == '010' or packet['MType'] == '100':  # unconfirmed/confirmed uplink
-            direction = True
-        else:
-            direction = False
-
-        if direction:  # unconfirmed/confirmed uplink
-            if "requireACKdown" in self.session and  self.session["requireACKdown"]:
-                packet['ACK'] = "1"
-            else:
-                packet['ACK'] = "0"
-
-            f_ctrl_bin = packet['ADR'] + packet['ADRACKReq'] + packet['ACK'] + packet['ClassB']
-        else:
-            if "requireACKup" in self.session and self.session["requireACKup"]:
-                packet['ACK'] = "1"
-            else:
-                packet['ACK'] = "0"
-
-            f_ctrl_bin = packet['ADR'] + '0' + packet['ACK'] + packet['FPending']
-
-        if "FOpts" in packet:
-            f_opts = packet["FOpts"]
+        if direction:
+            packet['ACK'] = "1" if self.session.get("requireACKdown") else "0"
+            f_ctrl = int(packet['ADR']) << 7 | int(packet['ADRACKReq']) << 6 | int(packet['ClassB']) << 4
         else:
-            f_opts = ""
-        f_opts_len = int(len(f_opts) / 2)
-
-        f_ctrl_bin += bin(f_opts_len)[2:].zfill(4)
-        f_ctrl = "%02x" % int(f_ctrl_bin, 2)
+            packet['ACK'] = "1" if self.session.get("requireACKup") else "0"
+            f_ctrl = int(packet['ADR']) << 7 | int(packet['FPending']) << 4
+        f_ctrl |= int(packet['ACK']) << 5
 
-        mac_payload += f_ctrl
-
-        f_cnt = "%04x" % (packet["FCnt"])
+        f_opts = bytes.fromhex(packet.get("FOpts", ""))
+        f_ctrl |= len(f_opts)
         f_cnt_int = packet["FCnt"]
+        dev_addr = bytes.fromhex(packet['DevAddr'])
 
-        f_cnt = f_cnt[2:4] + f_cnt[0:2]
-        mac_payload += f_cnt
-        mac_payload += f_opts
+        phy_payload = bytes([mhdr]) + dev_addr + bytes([f_ctrl]) + (f_cnt_int & 0xffff).to_bytes(2, "little") + f_opts
 
         if 'FPort' in packet and packet["FPort"] >= 0:
-            if packet['FPort'] != 0:
-                if direction:
-                    frm_payload_encrypt = decrypt_frame_payload(packet['FRMPayload'], self.session['AppSKey'], '00',
-                                                                packet['DevAddr'], f_cnt_int)
-                else:
-                    frm_payload_encrypt = decrypt_frame_payload(packet['FRMPayload'], self.session['AppSKey'], '01',
-                                                                packet['DevAddr'], f_cnt_int)
-            else:
-                if direction:
-                    frm_payload_encrypt = decrypt_frame_payload(packet['FRMPayload'], self.session['NwkSEncKey'], '00',
-                                                                packet['DevAddr'], f_cnt_int)
-                else:
-                    frm_payload_encrypt = decrypt_frame_payload(packet['FRMPayload'], self.session['NwkSEncKey'], '01',
-                                                                packet['DevAddr'], f_cnt_int)
-            mac_payload = mac_payload + '%02x' % packet['FPort'] + frm_payload_encrypt
-
-        phy_payload = mhdr + mac_payload
-
+            key = self.session['AppSKey'] if packet['FPort'] != 0 else self.session['NwkSEncKey']
+            frm_payload_encrypt = crypt_frame_payload_bytes(bytes.fromhex(packet['FRMPayload']), bytes.fromhex(key),
+                                                            0 if direction else 1, dev_addr, f_cnt_int)
+            phy_payload += bytes([packet['FPort']]) + frm_payload_encrypt
 
         if len(packet["mic"]) <= 8:
             if direction:
-                mic = calc_mic_up(phy_payload, self.session['FNwkSIntKey'], packet['DevAddr'], f_cnt_int)
+                mic = mic_up_bytes(phy_payload, bytes.fromhex(self.session['FNwkSIntKey']), dev_addr, f_cnt_int)
             else:
-                mic = calc_mic_down(phy_payload, self.session['FNwkSIntKey'], packet['DevAddr'], f_cnt_int)
+                mic = mic_down_bytes(phy_payload, bytes.fromhex(self.session['FNwkSIntKey']), dev_addr, f_cnt_int)
         else:
-            mic = packet["mic"][:8]
+            mic = bytes.fromhex(packet["mic"][:8])
 
-        phy_payload = phy_payload + mic
+        phy_payload += mic
 
-        '''
-        if direction:
-            conn.execute("UPDATE session SET FCntUp=(?) WHERE rowid = (SELECT rowid FROM session WHERE DevAddr = (?) ORDER BY time DESC LIMIT 1)", (f_cnt_int, packet['DevAddr']))
-        else:
-            if packet["FCnt"] >= session["AFCntDown"]:
-                conn.execute("UPDATE session SET AFCntDown=(?) WHERE rowid = (SELECT rowid FROM session WHERE DevAddr = (?) ORDER BY time DESC LIMIT 1)", (f_cnt_int, packet['DevAddr']))
-        conn.commit()
-        '''
         # needs to return size as int to work with ChirpStack
-        return base64.b64encode(bytes.fromhex(phy_payload)).decode(), len(phy_payload) // 2 
+        return base64.b64encode(phy_payload).decode(), len(phy_payload)
 
 
     def decode_data(self, pkt):
-        packet = {}
+        return self.decode_data_frame(read_frame(pkt))
 
-        phy_payload = base64.b64decode(pkt['data']).hex()
-        mhdr = phy_payload[:2]
-        mhdr_bin = bin(int(mhdr, 16))[2:].zfill(8)
-        m_type = mhdr_bin[:3]
 
-        if m_type == '010' or m_type == '100':  # unconfirmed/confirmed uplink
-            direction = True
-        else:
-            direction = False
-
-        mac_payload = phy_payload[2:]
+    def decode_data_frame(self, frame, lazy=False):
+        # lazy returns the DataFrame of a frame whose MIC checked, its fields() are the decoded frame
+        packet = {}
+        direction = frame.uplink()
+        if len(frame.data) < DATA_HEADER_SIZE + MIC_SIZE:
+            packet['error'] = 'frame too short'
+            return packet
+        frame.read_mac_payload()
 
-        packet['DevAddr'] = mac_payload[:8]
+        packet['DevAddr'] = frame.dev_addr.hex()
         if 'DevAddr' not in self.session or not self.session['DevAddr']:
             packet['error'] = 'no session information'
             return packet
@@ -293,100 +411,74 @@ class Codec:
         packet['DevEui'] = self.session['DevEui']
         packet['region'] = self.session["region"]
 
-        f_ctrl = mac_payload[8:10]
-        f_ctrl_bin = bin(int(f_ctrl, 16))[2:].zfill(8)
-
-        if direction:  # unconfirmed/confirmed uplink
-            packet['ADR'] = f_ctrl_bin[0]
-            packet['ADRACKReq'] = f_ctrl_bin[1]
-            packet['ACK'] = f_ctrl_bin[2]
-            packet['ClassB'] = f_ctrl_bin[3]
+        f_ctrl = frame.f_ctrl
+        packet['ADR'] = BITS[f_ctrl >> 7]
+        if direction:
+            packet['ADRACKReq'] = BITS[f_ctrl >> 6 & 1]
+            packet['ACK'] = BITS[f_ctrl >> 5 & 1]
+            packet['ClassB'] = BITS[f_ctrl >> 4 & 1]
         else:
-            packet['ADR'] = f_ctrl_bin[0]
-            packet['ACK'] = f_ctrl_bin[2]
-            packet['FPending'] = f_ctrl_bin[3]
+            packet['ACK'] = BITS[f_ctrl >> 5 & 1]
+            packet['FPending'] = BITS[f_ctrl >> 4 & 1]
 
-        packet['FOptsLen'] = int(f_ctrl_bin[4:8], 2)
-
-        f_cnt = mac_payload[10:14]
-        f_cnt_int = int(f_cnt[2:4] + f_cnt[0:2], 16)
+        packet['FOptsLen'] = frame.f_opts_len
+        f_cnt_int = frame.f_cnt
         packet['FCnt'] = f_cnt_int
 
         if direction:
-            mic_calc = calc_mic_up(phy_payload[:-8], self.session['FNwkSIntKey'], packet['DevAddr'], f_cnt_int)
+            mic_calc = mic_up_bytes(frame.data[:-MIC_SIZE], bytes.fromhex(self.session['FNwkSIntKey']),
+                                    frame.dev_addr, f_cnt_int)
         else:
-            mic_calc = calc_mic_down(phy_payload[:-8], self.session['FNwkSIntKey'], packet['DevAddr'], f_cnt_int)
+            mic_calc = mic_down_bytes(frame.data[:-MIC_SIZE], bytes.fromhex(self.session['FNwkSIntKey']),
+                                      frame.dev_addr, f_cnt_int)
 
-        mic = mac_payload[-8:]
-        packet['mic'] = mic
+        packet['mic'] = frame.mic.hex()
 
-        if mic_calc != mic:
+        if mic_calc != frame.mic:
             packet['error'] = 'MIC error'
-            packet['mic calc'] = mic_calc
+            packet['mic calc'] = mic_calc.hex()
             return packet
 
         if direction:
             self.session['FCntUp'] = f_cnt_int
-            self.session['requireACKup'] = int(m_type == "100")
+            self.session['requireACKup'] = int(frame.m_type == 4)
         else:
             self.session['FCntDown'] = f_cnt_int
-            self.session['requireACKdown'] = int(m_type == "101")
+            # LoRaWAN 1.0, one downlink counter for the network and the application
+            self.session['NFCntDown'] = f_cnt_int
+            self.session['AFCntDown'] = f_cnt_int
+            self.session['requireACKdown'] = int(frame.m_type == 5)
         self.update_count(direction)
 
-        packet['FOpts'] = mac_payload[14:14 + 2 * packet['FOptsLen']]
-
-        mac_commands = packet['FOpts']
-
-        f_port_frm_payload = mac_payload[14 + 2 * packet['FOptsLen']:-8]
-        if len(f_port_frm_payload) > 0:
-            f_port = f_port_frm_payload[:2]
-            packet['FPort'] = int(f_port, 16)
-
-            frm_payload = f_port_frm_payload[2:]
-
-            if f_port != '00':
-                if direction:
-                    decrypted = decrypt_frame_payload(frm_payload, self.session['AppSKey'], '00', packet['DevAddr'], f_cnt_int)
-                else:
-                    decrypted = decrypt_frame_payload(frm_payload, self.session['AppSKey'], '01', packet['DevAddr'], f_cnt_int)
-                packet['FRMPayload'] = decrypted
-            else:
-                if direction:
-                    decrypted = decrypt_frame_payload(frm_payload, self.session['NwkSEncKey'], '00', packet['DevAddr'], f_cnt_int)
-                else:
-                    decrypted = decrypt_frame_payload(frm_payload, self.session['NwkSEncKey'], '01', packet['DevAddr'], f_cnt_int)
-                packet['FRMPayload'] = decrypted
-                if mac_commands:
-                    packet['error'] = "Error, FOpts and port 0 used in the same packet"
-                    return packet
-                else:
-                    mac_commands = decrypted
+        if frame.f_port is None:
+            key = None
         else:
-            packet['FPort'] = -1
-            packet['FRMPayload'] = ""
-
-        packet['MAC Commands'] = lib_packet_command.MacCommandDecoder(mac_commands, direction)
-
+            key = self.session['AppSKey'] if frame.f_port != 0 else self.session['NwkSEncKey']
+        record = DataFrame(frame, packet, direction, key)
+        # FOpts with port 0 is an error only the fields tell, the caller has to see it now
+        if lazy and not (frame.f_port == 0 and frame.f_opts_len):
+            return record
+        return record.fields()
+
+    def decode_data_head(self, frame, packet, lazy):
+        # the MHDR fields of decode_uplink and decode_downlink first, then those of the data frame
+        decoded = self.decode_data_frame(frame, lazy)
+        if isinstance(decoded, DataFrame):
+            decoded.packet = dict(packet, **decoded.packet)
+            return decoded
+        packet.update(decoded)
         return packet
 
-    def decode_uplink(self, pkt):
-        packet = {}
-
-        phy_payload = base64.b64decode(pkt['data']).hex()
-        mhdr = phy_payload[:2]
-        mhdr_bin = bin(int(mhdr, 16))[2:].zfill(8)
-        m_type = mhdr_bin[:3]
+    def decode_uplink(self, pkt, lazy=False):
+        frame = read_frame(pkt)
+        packet = {'MType': M_TYPES[frame.m_type], 'Major': BITS[frame.major]}
 
-        packet['MType'] = m_type
-        packet['Major'] = mhdr_bin[7]
-
-        if m_type == '000':
-            packet = {**packet, **self.decode_join_request(pkt)}
+        if frame.m_type == 0:
+            packet.update(self.decode_join_request_frame(frame))
+        elif frame.uplink():
+            return self.decode_data_head(frame, packet, lazy)
         else:
-            if m_type == '010' or m_type == '100':
-                packet = {**packet, **self.decode_data(pkt)}
-            else:
-                packet["error"] = "unknown MType"
+            packet["error"] = "unknown MType"
 
         return packet
 
@@ -406,46 +498,21 @@ class Codec:
         return "", -1
 
 
-    def decode_downlink(self, pkt):
-        packet = {}
-
-        phy_payload = base64.b64decode(pkt['data']).hex()
-        mhdr = phy_payload[:2]
-        mhdr_bin = bin(int(mhdr, 16))[2:].zfill(8)
-        m_type = mhdr_bin[:3]
+    def decode_downlink(self, pkt, lazy=False):
+        frame = read_frame(pkt)
+        packet = {'MType': M_TYPES[frame.m_type], 'Major': BITS[frame.major]}
 
-        packet['MType'] = m_type
-        packet['Major'] = mhdr_bin[7]
-
-        if m_type == '001':
-            packet = {**packet, **self.decode_join_accept(pkt)}
+        if frame.m_type == 1:
+            packet.update(self.decode_join_accept_frame(frame))
+        elif frame.m_type in (3, 5):
+            return self.decode_data_head(frame, packet, lazy)
         else:
-            if m_type == '011' or m_type == '101':
-                packet = {**packet, **self.decode_data(pkt)}
-            else:
-                packet["error"] = "unknown MType"
+            packet["error"] = "unknown MType"
         return packet
 
 
     def mac_commands(self, pkt):
-        packet = {}
-
-        phy_payload = base64.b64decode(pkt['data']).hex()
-        mhdr = phy_payload[:2]
-        mhdr_bin = bin(int(mhdr, 16))[2:].zfill(8)
-        m_type = mhdr_bin[:3]
-
-        packet['MType'] = m_type
-        packet['Major'] = mhdr_bin[7]
-
-        if m_type == '001':
-            packet = {**packet, **self.decode_join_accept(pkt)}
-        else:
-            if m_type == '011' or m_type == '101':
-                packet = {**packet, **self.decode_data(pkt)}
-            else:
-                packet["error"] = "unknown MType"
-        return packet
+        return self.decode_downlink(pkt)
 
 
     def add_session(self):
@@ -459,25 +526,23 @@ class Codec:
 
 
     def update_session(self):
-        self.conn.execute('UPDATE session SET FCntUp=(?),NFCntDown=(?),AFCntDown=(?), AppSKey=(?),FNwkSIntKey=(?),'
-                          'SNwkSIntKey=(?),NwkSEncKey=(?),JoinNonce=(?),Home_NetID=(?),DevAddr=(?),RxDelay=(?),'
-                          'OptNeg=(?),RX1DRoffset=(?),RX2DataRate=(?), RX2Freq=(?) WHERE rowid=(?)',
-                          (self.session['FCntUp'], self.session['NFCntDown'], self.session['AFCntDown'],
-                           self.session['AppSKey'], self.session['FNwkSIntKey'], self.session['SNwkSIntKey'],
-                           self.session['NwkSEncKey'], self.session['JoinNonce'], self.session['Home_NetID'],
-                           self.session['DevAddr'], self.session['RxDelay'], self.session['OptNeg'],
-                           self.session['RX1DRoffset'], self.session['RX2DataRate'], self.session['RX2Freq'],
-                           self.session['rowid']))
+        if self.store:
+            self.store.changed(self.session)
+            return
+        self.conn.execute(SESSION_UPDATE, session_row(self.session))
         self.conn.commit()
 
 
     def update_count(self, direction):
+        if self.store:
+            self.store.changed(self.session)
+            return
         if direction:
             self.conn.execute("UPDATE session SET FCntUp=(?) WHERE rowid = (?)",
             (self.session['FCntUp'], self.session['rowid']))
         else:
-            self.conn.execute("UPDATE session SET AFCntDown=(?) WHERE rowid = (?)",
-            (self.session['FCntUp'], self.session['rowid']))
+            self.conn.execute("UPDATE session SET NFCntDown=(?), AFCntDown=(?) WHERE rowid = (?)",
+            (self.session['NFCntDown'], self.session['AFCntDown'], self.session['rowid']))
         self.conn.commit()
 
 
@@ -0,0 +1,176 @@
+#file      lib_pcap.py
+
+#brief      pcapng capture of the datagrams handled by the proxy
+
+#Revised BSD License
+
+#Copyright Semtech Corporation 2021. All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#Redistributions of source code must retain the above copyright
+#notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright
+#notice, this list of conditions and the following disclaimer in the
+#documentation and/or other materials provided with the distribution.
+#Neither the name of the Semtech corporation nor the
+#names of its contributors may be used to endorse or promote products
+#derived from this software without specific prior written permission.
+
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL SEMTECH CORPORATION. BE LIABLE FOR ANY DIRECT,
+#INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import time
+import queue
+import socket
+import struct
+import logging
+import threading
+
+from lib_base import PCAP_FOLDER
+
+PCAP_MAX_BYTES = 64 * 1024 * 1024
+PCAP_QUEUE_SIZE = 10000
+
+LINKTYPE_IPV4 = 228
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+SHB_TYPE = 0x0A0D0D0A
+IDB_TYPE = 0x00000001
+EPB_TYPE = 0x00000006
+OPT_ENDOFOPT = 0
+OPT_IF_TSRESOL = 9
+
+
+def pad4(data):
+    return data + bytes(-len(data) % 4)
+
+
+def block(block_type, body):
+    body = pad4(body)
+    length = len(body) + 12
+    return struct.pack("<II", block_type, length) + body + struct.pack("<I", length)
+
+
+def section_header():
+    return block(SHB_TYPE, struct.pack("<IHHq", BYTE_ORDER_MAGIC, 1, 0, -1))
+
+
+def interface_description():
+    # timestamps in microseconds
+    options = struct.pack("<HHB", OPT_IF_TSRESOL, 1, 6) + bytes(3) + struct.pack("<HH", OPT_ENDOFOPT, 0)
+    return block(IDB_TYPE, struct.pack("<HHI", LINKTYPE_IPV4, 0, 0) + options)
+
+
+def ip_checksum(header):
+    total = sum(struct.unpack("!10H", header))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def udp_datagram(payload, src, dst, ident):
+    # the UDP checksum is optional over IPv4 and left to 0
+    udp = struct.pack("!HHHH", src[1], dst[1], len(payload) + 8, 0)
+    ip = bytearray(struct.pack("!BBHHHBBH4s4s", 0x45, 0, len(payload) + 28, ident, 0x4000, 64,
+                               socket.IPPROTO_UDP, 0, src[0], dst[0]))
+    struct.pack_into("!H", ip, 10, ip_checksum(bytes(ip)))
+    return bytes(ip) + udp + payload
+
+
+def enhanced_packet(timestamp, data):
+    usec = int(timestamp * 1000000)
+    return block(EPB_TYPE, struct.pack("<IIIII", 0, usec >> 32, usec & 0xffffffff, len(data), len(data)) + data)
+
+
+class PcapCapture():
+    '''
+    Captures the datagrams of one test into PCAP_FOLDER/test_<TestInstID>_<time>_<n>.pcapng,
+    a new file is started every PCAP_MAX_BYTES. Files are written by a background thread.
+    '''
+    def __init__(self, test_inst_id, folder=PCAP_FOLDER, max_bytes=PCAP_MAX_BYTES):
+        self.test_inst_id = test_inst_id
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.timestamp = time.strftime("%Y-%m-%d-%H-%M-%S", time.localtime())
+        self.file = None
+        self.file_index = 0
+        self.file_size = 0
+        self.ident = 0
+        self.dropped = 0
+        self.addresses = {}
+        self.queue = queue.Queue(PCAP_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def capture(self, data, src, dst):
+        try:
+            self.queue.put_nowait((time.time(), data, src, dst))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.dropped:
+            logging.warning("[pcap] {} datagrams were not captured".format(self.dropped))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            timestamp, data, src, dst = item
+            try:
+                self.write(timestamp, data, src, dst)
+            except OSError:
+                logging.exception("[pcap] cannot write capture file")
+        if self.file:
+            self.file.close()
+
+    def write(self, timestamp, data, src, dst):
+        if self.file is None or self.file_size >= self.max_bytes:
+            self.open_next()
+        src, dst = (self.resolve(src[0], dst[0]), src[1]), (self.resolve(dst[0], src[0]), dst[1])
+        self.ident = (self.ident + 1) & 0xffff
+        packet = enhanced_packet(timestamp, udp_datagram(data, src, dst, self.ident))
+        self.file.write(packet)
+        self.file_size += len(packet)
+        if self.queue.empty():
+            self.file.flush()
+
+    def open_next(self):
+        if self.file:
+            self.file.close()
+        self.file_index += 1
+        path = os.path.join(self.folder, "test_{}_{}_{:03d}.pcapng".format(self.test_inst_id, self.timestamp,
+                                                                          self.file_index))
+        logging.info("[pcap] writing {}".format(path))
+        self.file = open(path, "wb")
+        header = section_header() + interface_description()
+        self.file.write(header)
+        self.file_size = len(header)
+
+    def resolve(self, host, peer):
+        # "" or 0.0.0.0 is the proxy itself, shown with the address used to reach the peer
+        key = (host, peer) if host in ("", "0.0.0.0") else host
+        if key not in self.addresses:
+            try:
+                if host in ("", "0.0.0.0"):
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    sock.connect((peer if peer not in ("", "0.0.0.0") else "127.0.0.1", 9))
+                    host = sock.getsockname()[0]
+                    sock.close()
+                self.addresses[key] = socket.inet_aton(socket.gethostbyname(host))
+            except OSError:
+                self.addresses[key] = bytes(4)
+        return self.addresses[key]
@@ -0,0 +1,144 @@
+#file      lib_stats.py
+
+#brief      counters and latency histograms of the proxy
+
+#Revised BSD License
+
+#Copyright Semtech Corporation 2021. All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#Redistributions of source code must retain the above copyright
+#notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright
+#notice, this list of conditions and the following disclaimer in the
+#documentation and/or other materials provided with the distribution.
+#Neither the name of the Semtech corporation nor the
+#names of its contributors may be used to endorse or promote products
+#derived from this software without specific prior written permission.
+
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL SEMTECH CORPORATION. BE LIABLE FOR ANY DIRECT,
+#INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import bisect
+import time
+
+# upper bounds of the latency buckets, doubling from 100 us to 3.3 s
+LATENCY_BUCKETS = tuple(0.0001 * 2 ** i for i in range(16))
+LATENCY_HOPS = ("gw_tc", "tc_ns", "ns_gw")
+STATS_PREFIX = "ctb_proxy"
+
+
+class Histogram():
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+class ProxyStats():
+    '''
+    Updated inline by the proxy loop, so recording is an increment or a bisect over a few buckets.
+    Gauges such as queue depths are read by the caller when a snapshot is taken.
+    '''
+    def __init__(self, msg_names):
+        self.started = time.time()
+        self.msg_names = msg_names
+        self.datagrams = [0] * 256
+        self.counters = {"dedup_merges": 0, "decode_errors": 0, "fast_path_frames": 0,
+                         "timely_downlinks": 0, "late_downlinks": 0, "duty_cycle_violations": 0,
+                         "unsolicited_joins": 0}
+        self.latencies = {hop: Histogram() for hop in LATENCY_HOPS}
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, hop, value):
+        self.latencies[hop].observe(value)
+
+    def snapshot(self, gauges):
+        datagrams = {}
+        for msg_type, count in enumerate(self.datagrams):
+            if count:
+                datagrams[self.msg_names.get(msg_type, str(msg_type))] = count
+        return {"time": time.time(), "uptime": time.time() - self.started, "datagrams": datagrams,
+                "counters": dict(self.counters), "gauges": gauges,
+                "latencies": {hop: histogram.snapshot() for hop, histogram in self.latencies.items()}}
+
+
+def merge_snapshots(snapshots):
+    # snapshots of the workers of a sharded proxy, counts add up, the gateways are heard by all
+    merged = {"time": time.time(), "uptime": max(snapshot["uptime"] for snapshot in snapshots),
+              "datagrams": {}, "counters": {}, "gauges": {}, "latencies": {}}
+    for snapshot in snapshots:
+        for field in ("datagrams", "counters", "gauges"):
+            for name, value in snapshot[field].items():
+                if name == "gateways":
+                    merged[field][name] = max(merged[field].get(name, 0), value)
+                else:
+                    merged[field][name] = merged[field].get(name, 0) + value
+        for hop, histogram in snapshot["latencies"].items():
+            if hop not in merged["latencies"]:
+                merged["latencies"][hop] = {"buckets": [list(bucket) for bucket in histogram["buckets"]],
+                                            "sum": histogram["sum"], "count": histogram["count"]}
+                continue
+            total = merged["latencies"][hop]
+            for bucket, (_, count) in zip(total["buckets"], histogram["buckets"]):
+                bucket[1] += count
+            total["sum"] += histogram["sum"]
+            total["count"] += histogram["count"]
+    return merged
+
+
+def format_prometheus(snapshot, prefix=STATS_PREFIX):
+    lines = ["# TYPE {}_uptime_seconds gauge".format(prefix),
+             "{}_uptime_seconds {:.3f}".format(prefix, snapshot["uptime"]),
+             "# TYPE {}_datagrams_total counter".format(prefix)]
+    for name, count in snapshot["datagrams"].items():
+        lines.append('{}_datagrams_total{{msg_type="{}"}} {}'.format(prefix, name, count))
+    for name, count in snapshot["counters"].items():
+        lines.append("# TYPE {}_{}_total counter".format(prefix, name))
+        lines.append("{}_{}_total {}".format(prefix, name, count))
+    for name, value in snapshot["gauges"].items():
+        lines.append("# TYPE {}_{} gauge".format(prefix, name))
+        lines.append("{}_{} {}".format(prefix, name, value))
+    lines.append("# TYPE {}_latency_seconds histogram".format(prefix))
+    for hop, histogram in snapshot["latencies"].items():
+        for bound, count in histogram["buckets"]:
+            le = "+Inf" if bound == float("inf") else "{:g}".format(bound)
+            lines.append('{}_latency_seconds_bucket{{hop="{}",le="{}"}} {}'.format(prefix, hop, le, count))
+        lines.append('{}_latency_seconds_sum{{hop="{}"}} {:.6f}'.format(prefix, hop, histogram["sum"]))
+        lines.append('{}_latency_seconds_count{{hop="{}"}} {}'.format(prefix, hop, histogram["count"]))
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(snapshot, file):
+    # written aside and renamed so a scraper never reads half a file
+    tmp_file = file + ".tmp"
+    with open(tmp_file, "w") as f:
+        f.write(format_prometheus(snapshot))
+    os.replace(tmp_file, file)
@@ -35,392 +35,1588 @@ Created on Mon Oct 15 17:24:14 2018
 
 @author: flu
 """
+import base64
+import re
 import socket
+import selectors
+import collections
+import bisect
+import glob
+import heapq
+import itertools
+import multiprocessing
+import struct
+import os
+import sys
 import json
 import time
 import sqlite3
 import random
 import logging
-
-from lib_base import addr_ns, addr_tc, gw_mac, DB_FILE_PROXY, DB_FILE_BACKUP, addr_pf, reliable_run,\
-    deduplication_threshold, MAX_TX_POWER, PROC_MSG, reverse_eui
-from lib_packet import get_toa, Codec
-from lib_db import recover_db_proxy, create_db_tables_proxy
-
-buffer = {}
-
-
-def append_packet(pkt, packets, test_inst_id, conn):
+import zlib
+
+from lib_base import addr_ns, gw_mac, DB_FILE_PROXY, DB_FILE_BACKUP, addr_pf, reliable_run,\
+    deduplication_threshold, MAX_TX_POWER, PROC_MSG, reverse_eui, PROXY_RCVBUF, install_term_handler, \
+    DEDUP_GUARD, DEDUP_TOA_RATIO, DEDUP_MAX_WINDOW, STATS_FILE_PROXY, STATS_INTERVAL, DOWNLINK_MIN_LEAD, PROXY_WORKERS, FILE_PROXY_CONTEXT, \
+    PROXY_CHECKPOINT_INTERVAL, DUTY_CYCLE_WINDOW, DUTY_CYCLE_BANDS, DWELL_TIME
+from lib_packet import get_toa, Codec, SessionStore, DataFrame, decoded_fields
+from lib_crypto import cmac_bytes
+from lib_db import recover_db_proxy, create_db_tables_proxy, DbWriter
+from lib_ipc import pack_packet_chunk, PACKET_CHUNK_SIZE, PACKET_CHUNK_HEADER, PACKET_RECORD_LEN
+from lib_ipc import pack_tc_data, unpack_tc_data, TC_FRAME_VERSION
+from lib_pcap import PcapCapture
+from lib_gwmp import parse_header, gateway_eui, json_body, build, rewrite, join, send_frame
+from lib_stats import ProxyStats, write_prometheus, merge_snapshots
+
+RECV_BUFSIZE = 10240
+DELAY_DST = ("tc", "ns", "gw")
+DELAY_TTL = 30
+DELAY_MAX_PENDING = 4096
+DELAY_RING_SIZE = 1024
+PACKET_WINDOW_SIZE = 2048
+PACKET_FETCH_LIMIT = 256
+# RX2 of a join accept with the longest RxDelay, a later tmst is not an answer to the last uplink
+DOWNLINK_MAX_RX_DELAY = 16
+# base64 PHYPayload of every rxpk/txpk, read without parsing the json
+DATA_FIELD = re.compile(rb'"data"\s*:\s*"([^"]*)"')
+# 24 base64 characters decode to the 18 bytes that hold MHDR and the DevEui of a join request
+PHY_HEADER_B64 = 24
+JOIN_REQUEST_SIZE = 23
+# Linux only, reports the number of datagrams the kernel dropped on a full receive buffer
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40)
+# sharded mode, seconds a worker gets to flush its database rows when the proxy stops
+WORKER_STOP_TIMEOUT = 5
+
+
+def packet_json(pkt):
+    # a DataFrame is stored as is, the DbWriter thread turns it into json
+    decoded = pkt["json"]
+    return decoded if isinstance(decoded, DataFrame) else json.dumps(decoded)
+
+
+def append_packet(pkt, packets, test_inst_id, writer):
     packets.append(pkt)
     if pkt["stat"] == 0 and pkt["direction"] == "up":
         logging.debug("[proxy] uplink before tc")
-        conn.execute("INSERT INTO packet (TestInstID, tmst, chan, rfch, freq, stat, modu, datr, "
+        writer.execute("INSERT INTO packet (TestInstID, tmst, chan, rfch, freq, stat, modu, datr, "
                      "codr, lsnr, rssi, size, data, time, direction, json, toa) "
                      "VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
                      (test_inst_id, pkt['tmst'], pkt['chan'], pkt['rfch'], pkt['freq'], pkt["stat"], pkt['modu'], pkt['datr'],
                       pkt['codr'], pkt['lsnr'], pkt['rssi'], pkt['size'], pkt['data'], pkt["time"], pkt["direction"],
-                      json.dumps(pkt["json"]), get_toa(pkt['size'], pkt['datr'])))
+                      packet_json(pkt), get_toa(pkt['size'], pkt['datr'])))
     elif pkt["stat"] == 0 and pkt["direction"] == "down":
         logging.debug("[proxy] downlink before tc")
-        conn.execute("INSERT INTO packet "
+        writer.execute("INSERT INTO packet "
                      "(TestInstID, tmst, rfch, freq, stat, modu, datr, codr, size, data, "
                      "time, powe, direction, fdev, prea, json, toa) "
                      "VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
                      (test_inst_id, pkt['tmst'], pkt['rfch'], pkt['freq'], pkt["stat"], pkt['modu'], pkt['datr'],
                       pkt['codr'], pkt['size'], pkt['data'], pkt["time"], pkt['powe'], pkt["direction"], pkt['fdev'],
-                      pkt['prea'], json.dumps(pkt["json"]), get_toa(pkt['size'], pkt['datr'])))
+                      pkt['prea'], packet_json(pkt), get_toa(pkt['size'], pkt['datr'])))
     elif pkt["stat"] == 1 and pkt["direction"] == "up":
         logging.debug("[proxy] uplink after tc")
-        conn.execute("INSERT INTO packet (TestInstID, tmst, chan, rfch, freq, stat, modu, datr, "
+        writer.execute("INSERT INTO packet (TestInstID, tmst, chan, rfch, freq, stat, modu, datr, "
                      "codr, lsnr, rssi, size, data, time, direction, json, toa) "
                      "VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
                      (test_inst_id, pkt['tmst'], pkt['chan'], pkt['rfch'], pkt['freq'], pkt["stat"], pkt['modu'], pkt['datr'],
                       pkt['codr'], pkt['lsnr'], pkt['rssi'], pkt['size'], pkt['data'], pkt["time"], pkt["direction"],
-                      json.dumps(pkt["json"]), get_toa(pkt['size'], pkt['datr'])))
+                      packet_json(pkt), get_toa(pkt['size'], pkt['datr'])))
     elif pkt["stat"] == 1 and pkt["direction"] == "down":
         logging.debug("[proxy] downlink after tc")
-        conn.execute("INSERT INTO packet "
+        writer.execute("INSERT INTO packet "
                      "(TestInstID, tmst, rfch, freq, stat, modu, datr, codr, size, data, "
                      "time, powe, direction, fdev, prea, json, toa) "
                      "VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
                      (test_inst_id, pkt['tmst'], pkt['rfch'], pkt['freq'], pkt["stat"], pkt['modu'], pkt['datr'],
                       pkt['codr'], pkt['size'], pkt['data'], pkt["time"], pkt['powe'], pkt["direction"], pkt['fdev'],
-                      pkt['prea'], json.dumps(pkt["json"]),
+                      pkt['prea'], packet_json(pkt),
                       get_toa(pkt['size'], pkt['datr'])))
-    conn.commit()
-
-
-def append_delay(token, time, dst, delays):
-    delay = {}
-    delay["token"] = "%02x%02x" % (token[0], token[1])
-    delay["time_gen"] = time
-    delay["dst"] = dst
-    logging.debug("[proxy] append delay: {}".format(delay))
-    delays.append(delay)
-
-
-def update_delay(token, dst, delays, test_inst_id, conn):
-    token_tmp = "%02x%02x" % (token[0], token[1])
-    for delay in delays[::-1]:
-        if delay["token"] == token_tmp and delay["dst"] == dst:
-            logging.debug("[proxy] update delay: {}".format(delay))
-            if "time_ack" not in delay:
-                delay["time_ack"] = time.time()
-                conn.execute("INSERT INTO delay (TestInstID, token, time_gen, dst, time_ack) VALUES (?, ?, ?, ?, ?)",
-                         (test_inst_id, delay["token"], delay["time_gen"], delay["dst"],
-                          delay["time_ack"]))
-                conn.commit()
-            else:
-                logging.warning("Ack has already been received. Remove duplicate")
-            break
 
 
-def get_device(deveui):
-    conn = sqlite3.connect(DB_FILE_BACKUP, timeout=60)
-    conn.row_factory = sqlite3.Row
-    device = conn.execute("SELECT * from device WHERE devEUI = (?)", (deveui,)).fetchone()
-    if device:
-        device = dict(device)
-        device['DevEui'] = reverse_eui(device['DevEui'])
-        response = conn.execute("SELECT Region from regionSKU WHERE SkuID = (?)", (device['SkuID'],)).fetchone()
-        if response:
-            region = dict(response)
-            logging.debug("region is {}".format(region))
-            device['region'] = region['Region']
-        else:
+class DelayTracker():
+    '''
+    Pending acks indexed by (token, dst), each tagged with the test it belongs to. Entries older
+    than DELAY_TTL, or pushed out once more than DELAY_MAX_PENDING are waiting, are stored as
+    timeouts (time_ack NULL).
+    '''
+    def __init__(self, writer, ttl=DELAY_TTL, max_pending=DELAY_MAX_PENDING):
+        self.writer = writer
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict()
+        self.counters = {}
+        self.latencies = {}
+        for dst in DELAY_DST:
+            self.add_dst(dst)
+
+    def add_dst(self, dst):
+        self.counters[dst] = {"sent": 0, "acked": 0, "timeout": 0, "unmatched": 0, "total": 0.0, "max": 0.0}
+        self.latencies[dst] = collections.deque(maxlen=DELAY_RING_SIZE)
+
+    def append(self, token, time_gen, dst, test_inst_id):
+        if dst not in self.counters:
+            self.add_dst(dst)
+        key = (bytes(token), dst)
+        now = time.monotonic()
+        self.expire(now)
+        if key in self.pending:
+            logging.debug("[proxy] token {} reused before ack, dst: {}".format(key[0].hex(), dst))
+            self.timeout(key, self.pending.pop(key))
+        self.pending[key] = (time_gen, now, test_inst_id)
+        self.counters[dst]["sent"] += 1
+        logging.debug("[proxy] append delay: {} {} {}".format(key[0].hex(), dst, time_gen))
+
+    def update(self, token, dst):
+        key = (bytes(token), dst)
+        entry = self.pending.pop(key, None)
+        if entry is None:
+            if dst not in self.counters:
+                self.add_dst(dst)
+            self.counters[dst]["unmatched"] += 1
+            logging.debug("[proxy] no pending delay for token {}, dst: {}".format(key[0].hex(), dst))
+            return None
+
+        time_gen, _, test_inst_id = entry
+        time_ack = time.time()
+        latency = time_ack - time_gen
+        counter = self.counters[dst]
+        counter["acked"] += 1
+        counter["total"] += latency
+        counter["max"] = max(counter["max"], latency)
+        self.latencies[dst].append(latency)
+        self.writer.execute("INSERT INTO delay (TestInstID, token, time_gen, dst, time_ack) VALUES (?, ?, ?, ?, ?)",
+                            (test_inst_id, key[0].hex(), time_gen, dst, time_ack))
+        logging.debug("[proxy] update delay: {} {} {:.6f}".format(key[0].hex(), dst, latency))
+        return time_gen
+
+    def timeout(self, key, entry):
+        time_gen, _, test_inst_id = entry
+        self.counters[key[1]]["timeout"] += 1
+        self.writer.execute("INSERT INTO delay (TestInstID, token, time_gen, dst, time_ack) VALUES (?, ?, ?, ?, ?)",
+                            (test_inst_id, key[0].hex(), time_gen, key[1], None))
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        while self.pending:
+            key, entry = next(iter(self.pending.items()))
+            if now - entry[1] < self.ttl and len(self.pending) <= self.max_pending:
+                break
+            del self.pending[key]
+            self.timeout(key, entry)
+
+    def close(self, test_inst_id=None):
+        # flush what is still waiting for the given test, or for every test
+        for key, entry in list(self.pending.items()):
+            if test_inst_id is None or entry[2] == test_inst_id:
+                del self.pending[key]
+                self.timeout(key, entry)
+        logging.info("[proxy] delay summary: {}".format(self.stats()))
+
+    def stats(self):
+        stats = {}
+        for dst, counter in self.counters.items():
+            stats[dst] = dict(counter)
+            if counter.get("acked"):
+                stats[dst]["mean"] = counter["total"] / counter["acked"]
+        return stats
+
+
+class Tracer():
+    '''
+    Hop timings of each packet, from its first receipt (gateway, NS or test controller) to the ack
+    of the next hop. A trace stores the monotonic seconds since that receipt at which the packet
+    was sent to the test controller, came back, was forwarded and was acked, NULL for the hops it
+    never reached. It is written once acked, or after DELAY_TTL.
+    '''
+    def __init__(self, writer, ttl=DELAY_TTL, max_open=DELAY_MAX_PENDING, shard=(0, 1)):
+        self.writer = writer
+        self.ttl = ttl
+        self.max_open = max_open
+        # unique across proxy restarts, and across workers in sharded mode
+        self.ids = itertools.count((int(time.time()) << 24) + shard[0], shard[1])
+        self.open = collections.OrderedDict()
+        self.waiting = {}  # (token, dst) -> trace, GWMP replies carry nothing but the token
+
+    def start(self, test_inst_id, direction, origin, time_of_arrival, start=None):
+        trace = next(self.ids)
+        self.expire()
+        self.open[trace] = {"TestInstID": test_inst_id, "time": time_of_arrival, "direction": direction,
+                            "origin": origin, "start": time.monotonic() if start is None else start,
+                            "spans": {}, "waiting": []}
+        return trace
+
+    def mark(self, trace, span):
+        record = self.open.get(trace)
+        if record is not None and span not in record["spans"]:
+            record["spans"][span] = time.monotonic() - record["start"]
+
+    def expect(self, trace, token, dst):
+        record = self.open.get(trace)
+        if record is not None:
+            key = (bytes(token), dst)
+            self.waiting[key] = trace
+            record["waiting"].append(key)
+
+    def reply(self, token, dst):
+        return self.waiting.pop((bytes(token), dst), None)
+
+    def ack(self, token, dst):
+        trace = self.reply(token, dst)
+        if trace is not None:
+            self.mark(trace, "ack")
+            self.finish(trace)
+
+    def finish(self, trace):
+        record = self.open.pop(trace, None)
+        if record is None:
+            return
+        for key in record["waiting"]:
+            if self.waiting.get(key) == trace:
+                del self.waiting[key]
+        spans = record["spans"]
+        self.writer.execute("INSERT INTO trace (TestInstID, trace, time, direction, origin, tc_tx, tc_rx, fwd, ack) "
+                            "VALUES (?,?,?,?,?,?,?,?,?)",
+                            (record["TestInstID"], trace, record["time"], record["direction"], record["origin"],
+                             spans.get("tc_tx"), spans.get("tc_rx"), spans.get("fwd"), spans.get("ack")))
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        while self.open:
+            trace, record = next(iter(self.open.items()))
+            if now - record["start"] < self.ttl and len(self.open) <= self.max_open:
+                break
+            self.finish(trace)
+
+    def close(self, test_inst_id=None):
+        for trace, record in list(self.open.items()):
+            if test_inst_id is None or record["TestInstID"] == test_inst_id:
+                self.finish(trace)
+
+
+class PacketWindow():
+    '''
+    Packets of the running test served by TC_GET_PACKET. Only the last PACKET_WINDOW_SIZE
+    stay in memory, a cursor pointing before them is served from the proxy and backup db.
+    '''
+    def __init__(self, test_inst_id, size=PACKET_WINDOW_SIZE):
+        self.test_inst_id = test_inst_id
+        self.size = size
+        self.times = []
+        self.packets = []
+        self.head = 0
+        self.truncated = False
+
+    def __len__(self):
+        return len(self.times) - self.head
+
+    def append(self, pkt):
+        self.times.append(pkt["time"])
+        self.packets.append([pkt, None])
+        if len(self) > self.size:
+            self.head += 1
+            self.truncated = True
+            if self.head >= self.size:
+                del self.times[:self.head]
+                del self.packets[:self.head]
+                self.head = 0
+
+    def fetch(self, since, limit, max_bytes):
+        records = []
+        length = 0
+        next_since = since
+
+        if self.truncated and since < self.times[self.head]:
+            for row in get_packets_from_db(self.test_inst_id, since, self.times[self.head], limit):
+                record = json.dumps(row).encode()
+                if records and length + len(record) + PACKET_RECORD_LEN.size > max_bytes:
+                    return records, next_since, True
+                records.append(record)
+                length += len(record) + PACKET_RECORD_LEN.size
+                next_since = row["time"]
+            if records:
+                return records, next_since, True
+
+        i = bisect.bisect_right(self.times, since, self.head)
+        while i < len(self.times) and len(records) < limit:
+            entry = self.packets[i]
+            if entry[1] is None:
+                entry[1] = json.dumps(entry[0], default=decoded_fields).encode()
+            if records and length + len(entry[1]) + PACKET_RECORD_LEN.size > max_bytes:
+                break
+            records.append(entry[1])
+            length += len(entry[1]) + PACKET_RECORD_LEN.size
+            next_since = self.times[i]
+            i += 1
+        return records, next_since, i < len(self.times)
+
+
+class AirtimeTracker():
+    '''
+    Uplink airtime of one device over the last window seconds, per sub-band and per channel. Each
+    frame is queued and added to running sums that the frames leaving the window are taken from,
+    so the duty cycle of the sub-band is checked as soon as a frame arrives.
+    '''
+    def __init__(self, region, window=DUTY_CYCLE_WINDOW):
+        self.bands = DUTY_CYCLE_BANDS.get(region, ())
+        self.dwell_time = DWELL_TIME.get(region)
+        self.window = window
+        self.frames = collections.deque()  # (time, band, freq, toa), oldest first
+        self.band_airtime = collections.defaultdict(float)
+        self.channel_airtime = collections.defaultdict(float)
+        self.started = None
+        self.violations = 0
+
+    def band(self, freq):
+        for name, low, high, duty_cycle in self.bands:
+            if low <= freq < high:
+                return name, duty_cycle
+        return "other", None
+
+    def expire(self, now):
+        while self.frames and self.frames[0][0] <= now - self.window:
+            _, band, freq, toa = self.frames.popleft()
+            self.band_airtime[band] -= toa
+            self.channel_airtime[freq] -= toa
+        if not self.frames:  # no rounding error left behind
+            self.band_airtime.clear()
+            self.channel_airtime.clear()
+
+    def add(self, now, freq, toa):
+        # the violations of the frame, as (kind, band, airtime, allowed airtime)
+        if self.started is None:
+            self.started = now - toa  # frames are added once received
+        self.expire(now)
+        band, duty_cycle = self.band(freq)
+        self.frames.append((now, band, freq, toa))
+        self.band_airtime[band] += toa
+        self.channel_airtime[freq] += toa
+
+        violations = []
+        if duty_cycle is not None and self.band_airtime[band] > duty_cycle * self.window:
+            violations.append(("duty_cycle", band, self.band_airtime[band], duty_cycle * self.window))
+        if self.dwell_time is not None and toa > self.dwell_time:
+            violations.append(("dwell_time", band, toa, self.dwell_time))
+        self.violations += len(violations)
+        return violations
+
+    def summary(self, now):
+        self.expire(now)
+        span = min(now - self.started, self.window) if self.started is not None else 0
+        duty_cycles = {name: duty_cycle for name, _, _, duty_cycle in self.bands}
+        return {"window": self.window, "span": span, "frames": len(self.frames), "violations": self.violations,
+                "bands": {band: {"airtime": airtime, "duty_cycle": airtime / self.window,
+                                 "limit": duty_cycles.get(band)}
+                          for band, airtime in self.band_airtime.items()},
+                "channels": {"{:g}".format(freq): {"airtime": airtime, "occupancy": airtime / span if span else 0}
+                             for freq, airtime in self.channel_airtime.items()}}
+
+
+class GatewayTable():
+    '''
+    Packet forwarders connected to the proxy, keyed by the gateway EUI of their frames.
+    Downlinks for a device go to the gateway that heard its last uplink with the best rssi.
+    '''
+    def __init__(self):
+        self.gateways = {}
+        self.best = {}
+        self.last_pull = None
+
+    def seen(self, gw, msg, addr):
+        entry = self.gateways.get(gw)
+        if entry is None:
+            logging.info("[proxy] gateway {} connected from {}".format(gw, addr))
+            entry = {"addr_push": (), "addr_pull": (), "last_seen": 0.0,
+                     "push_data": 0, "pull_data": 0, "tx_ack": 0, "rxpk": 0, "txpk": 0}
+            self.gateways[gw] = entry
+        entry["last_seen"] = time.time()
+        entry[msg] += 1
+        if msg == "push_data":
+            entry["addr_push"] = addr
+        else:  # PULL_DATA and TX_ACK come from the downstream socket of the forwarder
+            entry["addr_pull"] = addr
+            if msg == "pull_data":
+                self.last_pull = gw
+
+    def heard(self, deveui, receptions):
+        for gw, *_ in receptions:
+            if gw in self.gateways:
+                self.gateways[gw]["rxpk"] += 1
+        if deveui:
+            self.best[deveui] = [reception[0] for reception in receptions]
+
+    def route(self, deveui=None):
+        for gw in self.best.get(deveui, []) + [self.last_pull]:
+            entry = self.gateways.get(gw)
+            if entry and entry["addr_pull"]:
+                entry["txpk"] += 1
+                return gw, entry["addr_pull"]
+        return None, None
+
+    def stats(self):
+        return {gw: dict(entry) for gw, entry in self.gateways.items()}
+
+
+def get_packets_from_db(test_inst_id, since, until, limit):
+    # rows move from the proxy db to the backup db every DB_BACKUP_INTERVAL, so look in both
+    packets = {}
+    for db_file in [DB_FILE_PROXY, DB_FILE_BACKUP]:
+        conn = sqlite3.connect(db_file, timeout=60)
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute("SELECT * FROM packet WHERE TestInstID = (?) AND time > (?) AND time < (?) "
+                            "ORDER BY time LIMIT (?)", (test_inst_id, since, until, limit)).fetchall()
+        conn.close()
+        for row in rows:
+            pkt = dict(row)
+            if pkt["json"]:
+                pkt["json"] = json.loads(pkt["json"])
+            packets[pkt["time"]] = pkt
+    return [packets[t] for t in sorted(packets)[:limit]]
+
+
+class DeviceCache():
+    '''
+    The device table of the backup database with the region of each SkuID, by DevEui as sent over the air.
+    Read again at the first lookup after the web interface reports a change (WB_DEVICE_UPDATE).
+    '''
+    def __init__(self, db_file=DB_FILE_BACKUP):
+        self.db_file = db_file
+        self.devices = None
+
+    def invalidate(self):
+        self.devices = None
+
+    def load(self):
+        conn = sqlite3.connect(self.db_file, timeout=60)
+        conn.row_factory = sqlite3.Row
+        regions = {row['SkuID']: row['Region'] for row in conn.execute("SELECT SkuID, Region from regionSKU")}
+        self.devices = {}
+        for row in conn.execute("SELECT * from device"):
+            device = dict(row)
+            device['DevEui'] = reverse_eui(device['DevEui'])
+            if device['SkuID'] in regions:
+                device['region'] = regions[device['SkuID']]
+            self.devices[device['DevEui']] = device
+        conn.close()
+        logging.debug("[proxy] {} devices loaded".format(len(self.devices)))
+
+    def lookup(self, deveui):
+        # DevEui as sent over the air, the device may have no region
+        if self.devices is None:
+            self.load()
+        return self.devices.get(deveui)
+
+    def get_device(self, deveui):
+        # DevEui as stored in the database, a copy the test can keep
+        device = self.lookup(reverse_eui(deveui))
+        if device is None:
+            logging.error("Cannot find information for device: {}".format(deveui))
+        elif 'region' not in device:
             device = None
             logging.error("Cannot find region information for device: {}".format(deveui))
-    else:
-        logging.error("Cannot find information for device: {}".format(deveui))
-    conn.close()
-    return device
-
-
-def run_proxy():
-    create_db_tables_proxy()
-    recover_db_proxy()
-
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.settimeout(deduplication_threshold/10)
-
-    sock.bind(("", addr_pf[1]))
-
-    addr_push = ()
-    addr_pull = ()
-
-    gw_mac_tmp = ''
-
-    conn = sqlite3.connect(DB_FILE_PROXY, timeout=60)
-    conn.row_factory = sqlite3.Row
-
-    packets = []
-    delays = []
-    is_test_running = False
-    test_inst_id = 0
-    logging.debug("proxy successfully started")
-    t = 0
-    codec = Codec(conn, test_inst_id)
-
-    while True:
-
-        to_be_removed = []
-        for pl in buffer:
-            pkt = buffer[pl]["pkt"]
-            if time.time() - buffer[pl]["time"] > deduplication_threshold:
-                to_be_removed.append(pl)
-
-                pkt["json"] = codec.decode_uplink(pkt)
-                logging.info("Received from GW")
-                for line in json.dumps(pkt, indent=4, sort_keys=True).split("\n"):
-                    logging.info(line)
-
-                if "error" in pkt["json"]:
-                    continue
-
-                pkt["time"] = time.time()
-                pkt["direction"] = "up"
-                byte_data = bytes([2, random.randint(0, 255), random.randint(0, 255), 6]) + \
-                            json.dumps({"rxpk": pkt}).encode()
-                sock.sendto(byte_data, addr_tc)
-
-                pkt["stat"] = 0
-                token = list(byte_data[1:3])
-                if is_test_running:
-                    append_packet(pkt, packets, test_inst_id, conn)
-                    append_delay(token, buffer[pl]["time"], "tc", delays)
-
-        for pl in to_be_removed:
-            del buffer[pl]
-
-        try:
-            byte_data, addr = sock.recvfrom(10240)
-        except socket.timeout:
-            continue
-        except ConnectionResetError:
-            logging.error("ConnectionResetError, check test controller")
-            continue
-
-        time_of_arrival = time.time()
-        msg_type = list(byte_data)[3]
-        logging.debug("received data: {}, msg_type:{}".format(list(byte_data)[0:5],
-                                                              msg_type))
-        if msg_type in [PROC_MSG["TC_DATA"]]:
-            logging.info(str(msg_type) + " controller -> proxy")
-        elif msg_type in [PROC_MSG["GW_PUSH_DATA"], PROC_MSG["GW_PULL_DATA"], PROC_MSG["GW_TX_ACK"]]:
-            logging.debug(str(msg_type) + " Packetforwarder -> proxy")
-        elif msg_type in [PROC_MSG["NS_PUSH_ACK"], PROC_MSG["NS_PULL_RSP"], PROC_MSG["NS_PULL_ACK"]]:
-            logging.debug(str(msg_type) + " NS -> proxy")
-        elif msg_type == PROC_MSG["TC_SETUP_TEST"]:
-            is_test_running = True
-            test_instance = json.loads(byte_data[4:].decode())
-            device = get_device(test_instance["DevEui"])
-            test_inst_id = test_instance["TestInstID"]
-            logging.debug("start new test, device is: {}".format(device))
-            codec = Codec(conn, test_inst_id, device)
-            packets = []
-            delays = []
-            continue
-        elif msg_type == PROC_MSG["TC_GET_PACKET"]:
-            byte_data = json.dumps(packets).encode()
-            logging.debug("[proxy] packets length is:{}, dst addr is:{}".format(len(byte_data), addr))
-            sock.sendto(byte_data, addr)
-            continue
-        elif msg_type == PROC_MSG["TC_TEARDOWN_TEST"]:
-            logging.debug("[proxy] sent stop response")
-            is_test_running = False
-            packets = []
-            delays = []
-            continue
-
-        if msg_type == 0:  # PUSH_DATA from the gateway, uplink packets
-            original_token = byte_data[1:3]
-
-            addr_push = addr
-            gw_mac_tmp = byte_data[4:12]
-
-            json_data = json.loads(byte_data[12:].decode())
-
-            if 'rxpk' in json_data:
-                logging.info("rx packet received from gateway at {}".format(time.time()))
-                for pkt in json_data['rxpk']:
-                    if pkt["data"] not in buffer:
-                        buffer[pkt["data"]] = {"pkt": pkt, "time": time_of_arrival}
-                    else:
-                        logging.info("duplicate packet received. ")
-                        if int(pkt["rssi"]) > int(buffer[pkt["data"]]["pkt"]["rssi"]):
-                            buffer[pkt["data"]]["pkt"] = pkt
+        return dict(device) if device else None
+
+
+def log_packet(title, pkt):
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        return
+    logging.info(title)
+    for line in json.dumps(pkt, indent=4, sort_keys=True, default=decoded_fields).split("\n"):
+        logging.info(line)
+
+
+class TestBinding():
+    '''
+    One device under test: its codec, packet window and capture, and where its test controller listens.
+    '''
+    def __init__(self, test_inst_id, device, conn, addr, sessions=None):
+        self.test_inst_id = test_inst_id
+        self.device = device
+        self.deveui = device["DevEui"].lower() if device else None
+        self.devaddr = None
+        self.addr_tc = addr
+        self.codec = Codec(conn, test_inst_id, device, sessions)
+        self.packets = PacketWindow(test_inst_id)
+        self.airtime = AirtimeTracker(device.get("region") if device else None)
+        self.capture = None
+        self.setup = {"TestInstID": test_inst_id}  # the TC_SETUP_TEST request, to restore the test
+        self.ipc_binary = False  # TC_DATA as binary frames instead of json
+        self.ipc_decoded = True  # TC_DATA carries the decoded fields
+        self.uplinks = {}
+        self.slacks = collections.deque(maxlen=DELAY_RING_SIZE)
+        self.downlinks = {"timed": 0, "late": 0, "min_slack": None}
+
+    def record_slack(self, slack, late):
+        self.slacks.append(slack)
+        self.downlinks["timed"] += 1
+        self.downlinks["late"] += late
+        if self.downlinks["min_slack"] is None or slack < self.downlinks["min_slack"]:
+            self.downlinks["min_slack"] = slack
+
+    def slack_summary(self):
+        summary = dict(self.downlinks)
+        if self.slacks:
+            summary["median_slack"] = sorted(self.slacks)[len(self.slacks) // 2]
+        return summary
+
+    def awaiting_join_accept(self):
+        return 'DevNonce' in self.codec.session and 'JoinNonce' not in self.codec.session
+
+    def owns_frame(self, data):
+        # like ProxyContext.is_dut for this device alone, in either direction
+        phy_payload = base64.b64decode(data[:PHY_HEADER_B64])
+        if not phy_payload:
+            return False
+        m_type = phy_payload[0] >> 5
+        if m_type == 0:
+            return phy_payload[9:17].hex() == self.deveui
+        if m_type == 1:
+            return self.awaiting_join_accept() and self.codec.check_join_accept({"data": data})
+        return phy_payload[1:5].hex() == self.devaddr
+
+    def checkpoint(self):
+        return {"setup": self.setup, "addr_tc": self.addr_tc, "session": self.codec.session}
+
+
+class ProxyContext():
+    def __init__(self, sock, conn, writer, shard=(0, 1)):
+        self.sock = sock
+        self.shard = shard  # (index, count) of this worker in sharded mode
+        self.conn = conn
+        self.writer = writer
+        self.buffer = {}
+        self.deadlines = []
+        self.gateways = GatewayTable()
+        self.tests = {}
+        self.by_deveui = {}
+        self.by_devaddr = {}
+        self.delays = DelayTracker(writer)
+        self.tracer = Tracer(writer, shard=shard)
+        self.codec = Codec(conn, 0)  # frames of devices that are not under test fail to decode with it
+        self.sessions = SessionStore(conn)
+        self.devices = DeviceCache()
+        self.kernel_drops = 0
+        self.decoded = collections.OrderedDict()  # token -> decoded fields not sent to the test controller
+        self.local_addr = sock.getsockname()
+        self.stats = ProxyStats({msg_type: name for name, msg_type in PROC_MSG.items()})
+        self.stats_deadline = time.monotonic() + STATS_INTERVAL
+        self.stats_file = STATS_FILE_PROXY
+        self.context_file = context_file(shard)
+        self.checkpoint_deadline = 0
+        self.checkpointed = None  # the last checkpoint written
+
+    def setup_test(self, test_instance, addr):
+        test_inst_id = test_instance["TestInstID"]
+        device = self.devices.get_device(test_instance["DevEui"])
+        logging.debug("start new test {}, device is: {}".format(test_inst_id, device))
+        binding = TestBinding(test_inst_id, device, self.conn, addr, self.sessions)
+        binding.setup = test_instance
+        self.teardown_test(test_inst_id)
+        if binding.deveui in self.by_deveui:
+            self.teardown_test(self.by_deveui[binding.deveui].test_inst_id)
+
+        self.tests[test_inst_id] = binding
+        if binding.deveui:
+            self.by_deveui[binding.deveui] = binding
+        if test_instance.get("pcap"):
+            binding.capture = PcapCapture(test_inst_id)
+        binding.ipc_binary = int(test_instance.get("ipc", 0)) >= TC_FRAME_VERSION
+        binding.ipc_decoded = bool(test_instance.get("decoded", True))
+        self.checkpoint_deadline = 0
+
+    def teardown_test(self, test_inst_id):
+        binding = self.tests.pop(test_inst_id, None)
+        if binding is None:
+            return
+        logging.debug("[proxy] stop test {}".format(test_inst_id))
+        self.checkpoint_deadline = 0
+        if self.by_deveui.get(binding.deveui) is binding:
+            del self.by_deveui[binding.deveui]
+        if self.by_devaddr.get(binding.devaddr) is binding:
+            del self.by_devaddr[binding.devaddr]
+        self.sessions.close(binding.codec.session)
+        self.delays.close(test_inst_id)
+        self.tracer.close(test_inst_id)
+        self.writer.flush()  # the test controller reads the rows of the test once it is stopped
+        logging.info("[proxy] test {} downlink slack: {}".format(test_inst_id, binding.slack_summary()))
+        if binding.capture:
+            binding.capture.close()
+
+    def close(self):
+        for test_inst_id in list(self.tests):
+            self.teardown_test(test_inst_id)
+        self.sessions.flush(force=True)
+        self.delays.close()
+        self.tracer.close()
+        self.writer.flush()
+
+    def current_test(self):
+        # frames that belong to no device (keepalives, stats) are accounted to the latest test
+        return next(reversed(self.tests.values()), None)
+
+    def bind_devaddr(self, binding):
+        devaddr = binding.codec.session.get("DevAddr")
+        if not devaddr or devaddr.lower() == binding.devaddr:
+            return
+        if self.by_devaddr.get(binding.devaddr) is binding:
+            del self.by_devaddr[binding.devaddr]
+        binding.devaddr = devaddr.lower()
+        self.by_devaddr[binding.devaddr] = binding
+        self.checkpoint_deadline = 0  # new session keys, do not wait to save them
+
+    def is_dut(self, data, downlink=False):
+        # only the head of the PHYPayload is decoded, enough for MType, DevAddr and DevEui
+        phy_payload = base64.b64decode(data[:PHY_HEADER_B64])
+        if not phy_payload:
+            return False
+        m_type = phy_payload[0] >> 5
+        if m_type == 0:
+            return not downlink and phy_payload[9:17].hex() in self.by_deveui
+        if m_type == 1:
+            return downlink and self.join_accept_binding({"data": data}) is not None
+        if m_type in (2, 4):
+            return not downlink and phy_payload[1:5].hex() in self.by_devaddr
+        if m_type in (3, 5):
+            return downlink and phy_payload[1:5].hex() in self.by_devaddr
+        return False
+
+    def lookup_uplink(self, pkt):
+        phy_payload = base64.b64decode(pkt["data"])
+        if not phy_payload:
+            return None
+        if phy_payload[0] >> 5 == 0:  # join request, DevEui as sent over the air
+            return self.by_deveui.get(phy_payload[9:17].hex())
+        return self.by_devaddr.get(phy_payload[1:5].hex())
+
+    def join_accept_binding(self, pkt):
+        # the join accept is encrypted, only a device waiting for one whose NwkKey checks the MIC owns it
+        for binding in self.tests.values():
+            if binding.awaiting_join_accept() and binding.codec.check_join_accept(pkt):
+                return binding
+        return None
+
+    def lookup_downlink(self, pkt):
+        phy_payload = base64.b64decode(pkt["data"])
+        if not phy_payload:
+            return None
+        if phy_payload[0] >> 5 != 1:
+            return self.by_devaddr.get(phy_payload[1:5].hex())
+
+        return self.join_accept_binding(pkt)
+
+    def check_join(self, data):
+        # a join request that no test waits for, from a provisioned device whose key checks its MIC
+        mhdr = base64.b64decode(data[:4])
+        if not mhdr or mhdr[0] >> 5 != 0:
+            return
+        phy_payload = base64.b64decode(data)
+        if len(phy_payload) != JOIN_REQUEST_SIZE:
+            return
+        device = self.devices.lookup(phy_payload[9:17].hex())
+        if device is None or not device.get('NwkKey'):
+            return
+        if cmac_bytes(bytes.fromhex(device['NwkKey']), phy_payload[:-4]) == phy_payload[-4:]:
+            self.stats.count("unsolicited_joins")
+            logging.warning("[proxy] join request of device {}, no test is running for it".format(
+                reverse_eui(device['DevEui'])))
+
+    def lookup_tc(self, pkt):
+        binding = self.by_deveui.get((pkt.get("json") or {}).get("DevEui"))
+        if binding is None and len(self.tests) == 1:
+            binding = self.current_test()
+        return binding
+
+    def buffer_uplink(self, pkt, gw, time_of_arrival):
+        # every gateway that heard the frame is kept, the copy with the best rssi is forwarded
+        reception = (gw, pkt.get("rssi"), pkt.get("lsnr"), pkt.get("tmst"), pkt.get("chan"))
+        if pkt["data"] not in self.buffer:
+            self.buffer[pkt["data"]] = {"pkt": pkt, "time": time_of_arrival, "start": time.monotonic(),
+                                        "receptions": [reception],
+                                        "arrivals": {gw: (pkt.get("tmst"), time_of_arrival)}}
+            heapq.heappush(self.deadlines, (time.monotonic() + get_dedup_window(pkt), pkt["data"]))
+        else:
+            logging.info("duplicate packet received from gateway {}".format(gw))
+            self.stats.count("dedup_merges")
+            entry = self.buffer[pkt["data"]]
+            entry["receptions"].append(reception)
+            entry["arrivals"][gw] = (pkt.get("tmst"), time_of_arrival)
+            if int(pkt["rssi"]) > int(entry["pkt"]["rssi"]):
+                entry["pkt"] = pkt
+
+    def send(self, byte_data, addr, binding=None):
+        # byte_data is a datagram or the buffers of lib_gwmp.rewrite, binding the test it is sent for if known
+        send_frame(self.sock, byte_data, addr)
+        self.capture(byte_data, self.local_addr, addr, binding)
+
+    def new_token(self):
+        # in sharded mode the receiver hands the replies to a token to the worker that picked it
+        index, count = self.shard
+        return random.randrange(index, 0x10000, count).to_bytes(2, "big")
+
+    def send_tc(self, binding, kind, pkt):
+        header = bytes([2]) + self.new_token() + bytes([PROC_MSG["TC_DATA"]])
+        if not binding.ipc_decoded:
+            self.decoded[header[1:3]] = pkt["json"]
+            if len(self.decoded) > DELAY_MAX_PENDING:
+                self.decoded.popitem(last=False)
+        self.send(pack_tc_data(header, kind, pkt, binding.ipc_binary, binding.ipc_decoded), binding.addr_tc, binding)
+        self.tracer.mark(pkt["trace"], "tc_tx")
+        self.tracer.expect(pkt["trace"], header[1:3], "tc")
+        return list(header[1:3])
+
+    def restore_decoded(self, token, pkt):
+        '''
+        Put back the decoded fields of a packet the test controller got without them.
+        '''
+        if pkt and "json" not in pkt:
+            decoded = self.decoded.pop(bytes(token), None)
+            if isinstance(decoded, DataFrame) and pkt.get("size", 0) < 0:
+                decoded = decoded.fields()  # the frame is encoded again from them
+            pkt["json"] = decoded
+
+    def trace_reply(self, token, pkt, binding, direction):
+        '''
+        Trace of a packet back from the test controller, a new one when the test controller made it up.
+        '''
+        trace = self.tracer.reply(token, "tc")
+        if pkt.get("trace") is not None:
+            trace = pkt["trace"]
+        elif trace is None and binding:
+            trace = pkt["trace"] = self.tracer.start(binding.test_inst_id, direction, "tc", time.time())
+        self.tracer.mark(trace, "tc_rx")
+        return trace
+
+    def capture(self, byte_data, src, dst, binding=None):
+        # a test captures its test controller traffic and the frames of its device, the datagrams
+        # without a frame (acks, keepalives, gateway stats) go to every capture
+        if binding:
+            tests = [binding] if binding.capture else []
+        else:
+            tests = [test for test in self.tests.values() if test.capture]
+        if not tests:
+            return
+        byte_data = join(byte_data)
+        if not binding:
+            addrs_tc = {test.addr_tc for test in self.tests.values()}
+            if src in addrs_tc or dst in addrs_tc:
+                tests = [test for test in tests if test.addr_tc in (src, dst)]
             else:
-                byte_data = byte_data[0:4] + gw_mac + byte_data[12:]
-                sock.sendto(byte_data, addr_ns)
-
-                token = list(original_token)
-                if is_test_running:
-                    append_delay(token, time.time(), "ns", delays)
-
-            byte_data = bytes([2]) + original_token + bytes([1])
-            sock.sendto(byte_data, addr_push)
-
-            continue
-
-        if msg_type == 1:  # PUSH_ACK from the ns
-            if is_test_running:
-                update_delay(token, "ns", delays, test_inst_id, conn)
-
-            continue
-
-        if msg_type == 2:  # PULL_DATA from the gateway
-            gw_mac_tmp = byte_data[4:12]
-            addr_pull = addr
-
-            byte_data = byte_data[0:4] + gw_mac + byte_data[12:]
+                fields = DATA_FIELD.findall(byte_data, 4)
+                tests = [test for test in tests if not fields or any(test.owns_frame(field) for field in fields)]
+        for test in tests:
+            test.capture.capture(byte_data, src, dst)
+
+    def time_downlink(self, binding, gw, pkt, time_ns):
+        # slack is what was left of the RX window, on the host clock, once the gateway was handed the downlink:
+        # arrival of the uplink from that gateway plus the tmst difference, minus the time of sending
+        uplink = binding.uplinks.get(gw)
+        if pkt.get("imme") or not isinstance(pkt.get("tmst"), int) or uplink is None or uplink[0] is None:
+            return
+        tmst_up, time_up = uplink
+        rx_delay = ((pkt["tmst"] - tmst_up) & 0xffffffff) / 1e6
+        if rx_delay > DOWNLINK_MAX_RX_DELAY:
+            return
+        slack = time_up + rx_delay - pkt["time"]
+        late = slack < DOWNLINK_MIN_LEAD
+        path = pkt["time"] - time_ns if time_ns else None
+        binding.record_slack(slack, late)
+        self.stats.count("late_downlinks" if late else "timely_downlinks")
+        if late:
+            logging.warning("[proxy] downlink to {} sent {:.1f} ms before its RX window".format(gw, slack * 1000))
+        self.writer.execute("INSERT INTO downlink (TestInstID, time, gw, tmst_up, tmst_down, rx_delay, path, slack, late) "
+                            "VALUES (?,?,?,?,?,?,?,?,?)",
+                            (binding.test_inst_id, pkt["time"], gw, tmst_up, pkt["tmst"], rx_delay, path, slack, late))
+
+    def record_airtime(self, binding, pkt):
+        try:
+            toa = get_toa(pkt["size"], pkt["datr"])
+            freq = float(pkt["freq"])
+        except (KeyError, ValueError, IndexError, TypeError, AttributeError):  # FSK datr is a bit rate
+            return
+        for kind, band, airtime, allowed in binding.airtime.add(pkt["time"], freq, toa):
+            self.stats.count("duty_cycle_violations")
+            logging.warning("[proxy] test {} {} exceeded in sub-band {}: {:.3f} s of airtime, {:.3f} s allowed".format(
+                binding.test_inst_id, kind, band, airtime, allowed))
+            self.writer.execute("INSERT INTO dutycycle (TestInstID, time, kind, band, freq, toa, airtime, allowed) "
+                                "VALUES (?,?,?,?,?,?,?,?)",
+                                (binding.test_inst_id, pkt["time"], kind, band, freq, toa, airtime, allowed))
+
+    def next_timeout(self):
+        deadline = min(self.stats_deadline, self.checkpoint_deadline, self.sessions.next_deadline())
+        if self.deadlines:
+            deadline = min(deadline, self.deadlines[0][0])
+        return max(deadline - time.monotonic(), 0)
+
+    def tick(self):
+        # the work that fell due, run after each wake up of the proxy loop
+        self.flush_uplinks()
+        self.delays.expire()
+        self.tracer.expire()
+        self.sessions.flush()
+        self.write_stats()
+        self.checkpoint()
+
+    def flush_uplinks(self):
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, pl = heapq.heappop(self.deadlines)
+            forward_uplink(self.buffer.pop(pl), self)
+
+    def stats_snapshot(self):
+        gauges = {"dedup_buffer": len(self.buffer),
+                  "pending_acks": len(self.delays.pending),
+                  "open_traces": len(self.tracer.open),
+                  "db_queue": self.writer.depth(),
+                  "db_dropped": self.writer.dropped,
+                  "kernel_drops": self.kernel_drops,
+                  "pcap_queue": sum(binding.capture.queue.qsize() for binding in self.tests.values() if binding.capture),
+                  "tests": len(self.tests),
+                  "gateways": len(self.gateways.gateways)}
+        return self.stats.snapshot(gauges)
+
+    def write_stats(self):
+        if time.monotonic() < self.stats_deadline:
+            return
+        self.stats_deadline = time.monotonic() + STATS_INTERVAL
+        if self.stats_file is None:  # a worker, the receiver writes the stats of every worker
+            return
+        try:
+            write_prometheus(self.stats_snapshot(), self.stats_file)
+        except OSError as e:
+            logging.error("[proxy] cannot write stats: {}".format(e))
+
+    def checkpoint(self):
+        # the tests and sessions as json, replaced at once so a crash leaves the previous checkpoint
+        if time.monotonic() < self.checkpoint_deadline:
+            return
+        self.checkpoint_deadline = time.monotonic() + PROXY_CHECKPOINT_INTERVAL
+        state = json.dumps({"tests": [binding.checkpoint() for binding in self.tests.values()]})
+        if state == self.checkpointed:
+            return
+        tmp_file = self.context_file + ".tmp"
+        try:
+            with open(tmp_file, "w") as js:
+                js.write(state)
+            os.replace(tmp_file, self.context_file)
+        except OSError as e:
+            logging.error("[proxy] cannot write checkpoint: {}".format(e))
+            return
+        self.checkpointed = state
+
+    def restore(self, checkpoints):
+        index, count = self.shard
+        for checkpoint in checkpoints:
+            setup = checkpoint["setup"]
+            if count > 1 and shard_of(reverse_eui(setup.get("DevEui", "")), count) != index:
+                continue  # a device of another worker
+            self.setup_test(setup, tuple(checkpoint["addr_tc"]))
+            binding = self.tests[setup["TestInstID"]]
+            if checkpoint["session"]:
+                binding.codec.session = checkpoint["session"]
+                binding.codec.sessions.append(binding.codec.session)
+                if binding.codec.session.get("DevAddr"):
+                    self.sessions.changed(binding.codec.session)
+                self.bind_devaddr(binding)
+            logging.info("[proxy] test {} restored, DevAddr {} FCntUp {}".format(
+                binding.test_inst_id, binding.devaddr, binding.codec.session.get("FCntUp")))
+
+    def shard_state(self):
+        # what the receiver needs to send the next frames of these devices here
+        return (frozenset(self.by_devaddr),
+                any(binding.awaiting_join_accept() for binding in self.tests.values()))
+
+    def claims_join_accept(self, byte_data):
+        # the workers waiting for a join accept are asked, only the one with the device that checks the MIC takes it
+        pkt = json.loads(byte_data[4:].decode()).get("txpk") or {}
+        return "data" in pkt and self.join_accept_binding(pkt) is not None
+
+
+def shard_of(key, count):
+    # worker of a DevEui or DevAddr in sharded mode
+    return zlib.crc32(bytes.fromhex(key)) % count
+
+
+def context_file(shard):
+    index, count = shard
+    if count == 1:
+        return FILE_PROXY_CONTEXT
+    root, ext = os.path.splitext(FILE_PROXY_CONTEXT)
+    return "{}.{}{}".format(root, index, ext)
+
+
+def checkpoint_files():
+    root, ext = os.path.splitext(FILE_PROXY_CONTEXT)
+    return [file for file in [FILE_PROXY_CONTEXT] + glob.glob(glob.escape(root) + ".*" + ext) if os.path.exists(file)]
+
+
+def remove_checkpoints():
+    for file in checkpoint_files():
+        os.remove(file)
+
+
+def load_checkpoints(count):
+    '''
+    Tests checkpointed before the proxy restarted, with or without workers. The files that the
+    count workers of this run do not rewrite are removed once read.
+    '''
+    kept = {context_file((index, count)) for index in range(count)}
+    tests = collections.OrderedDict()
+    for file in sorted(checkpoint_files(), key=os.path.getmtime):
+        try:
+            with open(file) as js:
+                for checkpoint in json.load(js)["tests"]:
+                    tests[checkpoint["setup"]["TestInstID"]] = checkpoint
+        except (OSError, ValueError, KeyError) as e:
+            logging.error("[proxy] cannot read checkpoint {}: {}".format(file, e))
+        if file not in kept:
+            os.remove(file)
+    return list(tests.values())
+
+
+class DatagramReader():
+    '''
+    Reads the datagrams of the proxy socket, and counts those the kernel dropped on a full receive
+    buffer when it reports them.
+    '''
+    def __init__(self, sock, ancbufsize):
+        self.sock = sock
+        self.ancbufsize = ancbufsize
+        self.kernel_drops = 0
+
+    def drain(self):
+        # everything the kernel has queued, read before sleeping again
+        while True:
+            try:
+                if self.ancbufsize:
+                    byte_data, ancdata, _, addr = self.sock.recvmsg(RECV_BUFSIZE, self.ancbufsize)
+                    self.update_kernel_drops(ancdata)
+                else:
+                    byte_data, addr = self.sock.recvfrom(RECV_BUFSIZE)
+            except BlockingIOError:
+                return
+            except ConnectionResetError:
+                logging.error("ConnectionResetError, check test controller")
+                continue
 
-            sock.sendto(byte_data, addr_ns)
-            token = list(byte_data[1:3])
-            if is_test_running:
-                append_delay(token, time.time(), "ns", delays)
+            if len(byte_data) < 4:
+                logging.error("[proxy] datagram too short from {}".format(addr))
+                continue
+            yield byte_data, addr
 
-            byte_data = list(byte_data[:4])
-            byte_data[3] = 4
-            byte_data = bytes(byte_data)
+    def update_kernel_drops(self, ancdata):
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(data) >= 4:
+                drops = struct.unpack("=I", data[:4])[0]
+                if drops != self.kernel_drops:
+                    logging.warning("[proxy] kernel dropped {} datagram(s), {} in total".format(
+                        (drops - self.kernel_drops) & 0xffffffff, drops))
+                    self.kernel_drops = drops
 
-            byte_data = byte_data[0:4]
-            sock.sendto(byte_data, addr_pull)
 
+def open_proxy_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for option in (getattr(socket, "SO_RCVBUFFORCE", None), socket.SO_RCVBUF):
+        if option is None:
             continue
-
-        if msg_type == 4: # PULL_ACK from the ns
-            if is_test_running:
-                update_delay(token, "ns", delays, test_inst_id, conn)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, PROXY_RCVBUF)
+            break
+        except OSError:
             continue
+    logging.debug("[proxy] receive buffer is {} bytes".format(
+        sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)))
 
-        if msg_type == 3:  # PULL_RSP from the ns, downlink packets
-            original_token = byte_data[1:3]
-
-            json_data = json.loads(byte_data[4:].decode())
-            if 'txpk' in json_data:
-                pkt = json_data['txpk']
-                pkt["json"] = codec.decode_downlink(pkt)
-                logging.info("Received from NS")
-                for line in json.dumps(pkt, indent=4, sort_keys=True).split("\n"):
-                    logging.info(line)
+    ancbufsize = 0
+    if sys.platform.startswith("linux"):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            ancbufsize = socket.CMSG_SPACE(4)
+        except OSError:
+            logging.warning("[proxy] SO_RXQ_OVFL not supported, kernel drops are not counted")
 
-                if "error" in pkt["json"]:
-                    continue
+    sock.setblocking(False)
+    sock.bind(("", addr_pf[1]))
+    return sock, ancbufsize
+
+
+def get_dedup_window(pkt):
+    # the window grows with the frame time on air, never below the configured threshold, and is
+    # capped so that the test controller still has time to answer before RX1
+    try:
+        toa = get_toa(pkt["size"], pkt["datr"])
+    except (KeyError, ValueError, IndexError, TypeError, AttributeError):  # FSK datr is a bit rate
+        return deduplication_threshold
+    return max(deduplication_threshold, min(DEDUP_GUARD + DEDUP_TOA_RATIO * toa, DEDUP_MAX_WINDOW))
+
+
+def append_receptions(pkt, receptions, test_inst_id, writer):
+    for gw, rssi, lsnr, tmst, chan in receptions:
+        writer.execute("INSERT INTO reception (TestInstID, time, gw, tmst, chan, rssi, lsnr) VALUES (?,?,?,?,?,?,?)",
+                       (test_inst_id, pkt["time"], gw, tmst, chan, rssi, lsnr))
+
+
+def forward_uplink(entry, px):
+    pkt = entry["pkt"]
+    binding = px.lookup_uplink(pkt)
+    # the fields of a packet the test controller gets without them are read when it is stored
+    lazy = binding is not None and not binding.ipc_decoded
+    pkt["json"] = (binding.codec if binding else px.codec).decode_uplink(pkt, lazy)
+    log_packet("Received from GW", pkt)
+
+    if "error" in pkt["json"]:
+        px.stats.count("decode_errors")
+        return
+
+    receptions = sorted(entry["receptions"], key=lambda reception: reception[1], reverse=True)
+    binding.uplinks = entry["arrivals"]
+    px.gateways.heard(pkt["json"].get("DevEui"), receptions)
+    pkt["receptions"] = [{"gw": gw, "rssi": rssi, "lsnr": lsnr, "tmst": tmst, "chan": chan}
+                         for gw, rssi, lsnr, tmst, chan in receptions]
+    pkt["time"] = time.time()
+    pkt["direction"] = "up"
+    px.record_airtime(binding, pkt)
+    pkt["trace"] = px.tracer.start(binding.test_inst_id, "up", "gw", entry["time"], entry["start"])
+    token = px.send_tc(binding, "rxpk", pkt)
+    px.stats.observe("gw_tc", time.time() - entry["time"])
+
+    pkt["stat"] = 0
+    append_packet(pkt, binding.packets, binding.test_inst_id, px.writer)
+    append_receptions(pkt, receptions, binding.test_inst_id, px.writer)
+    px.delays.append(token, entry["time"], "tc", binding.test_inst_id)
+
+
+def process_proxy_msg(byte_data, addr, time_of_arrival, px, ack=True):
+    # ack is False for the parts of a PUSH_DATA split between workers but the first, the gateway gets one ack
+    _, original_token, msg_type = parse_header(byte_data)
+    px.stats.datagrams[msg_type] += 1
+    logging.debug("received data: %s, msg_type:%s", byte_data[0:5].hex(), msg_type)
+
+    if msg_type == PROC_MSG["TC_DATA"]:
+        logging.info(str(msg_type) + " controller -> proxy")
+    elif msg_type in [PROC_MSG["GW_PUSH_DATA"], PROC_MSG["GW_PULL_DATA"], PROC_MSG["GW_TX_ACK"]]:
+        logging.debug(str(msg_type) + " Packetforwarder -> proxy")
+    elif msg_type in [PROC_MSG["NS_PUSH_ACK"], PROC_MSG["NS_PULL_RSP"], PROC_MSG["NS_PULL_ACK"]]:
+        logging.debug(str(msg_type) + " NS -> proxy")
+
+    if msg_type == PROC_MSG["TC_SETUP_TEST"]:
+        px.setup_test(json.loads(byte_data[4:].decode()), addr)
+    elif msg_type == PROC_MSG["TC_GET_PACKET"]:
+        request = json.loads(byte_data[4:].decode()) if len(byte_data) > 4 else {}
+        binding = px.tests.get(request["TestInstID"]) if "TestInstID" in request else px.current_test()
+        packets = binding.packets if binding else PacketWindow(0)
+        records, next_since, more = packets.fetch(float(request.get("since", 0)),
+                                                  int(request.get("limit", PACKET_FETCH_LIMIT)),
+                                                  PACKET_CHUNK_SIZE - 4 - PACKET_CHUNK_HEADER.size)
+        byte_data = pack_packet_chunk(byte_data[0:4], records, next_since, more)
+        logging.debug("[proxy] {} packets, length is:{}, dst addr is:{}".format(len(records), len(byte_data), addr))
+        px.send(byte_data, addr)
+    elif msg_type == PROC_MSG["TC_TEARDOWN_TEST"]:
+        request = json.loads(byte_data[4:].decode()) if len(byte_data) > 4 else {}
+        if "TestInstID" in request:
+            px.teardown_test(request["TestInstID"])
+        else:
+            px.close()
+        logging.info("[proxy] gateway summary: {}".format(px.gateways.stats()))
+    elif msg_type == PROC_MSG["GW_PUSH_DATA"]:  # uplink packets
+        gw = gateway_eui(byte_data).hex()
+        px.gateways.seen(gw, "push_data", addr)
+
+        # forwarded under a token of this worker, in sharded mode the receiver hands the ack to its picker
+        token = px.new_token()
+        fields = DATA_FIELD.findall(byte_data, 12)
+        if fields and not any(px.is_dut(field) for field in fields):
+            # nobody tests these devices, the frames reach the NS as they came
+            px.send(rewrite(byte_data, gateway=gw_mac, token=token), addr_ns)
+            px.stats.count("fast_path_frames", len(fields))
+            for field in fields:
+                px.check_join(field)
+        elif fields:
+            logging.info("rx packet received from gateway at {}".format(time_of_arrival))
+            json_data = json_body(byte_data)
+            others = []
+            for pkt in json_data['rxpk']:
+                if px.is_dut(pkt["data"]):
+                    px.buffer_uplink(pkt, gw, time_of_arrival)
+                else:
+                    others.append(pkt)
+            if others:
+                json_data['rxpk'] = others
+                px.send(byte_data[0:1] + token + byte_data[3:4] + gw_mac + json.dumps(json_data).encode(), addr_ns)
+                px.stats.count("fast_path_frames", len(others))
+                for pkt in others:
+                    px.check_join(pkt["data"])
+        else:
+            px.send(rewrite(byte_data, gateway=gw_mac, token=token), addr_ns)
+
+            test = px.current_test()
+            if test:
+                px.delays.append(list(token), time.time(), "ns", test.test_inst_id)
+
+        if ack:
+            px.send(build(original_token, PROC_MSG["NS_PUSH_ACK"]), addr)
+    elif msg_type in [PROC_MSG["NS_PUSH_ACK"], PROC_MSG["NS_PULL_ACK"]]:
+        px.delays.update(list(original_token), "ns")
+        px.tracer.ack(original_token, "ns")
+    elif msg_type == PROC_MSG["GW_PULL_DATA"]:
+        px.gateways.seen(gateway_eui(byte_data).hex(), "pull_data", addr)
+
+        px.send(rewrite(byte_data, gateway=gw_mac), addr_ns)
+        test = px.current_test()
+        if test:
+            px.delays.append(list(original_token), time.time(), "ns", test.test_inst_id)
+
+        px.send(build(original_token, PROC_MSG["NS_PULL_ACK"]), addr)
+    elif msg_type == PROC_MSG["NS_PULL_RSP"]:  # downlink packets
+        fields = DATA_FIELD.findall(byte_data, 4)
+        json_data = json_body(byte_data) if not fields or px.is_dut(fields[0], downlink=True) else {}
+        binding = px.lookup_downlink(json_data['txpk']) if json_data.get('txpk', {}).get('data') else None
+        if binding:
+            pkt = json_data['txpk']
+            pkt["json"] = binding.codec.decode_downlink(pkt, not binding.ipc_decoded)
+            log_packet("Received from NS", pkt)
+
+            if "error" in pkt["json"]:
+                px.stats.count("decode_errors")
+                return
+            px.bind_devaddr(binding)
+
+            pkt["time"] = time.time()
+            pkt["direction"] = "down"
+            pkt["trace"] = px.tracer.start(binding.test_inst_id, "down", "ns", time_of_arrival)
+            token = px.send_tc(binding, "txpk", pkt)
+
+            if "fdev" not in pkt:
+                pkt["fdev"] = None
+            if "prea" not in pkt:
+                pkt["prea"] = 8
+            pkt["stat"] = 0
+            append_packet(pkt, binding.packets, binding.test_inst_id, px.writer)
+            px.delays.append(token, time_of_arrival, "tc", binding.test_inst_id)
+        else:
+            _, addr_pull = px.gateways.route()
+            if not addr_pull:
+                logging.error("[proxy] no gateway to send the downlink to")
+                return
+            token = px.new_token()  # the TX_ACK of the gateway comes back to this worker
+            test = px.current_test()
+            if fields:  # downlink of a device nobody tests
+                px.stats.count("fast_path_frames")
+            elif test:
+                px.delays.append(list(token), time.time(), "gw", test.test_inst_id)
+            px.send(rewrite(byte_data, token=token), addr_pull)
+
+        if gw_mac:
+            px.send(build(original_token, PROC_MSG["GW_TX_ACK"], gw_mac), addr_ns)
+    elif msg_type == PROC_MSG["GW_TX_ACK"]:
+        px.gateways.seen(gateway_eui(byte_data).hex(), "tx_ack", addr)
+        px.delays.update(list(original_token), "gw")
+        px.tracer.ack(original_token, "gw")
+    elif msg_type == PROC_MSG["TC_DATA"]:  # interface for test controller
+        process_tc_data(byte_data, time_of_arrival, px)
+    elif msg_type == PROC_MSG["TC_GET_STATS"]:
+        px.send(byte_data[0:4] + json.dumps(px.stats_snapshot()).encode(), addr)
+    elif msg_type == PROC_MSG["WB_DEVICE_UPDATE"]:
+        px.devices.invalidate()
+    elif msg_type == PROC_MSG["TC_GET_AIRTIME"]:
+        request = json.loads(byte_data[4:].decode()) if len(byte_data) > 4 else {}
+        binding = px.tests.get(request["TestInstID"]) if "TestInstID" in request else px.current_test()
+        summary = binding.airtime.summary(time.time()) if binding else {}
+        px.send(byte_data[0:4] + json.dumps(summary).encode(), addr)
+    else:
+        logging.error("Error UDP identifier:" + str(msg_type))
+
+
+def process_tc_data(byte_data, time_of_arrival, px):
+    kind, pkt = unpack_tc_data(byte_data)
+    token = list(byte_data[1:3])
+    px.restore_decoded(token, pkt)
+
+    if kind == "rxpk":
+        log_packet("Received from TC, send to NS", pkt)
+
+        if not pkt:
+            px.tracer.finish(px.tracer.reply(token, "tc"))
+            return
+
+        binding = px.lookup_tc(pkt)
+        trace = px.trace_reply(token, pkt, binding, "up")
+        if pkt["size"] < 0:
+            pkt["data"], pkt["size"] = (binding.codec if binding else px.codec).encode_uplink(pkt["json"])
+
+        pkt_copy = pkt.copy()
+        for key in ("json", "time", "direction", "receptions", "trace"):
+            if key in pkt_copy:
+                del pkt_copy[key]
+
+        byte_data = bytes([2, token[0], token[1], PROC_MSG["GW_PUSH_DATA"]]) + gw_mac + \
+                    json.dumps({"rxpk": [pkt_copy]}).encode()
+        px.send(byte_data, addr_ns, binding)
+        px.stats.observe("tc_ns", time.time() - time_of_arrival)
+        px.tracer.mark(trace, "fwd")
+        px.tracer.expect(trace, token, "ns")
+
+        pkt["stat"] = 1
+        pkt["time"] = time.time()
+        pkt["direction"] = "up"
+        px.delays.update(token, "tc")
+        if binding:
+            append_packet(pkt, binding.packets, binding.test_inst_id, px.writer)
+            px.delays.append(token, pkt["time"], "ns", binding.test_inst_id)
+    elif kind == "txpk":
+        gw, addr_pull = px.gateways.route(((pkt or {}).get("json") or {}).get("DevEui"))
+        if not addr_pull:
+            logging.error("[proxy] no gateway to send the downlink to")
+            return
+
+        log_packet("Received from TC, send to GW", pkt)
+
+        if not pkt:
+            px.delays.update(token, "tc")
+            px.tracer.finish(px.tracer.reply(token, "tc"))
+            return
+
+        binding = px.lookup_tc(pkt)
+        trace = px.trace_reply(token, pkt, binding, "down")
+        if pkt["size"] < 0:
+            pkt["data"], pkt["size"] = (binding.codec if binding else px.codec).encode_downlink(pkt["json"])
+
+        pkt["powe"] = min([pkt["powe"], MAX_TX_POWER])
+        pkt_copy = pkt.copy()
+        for key in ("json", "time", "direction", "trace"):
+            if key in pkt_copy:
+                del pkt_copy[key]
+
+        byte_data = bytes([2, token[0], token[1], PROC_MSG["NS_PULL_RSP"]]) + json.dumps({"txpk": pkt_copy}).encode()
+        px.send(byte_data, addr_pull, binding)
+        px.tracer.mark(trace, "fwd")
+        px.tracer.expect(trace, token, "gw")
+
+        if "fdev" not in pkt:
+            pkt["fdev"] = None
+        if "prea" not in pkt:
+            pkt["prea"] = 8
+
+        pkt["stat"] = 1
+        pkt["time"] = time.time()
+        pkt["direction"] = "down"
+        time_gen = px.delays.update(token, "tc")
+        if time_gen:  # the downlink came from the NS, not from the test controller alone
+            px.stats.observe("ns_gw", pkt["time"] - time_gen)
+        if binding:
+            px.time_downlink(binding, gw, pkt, time_gen)
+            append_packet(pkt, binding.packets, binding.test_inst_id, px.writer)
+            px.delays.append(token, time.time(), "gw", binding.test_inst_id)
 
-                pkt["time"] = time.time()
-                pkt["direction"] = "down"
-                byte_data = bytes([2, random.randint(0, 255), random.randint(0, 255), 6]) + \
-                           json.dumps({"txpk": pkt}).encode()
-                sock.sendto(byte_data, addr_tc)
-
-                if "fdev" not in pkt:
-                    pkt["fdev"] = None
-                if "prea" not in pkt:
-                    pkt["prea"] = 8
-                pkt["stat"] = 0
-                token = list(byte_data[1:3])
-                if is_test_running:
-                    append_packet(pkt, packets, test_inst_id, conn)
-                    append_delay(token, time_of_arrival, "tc", delays)
-            else:
-                if is_test_running:
-                    append_delay(token, time.time(), "gw", delays)
-                sock.sendto(byte_data, addr_pull)
-
-            if gw_mac:
-                byte_data = list(byte_data[:4])
-                byte_data[3] = 5
-                byte_data = bytes([2]) + original_token + bytes([5]) + gw_mac
-                sock.sendto(byte_data, addr_ns)
-            continue
 
-        if msg_type == 5:  # TX_ACK from the gw
-            gw_mac_tmp = byte_data[4:12]
-            addr_pull = addr
+def run_proxy():
+    create_db_tables_proxy()
+    recover_db_proxy()
+    if PROXY_WORKERS > 1:
+        run_sharded_proxy(PROXY_WORKERS)
+        return
 
-            token = list(byte_data[1:3])
-            if is_test_running:
-                update_delay(token, "gw", delays, test_inst_id, conn)
-            continue
+    sock, ancbufsize = open_proxy_socket()
 
-        # interface for test controller
-        if msg_type == 6:
-            json_data = json.loads(byte_data[4:].decode())
+    conn = sqlite3.connect(DB_FILE_PROXY, timeout=60)
+    conn.row_factory = sqlite3.Row
+    writer = DbWriter(DB_FILE_PROXY)
 
-            if 'rxpk' in json_data:
-                token = list(byte_data[1:3])
+    px = ProxyContext(sock, conn, writer)
+    px.restore(load_checkpoints(1))
+    reader = DatagramReader(sock, ancbufsize)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    logging.debug("proxy successfully started")
 
-                pkt = json_data["rxpk"]
-                logging.info("Received from TC, send to NS")
-                for line in json.dumps(pkt, indent=4, sort_keys=True).split("\n"):
-                    logging.info(line)
+    try:
+        while True:
+            events = selector.select(px.next_timeout())
+            px.tick()
+            if not events:
+                continue
 
-                if not pkt:
+            for byte_data, addr in reader.drain():
+                px.capture(byte_data, addr, px.local_addr)
+                process_proxy_msg(byte_data, addr, time.time(), px)
+                px.flush_uplinks()
+            px.kernel_drops = reader.kernel_drops
+    finally:
+        px.close()
+        writer.close()
+        selector.close()
+        sock.close()
+        conn.close()
+
+
+class ShardRouter():
+    '''
+    Picks the worker of each datagram in sharded mode. All frames of a device go to one worker and
+    keep their order: join requests and test setups by DevEui, data frames by the DevAddr the worker
+    reported once the device joined (by DevAddr hash before that), acks and test controller replies
+    by the token the worker picked. Workers forward uplinks and downlinks under a token of their own
+    so that the ack comes back to them, keepalives and their acks go through worker 0.
+    '''
+    def __init__(self, count):
+        self.count = count
+        self.by_devaddr = {}
+        self.devaddrs = [frozenset() for _ in range(count)]
+        self.awaiting = set()  # workers with a device waiting for its join accept
+        self.tests = {}  # TestInstID -> worker
+        self.last_test = 0
+
+    def by_key(self, key):
+        return shard_of(key, self.count)
+
+    def by_token(self, byte_data):
+        return int.from_bytes(byte_data[1:3], "big") % self.count
+
+    def by_frame(self, data):
+        phy_payload = base64.b64decode(data[:PHY_HEADER_B64])
+        if len(phy_payload) < 5:
+            return 0
+        m_type = phy_payload[0] >> 5
+        if m_type == 0:
+            return self.by_key(phy_payload[9:17].hex()) if len(phy_payload) >= 17 else 0
+        if m_type == 1:  # encrypted, the workers waiting for a join accept are asked by route
+            return 0
+        devaddr = phy_payload[1:5].hex()
+        shard = self.by_devaddr.get(devaddr)
+        return self.by_key(devaddr) if shard is None else shard
+
+    def restore(self, checkpoints):
+        # the workers restore the tests of their devices, the receiver only needs where they went
+        for checkpoint in checkpoints:
+            deveui = checkpoint["setup"].get("DevEui")
+            self.last_test = self.by_key(reverse_eui(deveui)) if deveui else 0
+            self.tests[checkpoint["setup"]["TestInstID"]] = self.last_test
+
+    def update(self, shard, devaddrs, awaiting):
+        for devaddr in self.devaddrs[shard] - devaddrs:
+            if self.by_devaddr.get(devaddr) == shard:
+                del self.by_devaddr[devaddr]
+        for devaddr in devaddrs:
+            self.by_devaddr[devaddr] = shard
+        self.devaddrs[shard] = devaddrs
+        if awaiting:
+            self.awaiting.add(shard)
+        else:
+            self.awaiting.discard(shard)
+
+    def route(self, byte_data):
+        # list of (worker, datagram, mode)
+        msg_type = byte_data[3]
+        if msg_type == PROC_MSG["GW_PUSH_DATA"]:
+            return self.route_push_data(byte_data)
+        if msg_type == PROC_MSG["GW_PULL_DATA"]:
+            # every worker may send downlinks to the gateway, one forwards the keepalive to the NS
+            return [(0, byte_data, "full")] + [(shard, byte_data, "gateway") for shard in range(1, self.count)]
+        if msg_type in (PROC_MSG["GW_TX_ACK"], PROC_MSG["NS_PUSH_ACK"], PROC_MSG["TC_DATA"]):
+            return [(self.by_token(byte_data), byte_data, "full")]
+        if msg_type == PROC_MSG["NS_PULL_RSP"]:
+            fields = DATA_FIELD.findall(byte_data, 4)
+            mhdr = base64.b64decode(fields[0][:4]) if fields else b""
+            if mhdr and mhdr[0] >> 5 == 1 and self.awaiting:
+                # only a worker whose device checks the MIC takes it, worker 0 forwards it if none does
+                return [(shard, byte_data, "candidate") for shard in sorted(self.awaiting)]
+            return [(self.by_frame(fields[0]) if fields else 0, byte_data, "full")]
+        if msg_type == PROC_MSG["TC_SETUP_TEST"]:
+            request = json.loads(byte_data[4:].decode())
+            deveui = request.get("DevEui")
+            self.last_test = self.by_key(reverse_eui(deveui)) if deveui else 0
+            self.tests[request.get("TestInstID")] = self.last_test
+            return [(self.last_test, byte_data, "full")]
+        if msg_type == PROC_MSG["WB_DEVICE_UPDATE"]:
+            return [(shard, byte_data, "full") for shard in range(self.count)]
+        if msg_type in (PROC_MSG["TC_TEARDOWN_TEST"], PROC_MSG["TC_GET_PACKET"], PROC_MSG["TC_GET_AIRTIME"]):
+            request = json.loads(byte_data[4:].decode()) if len(byte_data) > 4 else {}
+            if "TestInstID" in request:
+                return [(self.tests.get(request["TestInstID"], self.last_test), byte_data, "full")]
+            if msg_type == PROC_MSG["TC_TEARDOWN_TEST"]:
+                return [(shard, byte_data, "full") for shard in range(self.count)]
+            return [(self.last_test, byte_data, "full")]
+        return [(0, byte_data, "full")]
+
+    def route_push_data(self, byte_data):
+        fields = DATA_FIELD.findall(byte_data, 12)
+        shards = [self.by_frame(field) for field in fields]
+        if len(set(shards)) <= 1:
+            return [(shards[0] if shards else 0, byte_data, "full")]
+
+        # frames of devices on several workers, each gets a datagram with its frames only
+        json_data = json.loads(byte_data[12:].decode())
+        groups = collections.OrderedDict()
+        for shard, pkt in zip(shards, json_data["rxpk"]):
+            groups.setdefault(shard, []).append(pkt)
+        routes = []
+        for shard, frames in groups.items():
+            json_data["rxpk"] = frames
+            routes.append((shard, byte_data[0:12] + json.dumps(json_data).encode(), "part" if routes else "full"))
+            json_data = {}  # the gateway stats and the ack go with the first part only
+        return routes
+
+
+def run_worker(shard, count, sock, pipe, receiver_pipes, checkpoints):
+    # forked from the receiver, the socket is shared to send, only the receiver reads it
+    install_term_handler()
+    for receiver_pipe in receiver_pipes:  # or the end of the receiver is never seen
+        receiver_pipe.close()
+    conn = sqlite3.connect(DB_FILE_PROXY, timeout=60)
+    conn.row_factory = sqlite3.Row
+    writer = DbWriter(DB_FILE_PROXY)
+
+    px = ProxyContext(sock, conn, writer, (shard, count))
+    px.stats_file = None
+    px.restore(checkpoints)
+    state = None
+    try:
+        while True:
+            if pipe.poll(px.next_timeout()):
+                try:
+                    message = pipe.recv()
+                except EOFError:
+                    message = None
+                if message is None:
+                    break
+                mode, byte_data, addr, time_of_arrival = message[:4]
+                if mode == "stats":
+                    pipe.send(("stats", byte_data, px.stats_snapshot()))
+                elif mode == "gateway":
+                    px.gateways.seen(byte_data[4:12].hex(), "pull_data", addr)
+                elif mode == "candidate":  # a join accept, the receiver forwards it if no worker claims it
+                    claimed = px.claims_join_accept(byte_data)
+                    if claimed:
+                        px.capture(byte_data, addr, px.local_addr)
+                        process_proxy_msg(byte_data, addr, time_of_arrival, px)
+                    pipe.send(("join_accept", message[4], claimed))
+                else:
+                    px.capture(byte_data, addr, px.local_addr)
+                    process_proxy_msg(byte_data, addr, time_of_arrival, px, ack=mode != "part")
+            px.tick()
+            if px.shard_state() != state:
+                state = px.shard_state()
+                pipe.send(("state",) + state)
+    finally:
+        px.close()
+        writer.close()
+        conn.close()
+
+
+def run_sharded_proxy(count):
+    '''
+    A receiver reads the socket and hands each datagram to one of count worker processes, each
+    with its own tests, codecs and dedup buffer. The workers send on the same socket.
+    '''
+    sock, ancbufsize = open_proxy_socket()
+    checkpoints = load_checkpoints(count)
+    context = multiprocessing.get_context("fork")
+    pipes, worker_pipes = zip(*[context.Pipe() for _ in range(count)])
+    workers = []
+    for shard in range(count):
+        worker = context.Process(target=run_worker, name="proxy-worker-{}".format(shard),
+                                 args=(shard, count, sock, worker_pipes[shard], pipes, checkpoints), daemon=True)
+        worker.start()
+        workers.append(worker)
+    for worker_pipe in worker_pipes:
+        worker_pipe.close()
+
+    def stop_workers():
+        for pipe in pipes:
+            try:
+                pipe.send(None)
+            except OSError:
+                pass
+        for worker in workers:
+            worker.join(WORKER_STOP_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+
+    def request_stats(header, addr):
+        request_id = next(request_ids)
+        stats_requests[request_id] = (header, addr, [])
+        for pipe in pipes:
+            pipe.send(("stats", request_id, None, None))
+
+    router = ShardRouter(count)
+    router.restore(checkpoints)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    for shard, pipe in enumerate(pipes):
+        selector.register(pipe, selectors.EVENT_READ, shard)
+    stats_requests = {}  # request id -> (reply header, addr, snapshots of the workers)
+    join_accepts = {}  # request id -> [workers yet to answer, claimed, datagram, addr, time of arrival]
+    request_ids = itertools.count()
+    stats_deadline = time.monotonic() + STATS_INTERVAL
+    reader = DatagramReader(sock, ancbufsize)
+    logging.debug("proxy successfully started with {} workers".format(count))
+
+    try:
+        while True:
+            events = selector.select(max(stats_deadline - time.monotonic(), 0))
+            if time.monotonic() >= stats_deadline:
+                stats_deadline = time.monotonic() + STATS_INTERVAL
+                request_stats(None, None)
+
+            # the workers first, a join accept must find the state that announced its device waits for one
+            for key, _ in sorted(events, key=lambda event: event[0].fileobj is sock):
+                if key.fileobj is not sock:
+                    try:
+                        message = key.fileobj.recv()
+                    except EOFError:
+                        raise RuntimeError("proxy worker {} exited".format(key.data))
+                    if message[0] == "state":
+                        router.update(key.data, message[1], message[2])
+                        continue
+                    if message[0] == "join_accept":
+                        pending = join_accepts[message[1]]
+                        pending[0] -= 1
+                        pending[1] = pending[1] or message[2]
+                        if pending[0] == 0:
+                            del join_accepts[message[1]]
+                            if not pending[1]:  # a device nobody tests, worker 0 sends it to the gateway
+                                pipes[0].send(("full",) + tuple(pending[2:]))
+                        continue
+                    header, addr, snapshots = stats_requests[message[1]]
+                    snapshots.append(message[2])
+                    if len(snapshots) < count:
+                        continue
+                    del stats_requests[message[1]]
+                    snapshot = merge_snapshots(snapshots)
+                    snapshot["gauges"]["kernel_drops"] = reader.kernel_drops
+                    snapshot["gauges"]["workers"] = count
+                    if addr is None:
+                        try:
+                            write_prometheus(snapshot, STATS_FILE_PROXY)
+                        except OSError as e:
+                            logging.error("[proxy] cannot write stats: {}".format(e))
+                    else:
+                        sock.sendto(header + json.dumps(snapshot).encode(), addr)
                     continue
 
-                if pkt["size"] < 0:
-                    pkt["data"], pkt["size"] = codec.encode_uplink(pkt["json"])
-
-                pkt_copy = pkt.copy()
-                for key in ("json", "time", "direction"):
-                    if key in pkt_copy:
-                        del pkt_copy[key]
-
-                byte_data = bytes([2, token[0], token[1], 0]) + gw_mac + json.dumps({"rxpk": [pkt_copy]}).encode()
-                sock.sendto(byte_data, addr_ns)
-
-                pkt["stat"] = 1
-                pkt["time"] = time.time()
-                pkt["direction"] = "up"
-                if is_test_running:
-                    update_delay(token, "tc", delays, test_inst_id, conn)
-                    append_packet(pkt, packets, test_inst_id, conn)
-                    append_delay(token, pkt["time"], "ns", delays)
-
-                continue
-            if 'txpk' in json_data:
-                token = list(byte_data[1:3])
-
-                if addr_pull:
-                    pkt = json_data["txpk"]
-                    logging.info("Received from TC, send to GW")
-                    for line in json.dumps(pkt, indent=4, sort_keys=True).split("\n"):
-                        logging.info(line)
-
-                    if not pkt:
-                        if is_test_running:
-                            update_delay(token, "tc", delays, test_inst_id, conn)
+                for byte_data, addr in reader.drain():
+                    if byte_data[3] == PROC_MSG["TC_GET_STATS"]:
+                        request_stats(byte_data[0:4], addr)
                         continue
-
-                    if json_data["txpk"]["size"] < 0:
-                        pkt["data"], pkt["size"] = codec.encode_downlink(pkt["json"])
-
-                    pkt["powe"] = min([pkt["powe"], MAX_TX_POWER])
-                    pkt_copy = pkt.copy()
-                    for key in ("json", "time", "direction"):
-                        if key in pkt_copy:
-                            del pkt_copy[key]
-
-                    data = json.dumps({"txpk": pkt_copy})
-                    byte_data = bytes([2, token[0], token[1], 3]) + data.encode()
-                    sock.sendto(byte_data, addr_pull)
-
-                    if "fdev" not in pkt:
-                        pkt["fdev"] = None
-                    if "prea" not in pkt:
-                        pkt["prea"] = 8
-
-                    pkt["stat"] = 1
-                    pkt["time"] = time.time()
-                    pkt["direction"] = "down"
-                    if is_test_running:
-                        update_delay(token, "tc", delays, test_inst_id, conn)
-                        append_packet(pkt, packets, test_inst_id, conn)
-                        append_delay(token, time.time(), "gw", delays)
-                continue
-
-        logging.error("Error UDP identifier:" + str(byte_data[3]))
+                    time_of_arrival = time.time()
+                    try:
+                        routes = router.route(byte_data)
+                    except (ValueError, KeyError, IndexError) as e:
+                        logging.error("[proxy] cannot route datagram from {}: {}".format(addr, e))
+                        continue
+                    if routes[0][2] == "candidate":
+                        request_id = next(request_ids)
+                        join_accepts[request_id] = [len(routes), False, byte_data, addr, time_of_arrival]
+                        for shard, shard_data, mode in routes:
+                            pipes[shard].send((mode, shard_data, addr, time_of_arrival, request_id))
+                        continue
+                    for shard, shard_data, mode in routes:
+                        pipes[shard].send((mode, shard_data, addr, time_of_arrival))
+    finally:
+        stop_workers()
+        selector.close()
+        sock.close()
 
 
 if __name__== "__main__":
+    install_term_handler()
     reliable_run(run_proxy, loop = True)
@@ -44,6 +44,7 @@ import requests
 
 sys.path.append("..")
 import lib_base as lib
+import lib_ipc
 from lib_base import GW_ID
 
 def pytest_addoption(parser):
@@ -710,9 +711,6 @@ class TestController:
                                 self.schedule["AddTime"], self.schedule["StartTime"])).lastrowid
             self.conn.commit()
 
-        if self.pcap:
-            self.tcp_process = lib.start_pcap()
-
     def setup_socket(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.settimeout(1)
@@ -722,7 +720,9 @@ class TestController:
                              + json.dumps(self.schedule).encode(), lib.addr_pc)
             self.sock.sendto(bytes([0, 1, 2, lib.PROC_MSG["TC_SETUP_TEST"]])
                              + json.dumps({'DevEui': self.schedule['DevEui'],
-                                           "TestInstID": self.schedule['TestInstID']}).encode(),
+                                           "TestInstID": self.schedule['TestInstID'],
+                                           "pcap": self.pcap,
+                                           "ipc": lib_ipc.TC_FRAME_VERSION}).encode(),
                              lib.addr_pf)
 
     def start_misc_process(self):
@@ -757,33 +757,28 @@ class TestController:
             return None
         self.addr_proxy = addr
 
-        json_data = json.loads(byte_data[4:].decode())
-        pkt = None
-        for pk in ['rxpk', 'txpk']:
-            if pk in json_data:
-                pkt = json_data[pk]
-                self.header = byte_data[:4]
-                self.packet_type = pk
-                logging.debug("controller received {}, token is: {}, packet is: {}".format(
-                    list(byte_data[1:3]), pk, pkt))
-
-                if pk == 'rxpk' and self.is_duplicate(pkt):
-                    pkt = None
-                    break
-                # For now, for rx, save the packet before manipulation, so deepcopy
-                # a backup and append it to the list. For tx, save the packets after according
-                # to the logic in get_all_packets in web_result
-                if pk == 'rxpk':
-                    self.packets.append(copy.deepcopy(pkt))
-                else:
-                    self.packets.append(pkt)
-                break
+        pk, pkt = lib_ipc.unpack_tc_data(byte_data)
+        if pk:
+            self.header = byte_data[:4]
+            self.packet_type = pk
+            logging.debug("controller received {}, token is: {}, packet is: {}".format(
+                list(byte_data[1:3]), pk, pkt))
+
+            if pk == 'rxpk' and self.is_duplicate(pkt):
+                return None
+            # For now, for rx, save the packet before manipulation, so deepcopy
+            # a backup and append it to the list. For tx, save the packets after according
+            # to the logic in get_all_packets in web_result
+            if pk == 'rxpk':
+                self.packets.append(copy.deepcopy(pkt))
+            else:
+                self.packets.append(pkt)
 
         return pkt
 
     def send(self, pkt):
         if self.header and self.packet_type:
-            byte_data = self.header + json.dumps({self.packet_type: pkt}).encode()
+            byte_data = lib_ipc.pack_tc_data(self.header, self.packet_type, pkt)
             self.sock.sendto(byte_data, self.addr_proxy)
             self.header = None
             self.packet_type = None
@@ -994,13 +989,10 @@ class TestController:
             self.conn.close()
         if self.sock:
             if not self.standby:
-                self.sock.sendto(bytes([0, 1, 2, lib.PROC_MSG["TC_TEARDOWN_TEST"]]), lib.addr_pf)
+                self.sock.sendto(bytes([0, 1, 2, lib.PROC_MSG["TC_TEARDOWN_TEST"]])
+                                 + json.dumps({"TestInstID": self.schedule["TestInstID"]}).encode(), lib.addr_pf)
             self.sock.sendto(bytes([lib.PROC_MSG["TC_TEARDOWN_TEST"]]) + json.dumps(self.schedule).encode(), lib.addr_pc)
             self.sock.close()
-        if self.pcap:
-            self.tcp_process.terminate()
-            timestamp = time.strftime("%Y-%m-%d-%H-%M-%S", time.localtime(self.schedule['StartTime']))
-            os.system("sudo mv *.pcap ../log/test_{}_{}_{}.pcap".format(self.schedule["Cat"], self.schedule["SubCat"], timestamp))
 
         logging.debug("teardown is finished")
 #@pytest.fixture
@@ -29,47 +29,121 @@
 #(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 #SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import threading, subprocess
+import subprocess
+import multiprocessing
+import multiprocessing.connection
 import time
 import os, sys
 import lib_db
 import logging
 
 
-from proxy import run_proxy
+from proxy import run_proxy, remove_checkpoints
 from controller import run_controller
 from web_main import run_web
 from lib_base import POWER_FOLDER, DB_FOLDER, CACHE_FOLDER, PCAP_FOLDER, DB_BACKUP_INTERVAL,\
     FILE_PC_CONTEXT, reliable_run, use_internal_gateway, report_ip, config_console, config_logger,\
-    config, gw_mac, NUM_LOG_FILES
+    config, gw_mac, NUM_LOG_FILES, install_term_handler, PROXY_NICE, PROXY_CPUS
 
 import json
 
 LOG_DIR = os.path.join(os.getcwd(), "log")
+RESTART_BACKOFF_MIN = 1
+RESTART_BACKOFF_MAX = 60
+# a child that ran this long before dying is restarted without waiting
+RESTART_BACKOFF_RESET = 300
+STOP_TIMEOUT = 5
 
 def run_backup():
     lib_db.backup_db_proxy()
     lib_db.backup_db_tc()
 
 
-def restart_dead_thread(t):
-    label = {0: "web host       ",
-             1: "test controller",
-             2: "proxy          "}
-    
-    for _, thread in enumerate(t):
-        alive = thread.is_alive()
+def run_child(label, target, nice, cpus):
+    install_term_handler()
+    config_logger(name="ctb_" + label.replace(" ", "_"))
+    if nice:
         try:
-            thread_label = label[_]
-        except KeyError:
-            thread_label = "???            "
-        logging.log(logging.NOTSET, thread_label + " %d" % alive)
-        if not alive:
-            thread.run()
-            logging.error(thread_label + " restarted") # should this be checked again?
-
-            with open("error.log", "a") as f:
-                f.write(_ + " restarted\n") # uses a counter (_), maybe replace with thread_label
+            os.nice(nice)
+        except OSError as e:
+            logging.warning("{} cannot change its priority: {}".format(label, e))
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except (OSError, AttributeError) as e:
+            logging.warning("{} cannot be pinned to cpus {}: {}".format(label, cpus, e))
+    reliable_run(target, loop = True)
+
+
+class Supervisor():
+    '''
+    Runs web host, test controller and proxy as separate processes, so that page rendering in the
+    web host cannot hold the interpreter lock while the proxy forwards a downlink.
+    '''
+    def __init__(self):
+        self.children = {}
+
+    def add(self, label, target, nice=0, cpus=None):
+        self.children[label] = {"target": target, "nice": nice, "cpus": cpus, "process": None,
+                                "started": 0, "backoff": RESTART_BACKOFF_MIN, "restart_at": None}
+
+    def start(self, label):
+        child = self.children[label]
+        child["process"] = multiprocessing.Process(target=run_child, name=label,
+                                                   args=(label, child["target"], child["nice"], child["cpus"]))
+        child["process"].start()
+        child["started"] = time.monotonic()
+        child["restart_at"] = None
+        logging.info("{} started, pid {}".format(label, child["process"].pid))
+
+    def start_all(self):
+        for label in self.children:
+            self.start(label)
+            time.sleep(0.1)
+
+    def wait(self, timeout):
+        # sleeps like time.sleep but wakes up as soon as a child dies
+        deadline = time.monotonic() + timeout
+        while True:
+            self.restart_dead()
+            now = time.monotonic()
+            if now >= deadline:
+                return
+            wake_up = deadline
+            for child in self.children.values():
+                if child["restart_at"] is not None:
+                    wake_up = min(wake_up, child["restart_at"])
+            sentinels = [child["process"].sentinel for child in self.children.values()
+                         if child["process"] and child["process"].is_alive()]
+            multiprocessing.connection.wait(sentinels, max(wake_up - now, 0))
+
+    def restart_dead(self):
+        now = time.monotonic()
+        for label, child in self.children.items():
+            process = child["process"]
+            if process is None or process.is_alive():
+                continue
+            if child["restart_at"] is None:
+                if now - child["started"] > RESTART_BACKOFF_RESET:
+                    child["backoff"] = RESTART_BACKOFF_MIN
+                child["restart_at"] = now + child["backoff"]
+                logging.error("{} exited with code {}, restart in {} s".format(label, process.exitcode, child["backoff"]))
+                child["backoff"] = min(child["backoff"] * 2, RESTART_BACKOFF_MAX)
+            elif now >= child["restart_at"]:
+                self.start(label)
+                logging.error(label + " restarted")
+                with open("error.log", "a") as f:
+                    f.write(label + " restarted\n")
+
+    def stop(self):
+        for child in self.children.values():
+            if child["process"] and child["process"].is_alive():
+                child["process"].terminate()
+        for child in self.children.values():
+            if child["process"]:
+                child["process"].join(STOP_TIMEOUT)
+                if child["process"].is_alive():
+                    child["process"].kill()
 
 # Limit files in log directory
 def dir_file_limiter(log_path, max_files):
@@ -90,6 +164,7 @@ def dir_file_limiter(log_path, max_files):
 if __name__== "__main__":
     config_console()
     config_logger()
+    install_term_handler()
 
     report_ip()
 
@@ -109,27 +184,27 @@ if __name__== "__main__":
             os.mkdir(folder)
     if os.path.exists(FILE_PC_CONTEXT):
         os.remove(FILE_PC_CONTEXT)
+    remove_checkpoints()  # a new run, the proxy only restores its tests when it restarts within it
 
     lib_db.create_db_tables_backup()
     lib_db.create_db_tables_proxy()
     lib_db.create_db_tables_tc()
 
-    t = []
-    t.append(threading.Thread(target=reliable_run, args=(run_web, True)))
-    t.append(threading.Thread(target=reliable_run, args=(run_controller, True)))
-    t.append(threading.Thread(target=reliable_run, args=(run_proxy, True)))
-
-    for th in t:
-        th.start()
-        time.sleep(0.1)
+    supervisor = Supervisor()
+    supervisor.add("web host", run_web)
+    supervisor.add("test controller", run_controller)
+    supervisor.add("proxy", run_proxy, PROXY_NICE, PROXY_CPUS)
+    supervisor.start_all()
 
-    time.sleep(5)
+    try:
+        supervisor.wait(5)
 
-    while True:
-        reliable_run(run_backup, loop = False)
-        dir_file_limiter(LOG_DIR, NUM_LOG_FILES)
+        while True:
+            reliable_run(run_backup, loop = False)
+            dir_file_limiter(LOG_DIR, NUM_LOG_FILES)
 
-        for _ in range(int(DB_BACKUP_INTERVAL/10)):
-            report_ip()
-            restart_dead_thread(t)
-            time.sleep(10)
+            for _ in range(int(DB_BACKUP_INTERVAL/10)):
+                report_ip()
+                supervisor.wait(10)
+    finally:
+        supervisor.stop()
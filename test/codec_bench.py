@@ -0,0 +1,104 @@
+#file      codec_bench.py
+
+#brief      cost per frame of encoding and decoding LoRaWAN data frames with the Codec of lib_packet
+
+#Revised BSD License
+
+#Copyright Semtech Corporation 2021. All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#Redistributions of source code must retain the above copyright
+#notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright
+#notice, this list of conditions and the following disclaimer in the
+#documentation and/or other materials provided with the distribution.
+#Neither the name of the Semtech corporation nor the
+#names of its contributors may be used to endorse or promote products
+#derived from this software without specific prior written permission.
+
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL SEMTECH CORPORATION. BE LIABLE FOR ANY DIRECT,
+#INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# What the proxy does to every data frame of a device under test: decode it for the test controller and,
+# when the test controller changed it, encode it again. Run from the repository root:
+#   python test/codec_bench.py --payload 1 51 242
+
+import os
+import sys
+import time
+import sqlite3
+import logging
+import argparse
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import lib_base  # reads config.json from the working directory
+from lib_db import TABLES
+from lib_packet import Codec, SessionStore
+
+DEV_EUI = "7766554433221100"
+NWK_KEY = "2B7E151628AED2A6ABF7158809CF4F3C"
+DEV_ADDR = "01020304"
+
+
+def joined_codec():
+    conn = sqlite3.connect(":memory:")
+    conn.execute(TABLES['session']['sql'])
+    # the counters stay in memory as in the proxy, the bench does not flush them
+    codec = Codec(conn, 1, {"DevEui": DEV_EUI, "NwkKey": NWK_KEY, "region": "US"}, SessionStore(conn))
+    codec.session = {"DevEui": DEV_EUI, "region": "US", "DevAddr": DEV_ADDR, "FCntUp": 0,
+                     "AppSKey": NWK_KEY, "FNwkSIntKey": NWK_KEY, "SNwkSIntKey": NWK_KEY, "NwkSEncKey": NWK_KEY,
+                     "rowid": conn.execute("INSERT INTO session (TestInstID, time) VALUES (1, ?)", (time.time(),)).lastrowid}
+    return codec
+
+
+def uplink(payload, fcnt):
+    return {"MType": "010", "Major": "0", "DevAddr": DEV_ADDR, "ADR": "0", "ADRACKReq": "0", "ClassB": "0",
+            "FPending": "0", "FCnt": fcnt, "FPort": 1, "FRMPayload": "a5" * payload, "FOpts": "", "mic": ""}
+
+
+def run(codec, payload, count, lazy=False):
+    frames = []
+    start = time.perf_counter()
+    for fcnt in range(count):
+        frames.append(codec.encode_uplink(uplink(payload, fcnt))[0])
+    encode = (time.perf_counter() - start) / count
+    start = time.perf_counter()
+    for data in frames:
+        if "error" in codec.decode_uplink({"data": data}, lazy):
+            raise RuntimeError("frame of {} bytes decoded with an error".format(payload))
+    decode = (time.perf_counter() - start) / count
+    return encode, decode
+
+
+def main():
+    parser = argparse.ArgumentParser(description="per frame cost of the LoRaWAN codec of the proxy")
+    parser.add_argument("--payload", type=int, nargs="+", default=[1, 11, 51, 115, 242], help="FRMPayload bytes")
+    parser.add_argument("--count", type=int, default=5000, help="frames per measure")
+    parser.add_argument("--lazy", action="store_true",
+                        help="decode up to the MIC check, for a test controller that does not get the decoded fields")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    codec = joined_codec()
+    print("{:>8} {:>12} {:>12} {:>12}".format("payload", "encode us", "decode us", "frames/s"))
+    for payload in args.payload:
+        run(codec, payload, args.count // 10, args.lazy)  # warm up
+        encode, decode = run(codec, payload, args.count, args.lazy)
+        print("{:>8} {:>12.1f} {:>12.1f} {:>12.0f}".format(payload, encode * 1e6, decode * 1e6,
+                                                           1 / (encode + decode)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#file      crypto_bench.py
+
+#brief      cost of the FRMPayload encryption by payload size, hex string and per block keystreams against lib_crypto
+
+#Revised BSD License
+
+#Copyright Semtech Corporation 2021. All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#Redistributions of source code must retain the above copyright
+#notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright
+#notice, this list of conditions and the following disclaimer in the
+#documentation and/or other materials provided with the distribution.
+#Neither the name of the Semtech corporation nor the
+#names of its contributors may be used to endorse or promote products
+#derived from this software without specific prior written permission.
+
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL SEMTECH CORPORATION. BE LIABLE FOR ANY DIRECT,
+#INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# The FRMPayload of every data frame is encrypted or decrypted with an AES keystream of one block per
+# 16 bytes. Run from the repository root:
+#   python test/crypto_bench.py --payload 1 51 242
+# The saving is that of lib_crypto over the hex string keystream.
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+from Crypto.Cipher import AES
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+from lib_crypto import crypt_frame_payload_bytes, key_context, BLOCK_SIZE
+
+KEY = "2B7E151628AED2A6ABF7158809CF4F3C"
+DEV_ADDR = "04030201"
+F_CNT = 1234
+
+
+def crypt_hex(frm_payload, key, direction, dev_addr, f_cnt):
+    # a cipher and hex strings per block, the payload XORed one nibble at a time
+    fcnt_string = bytes(reversed(bytes.fromhex('%08x' % int(f_cnt)))).hex()
+    s = ''
+    for i in range(int(np.ceil(len(frm_payload) / 32))):
+        encryptor = AES.new(bytes.fromhex(key), AES.MODE_CBC, IV=bytes(16))
+        s = s + encryptor.encrypt(bytes.fromhex('01' + '00000000' + direction + dev_addr + fcnt_string + '00' +
+                                                '%02x' % (i + 1))).hex()
+    decrypted = ''
+    for i in range(len(frm_payload)):
+        decrypted = decrypted + '%1x' % (int(s[i], 16) ^ int(frm_payload[i], 16))
+    return decrypted
+
+
+def crypt_blocks(frm_payload, key, direction, dev_addr, f_cnt):
+    # the cached cipher called once per block, the payload XORed byte by byte
+    cipher = key_context(key).ecb
+    a = bytearray(b"\x01\x00\x00\x00\x00" + bytes([direction]) + dev_addr + f_cnt.to_bytes(4, "little") + b"\x00\x00")
+    crypted = bytearray()
+    for i in range(0, len(frm_payload), BLOCK_SIZE):
+        a[15] = i // BLOCK_SIZE + 1
+        crypted += bytes(x ^ y for x, y in zip(frm_payload[i:i + BLOCK_SIZE], cipher.encrypt(a)))
+    return bytes(crypted)
+
+
+def run(crypt, args, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        crypt(*args)
+    return (time.perf_counter() - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="per frame cost of the FRMPayload encryption")
+    parser.add_argument("--payload", type=int, nargs="+", default=[1, 16, 51, 115, 222, 242],
+                        help="FRMPayload bytes")
+    parser.add_argument("--count", type=int, default=20000, help="payloads per measure")
+    args = parser.parse_args()
+
+    key = bytes.fromhex(KEY)
+    dev_addr = bytes.fromhex(DEV_ADDR)
+    print("{:>8} {:>12} {:>12} {:>12} {:>8}".format("payload", "hex us", "blocks us", "lib us", "saving"))
+    for payload in args.payload:
+        frm_payload = os.urandom(payload)
+        hex_args = (frm_payload.hex(), KEY, "00", DEV_ADDR, F_CNT)
+        bytes_args = (frm_payload, key, 0, dev_addr, F_CNT)
+        expected = crypt_hex(*hex_args)
+        if crypt_blocks(*bytes_args).hex() != expected or crypt_frame_payload_bytes(*bytes_args).hex() != expected:
+            raise RuntimeError("the keystreams of a {} bytes payload differ".format(payload))
+        results = []
+        for crypt, crypt_args in ((crypt_hex, hex_args), (crypt_blocks, bytes_args),
+                                  (crypt_frame_payload_bytes, bytes_args)):
+            run(crypt, crypt_args, args.count // 10)  # warm up
+            results.append(run(crypt, crypt_args, args.count))
+        print("{:>8} {:>12.2f} {:>12.2f} {:>12.2f} {:>7.0f}%".format(
+            payload, results[0] * 1e6, results[1] * 1e6, results[2] * 1e6, (1 - results[2] / results[0]) * 100))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#file      crypto_check.py
+
+#brief      lib_crypto CMACs and CBC encryptions from several threads at once against Crypto.Hash.CMAC and AES-CBC
+
+#Revised BSD License
+
+#Copyright Semtech Corporation 2021. All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#Redistributions of source code must retain the above copyright
+#notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright
+#notice, this list of conditions and the following disclaimer in the
+#documentation and/or other materials provided with the distribution.
+#Neither the name of the Semtech corporation nor the
+#names of its contributors may be used to endorse or promote products
+#derived from this software without specific prior written permission.
+
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL SEMTECH CORPORATION. BE LIABLE FOR ANY DIRECT,
+#INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# The AES contexts of lib_crypto are cached per key. Several threads use a few shared keys at once
+# and every result is compared with a fresh Crypto.Hash.CMAC or AES-CBC object. Run from the
+# repository root:
+#   python test/crypto_check.py --threads 4 --count 20000
+# Exits with 1 if any result differs.
+
+import os
+import sys
+import random
+import argparse
+import threading
+
+from Crypto.Cipher import AES
+from Crypto.Hash import CMAC
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+from lib_crypto import cmac_bytes, encrypt_aes_bytes, BLOCK_SIZE
+
+
+def check(keys, count, errors):
+    # random keys among the shared ones, messages of 0 to 4 blocks as MIC and join accept sizes go
+    rng = random.Random()
+    for _ in range(count):
+        key = rng.choice(keys)
+        data = os.urandom(rng.randrange(0, 4 * BLOCK_SIZE + 1))
+        if cmac_bytes(key, data) != CMAC.new(key, data, ciphermod=AES).digest()[:4]:
+            errors.append(("cmac", key.hex(), data.hex()))
+        data = data[:len(data) - len(data) % BLOCK_SIZE]
+        if encrypt_aes_bytes(key, data) != AES.new(key, AES.MODE_CBC, iv=bytes(BLOCK_SIZE)).encrypt(data):
+            errors.append(("cbc", key.hex(), data.hex()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="lib_crypto from several threads against pycryptodome")
+    parser.add_argument("--threads", type=int, default=4, help="threads running at once")
+    parser.add_argument("--keys", type=int, default=3, help="keys shared by the threads")
+    parser.add_argument("--count", type=int, default=20000, help="messages per thread")
+    args = parser.parse_args()
+
+    keys = [os.urandom(BLOCK_SIZE) for _ in range(args.keys)]
+    errors = []
+    threads = [threading.Thread(target=check, args=(keys, args.count, errors)) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for error in errors[:10]:
+        print("{} differs, key {} data {}".format(*error))
+    print("{} errors in {} messages".format(len(errors), 2 * args.threads * args.count))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#file      gwmp_bench.py
+
+#brief      cost per datagram of reading and rewriting GWMP frames, list and slices against lib_gwmp
+
+#Revised BSD License
+
+#Copyright Semtech Corporation 2021. All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#Redistributions of source code must retain the above copyright
+#notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright
+#notice, this list of conditions and the following disclaimer in the
+#documentation and/or other materials provided with the distribution.
+#Neither the name of the Semtech corporation nor the
+#names of its contributors may be used to endorse or promote products
+#derived from this software without specific prior written permission.
+
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL SEMTECH CORPORATION. BE LIABLE FOR ANY DIRECT,
+#INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# What the proxy does to a datagram that it only forwards: read the header, log it, put the EUI of the
+# CTB gateway in place of the one of the gateway and send it to the NS. Run from the repository root:
+#   python test/gwmp_bench.py --frames 1 4 8
+# The saving is that of lib_gwmp over the list conversions.
+
+import os
+import sys
+import json
+import time
+import base64
+import socket
+import logging
+import argparse
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import lib_base  # reads config.json from the working directory
+from lib_gwmp import parse_header, rewrite, build, send_frame
+
+GW_EUI = bytes.fromhex("AA555A0000000001")
+
+
+def push_data(frames):
+    rxpk = {"tmst": 1000000, "chan": 0, "rfch": 0, "freq": 902.3, "stat": 1, "modu": "LORA", "datr": "SF7BW125",
+            "codr": "4/5", "lsnr": 9.5, "rssi": -50, "size": 51, "data": base64.b64encode(bytes(51)).decode()}
+    return bytes([2, 1, 2, 0]) + GW_EUI + json.dumps({"rxpk": [rxpk] * frames}).encode()
+
+
+def forward_lists(byte_data, sock, addr):
+    msg_type = list(byte_data)[3]
+    logging.debug("received data: {}, msg_type:{}".format(list(byte_data)[0:5], msg_type))
+    original_token = byte_data[1:3]
+    sock.sendto(byte_data[0:4] + lib_base.gw_mac + byte_data[12:], addr)
+    return bytes([2]) + original_token + bytes([1])
+
+
+def forward_slices(byte_data, sock, addr):
+    msg_type = byte_data[3]
+    logging.debug("received data: {}, msg_type:{}".format(list(byte_data[0:5]), msg_type))
+    original_token = byte_data[1:3]
+    sock.sendto(byte_data[0:4] + lib_base.gw_mac + byte_data[12:], addr)
+    return bytes([2]) + original_token + bytes([1])
+
+
+def forward_gwmp(byte_data, sock, addr):
+    _, original_token, msg_type = parse_header(byte_data)
+    logging.debug("received data: %s, msg_type:%s", byte_data[0:5].hex(), msg_type)
+    send_frame(sock, rewrite(byte_data, gateway=lib_base.gw_mac), addr)
+    return build(original_token, 1)
+
+
+class NullSocket():
+    def sendto(self, data, addr):
+        pass
+
+    def sendmsg(self, buffers, ancdata, flags, addr):
+        pass
+
+    def close(self):
+        pass
+
+
+def run(forward, byte_data, sock, addr, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        forward(byte_data, sock, addr)
+    return (time.perf_counter() - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="per datagram cost of the GWMP header handling of the proxy")
+    parser.add_argument("--frames", type=int, nargs="+", default=[1, 4, 8], help="rxpk per PUSH_DATA")
+    parser.add_argument("--count", type=int, default=100000, help="datagrams per measure")
+    parser.add_argument("--no-send", action="store_true", help="do not send, parsing and rewriting only")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # never read, the kernel drops what overflows
+    sink.bind(("127.0.0.1", 0))
+    sock = NullSocket() if args.no_send else socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    print("{:>6} {:>6} {:>12} {:>12} {:>12} {:>8}".format("rxpk", "bytes", "list us", "slices us", "gwmp us",
+                                                        "saving"))
+    for frames in args.frames:
+        byte_data = push_data(frames)
+        results = []
+        for forward in (forward_lists, forward_slices, forward_gwmp):
+            run(forward, byte_data, sock, sink.getsockname(), args.count // 10)  # warm up
+            results.append(run(forward, byte_data, sock, sink.getsockname(), args.count))
+        print("{:>6} {:>6} {:>12.3f} {:>12.3f} {:>12.3f} {:>7.0f}%".format(
+            frames, len(byte_data), results[0] * 1e6, results[1] * 1e6, results[2] * 1e6,
+            (1 - results[2] / results[0]) * 100))
+    sock.close()
+    sink.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#file      mic_check.py
+
+#brief      checks the MIC of the data frames stored in the packet table with the keys of their session
+
+#Revised BSD License
+
+#Copyright Semtech Corporation 2021. All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#Redistributions of source code must retain the above copyright
+#notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright
+#notice, this list of conditions and the following disclaimer in the
+#documentation and/or other materials provided with the distribution.
+#Neither the name of the Semtech corporation nor the
+#names of its contributors may be used to endorse or promote products
+#derived from this software without specific prior written permission.
+
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL SEMTECH CORPORATION. BE LIABLE FOR ANY DIRECT,
+#INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Reads the packet and session tables of the proxy and of the backup database and checks the MIC of
+# every stored data frame in one batch. Run from the repository root:
+#   python test/mic_check.py --test 12
+# A data frame is checked with the FNwkSIntKey of the latest session of its test and DevAddr that
+# started before it. Frames the test controller sent with a wrong MIC on purpose show up as bad.
+# The frames only carry the 16 low bits of FCnt, the 32 bit counter of the B0 block is rebuilt per
+# session and direction from the frames before, starting from 0 when the session starts.
+
+import os
+import sys
+import time
+import base64
+import bisect
+import sqlite3
+import argparse
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import lib_base  # reads config.json from the working directory
+from lib_crypto import verify_mics
+
+
+def read_rows(db_file, test_inst_id):
+    conn = sqlite3.connect(db_file, timeout=60)
+    conn.row_factory = sqlite3.Row
+    where, params = ("WHERE TestInstID=(?)", (test_inst_id,)) if test_inst_id is not None else ("", ())
+    try:
+        sessions = conn.execute("SELECT TestInstID, DevAddr, FNwkSIntKey, time FROM session " +
+                                (where + " AND" if where else "WHERE") +
+                                " DevAddr IS NOT NULL AND FNwkSIntKey IS NOT NULL ORDER BY time", params).fetchall()
+        packets = conn.execute("SELECT packetID, TestInstID, time, direction, data FROM packet " + where + " ORDER BY time",
+                               params).fetchall()
+    finally:
+        conn.close()
+    return sessions, packets
+
+
+def full_fcnt(last, fcnt):
+    # the 32 bit counter nearest to the last one with these 16 low bits, so it rolls over past 0xffff
+    delta = (fcnt - last) & 0xffff
+    full = last + delta if delta < 0x8000 else last + delta - 0x10000
+    return full if full >= 0 else fcnt
+
+
+def data_frames(sessions, packets):
+    # (frame, packet) of every data frame with a session, and the count of those without one
+    keys = {}
+    for session in sessions:
+        entry = keys.setdefault((session["TestInstID"], session["DevAddr"].lower()), ([], []))
+        entry[0].append(session["time"])
+        entry[1].append(bytes.fromhex(session["FNwkSIntKey"]))
+    frames = []
+    counters = {}  # (TestInstID, DevAddr, session, direction) -> last 32 bit FCnt
+    no_session = 0
+    for packet in packets:
+        phy_payload = base64.b64decode(packet["data"] or "")
+        if len(phy_payload) < 12 or phy_payload[0] >> 5 not in (2, 3, 4, 5):
+            continue
+        entry = keys.get((packet["TestInstID"], phy_payload[1:5].hex()))
+        index = bisect.bisect_right(entry[0], packet["time"]) - 1 if entry else -1
+        if index < 0:
+            no_session += 1
+            continue
+        direction = 0 if phy_payload[0] >> 5 in (2, 4) else 1
+        counter = (packet["TestInstID"], phy_payload[1:5], index, direction)
+        last = counters.get(counter, 0)
+        fcnt = full_fcnt(last, int.from_bytes(phy_payload[6:8], "little"))
+        counters[counter] = max(last, fcnt)  # a replayed frame does not move the counter back
+        frames.append(((entry[1][index], phy_payload[1:5], fcnt, direction, phy_payload), packet))
+    return frames, no_session
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MIC check of the stored data frames")
+    parser.add_argument("--db", action="append", help="database to read, the proxy and backup ones by default")
+    parser.add_argument("--test", type=int, help="TestInstID, every test by default")
+    parser.add_argument("--bad", type=int, default=20, help="frames with a bad MIC listed")
+    args = parser.parse_args()
+
+    for db_file in args.db or [lib_base.DB_FILE_PROXY, lib_base.DB_FILE_BACKUP]:
+        if not os.path.exists(db_file):
+            continue
+        frames, no_session = data_frames(*read_rows(db_file, args.test))
+        start = time.perf_counter()
+        results = verify_mics([frame for frame, _ in frames])
+        elapsed = time.perf_counter() - start
+        print("{}: {} data frame(s) checked in {:.1f} ms, {} bad, {} without session".format(
+            db_file, len(frames), elapsed * 1000, len(frames) - int(results.sum()), no_session))
+
+        counts = {}
+        for (frame, packet), valid in zip(frames, results):
+            count = counts.setdefault((packet["TestInstID"], packet["direction"]), [0, 0])
+            count[0] += 1
+            count[1] += not valid
+        if counts:
+            print("{:>10} {:5} {:>8} {:>8}".format("test", "dir", "frames", "bad"))
+            for (test_inst_id, direction), (total, bad) in sorted(counts.items()):
+                print("{:>10} {:5} {:>8} {:>8}".format(test_inst_id, direction, total, bad))
+
+        bad = [(frame, packet) for (frame, packet), valid in zip(frames, results) if not valid][:args.bad]
+        if bad:
+            print("{:>8} {:>10} {:>17} {:5} {:>8} {:>6} {:>8}".format(
+                "packetID", "test", "time", "dir", "DevAddr", "FCnt", "MIC"))
+        for frame, packet in bad:
+            print("{:>8} {:>10} {:>17.6f} {:5} {:>8} {:>6} {:>8}".format(
+                packet["packetID"], packet["TestInstID"], packet["time"], packet["direction"], frame[1].hex(), frame[2],
+                frame[4][-4:].hex()))
@@ -0,0 +1,143 @@
+#file      packet_fetch.py
+
+#brief      fetches the packets of a test from the running proxy page by page and checks them against its databases
+
+#Revised BSD License
+
+#Copyright Semtech Corporation 2021. All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#Redistributions of source code must retain the above copyright
+#notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright
+#notice, this list of conditions and the following disclaimer in the
+#documentation and/or other materials provided with the distribution.
+#Neither the name of the Semtech corporation nor the
+#names of its contributors may be used to endorse or promote products
+#derived from this software without specific prior written permission.
+
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL SEMTECH CORPORATION. BE LIABLE FOR ANY DIRECT,
+#INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Fetches the packets of a test with the TC_GET_PACKET cursor, the way a test controller pages
+# through a long test, and compares them with the packet rows of the proxy and backup databases.
+# Run from the repository root while the proxy runs:
+#   python test/packet_fetch.py --test 12 --limit 64
+# With --airtime it also prints the uplink airtime the proxy tracks live for the device (TC_GET_AIRTIME).
+# A lost reply is asked again with the same cursor. Exits with 1 if the pages and the rows differ.
+
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import argparse
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import lib_base  # reads config.json from the working directory
+from lib_ipc import unpack_packet_chunk
+
+
+def request(sock, msg_type, body, retries):
+    # the proxy answers with the header of the request, a reply to an earlier attempt is skipped
+    for attempt in range(retries + 1):
+        header = bytes([2, attempt & 0xff, int(time.time()) & 0xff, msg_type])
+        sock.sendto(header + json.dumps(body).encode(), lib_base.addr_pf)
+        try:
+            while True:
+                byte_data, _ = sock.recvfrom(65535)
+                if byte_data[:4] == header:
+                    return byte_data
+        except socket.timeout:
+            continue
+    raise RuntimeError("no reply from the proxy at {} after {} attempts".format(lib_base.addr_pf, retries + 1))
+
+
+def fetch_packets(sock, test_inst_id, limit, retries):
+    packets = []
+    pages = 0
+    since = 0
+    more = True
+    while more:
+        byte_data = request(sock, lib_base.PROC_MSG["TC_GET_PACKET"],
+                            {"TestInstID": test_inst_id, "since": since, "limit": limit}, retries)
+        records, since, more = unpack_packet_chunk(byte_data)
+        packets += [json.loads(record) for record in records]
+        pages += 1
+    return packets, pages
+
+
+def print_airtime(summary):
+    if not summary:
+        print("no airtime, the test is not running")
+        return
+    print("airtime over the last {:.0f} s ({:.0f} s seen): {} frames, {} violations".format(
+        summary["window"], summary["span"], summary["frames"], summary["violations"]))
+    for band, airtime in sorted(summary["bands"].items()):
+        limit = "" if airtime["limit"] is None else ", limit {:.2f} %".format(airtime["limit"] * 100)
+        print("  band {:>6} {:8.3f} s, duty cycle {:.3f} %{}".format(band, airtime["airtime"], airtime["duty_cycle"] * 100,
+                                                                  limit))
+    for freq, airtime in sorted(summary["channels"].items(), key=lambda item: float(item[0])):
+        print("  {:>6} MHz {:8.3f} s, occupancy {:.3f} %".format(freq, airtime["airtime"], airtime["occupancy"] * 100))
+
+
+def read_rows(test_inst_id):
+    # rows move from the proxy db to the backup db every DB_BACKUP_INTERVAL, so look in both
+    rows = {}
+    for db_file in (lib_base.DB_FILE_PROXY, lib_base.DB_FILE_BACKUP):
+        if not os.path.exists(db_file):
+            continue
+        conn = sqlite3.connect(db_file, timeout=60)
+        for row in conn.execute("SELECT time, direction, stat FROM packet WHERE TestInstID=(?)", (test_inst_id,)):
+            rows[row[0]] = row
+        conn.close()
+    return sorted(rows.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pages through the packets of a test and checks them")
+    parser.add_argument("--test", type=int, required=True, help="TestInstID")
+    parser.add_argument("--limit", type=int, default=256, help="packets per page")
+    parser.add_argument("--timeout", type=float, default=1, help="seconds to wait for a reply")
+    parser.add_argument("--retries", type=int, default=3, help="requests again after a lost reply")
+    parser.add_argument("--airtime", action="store_true", help="print the live airtime of the device too")
+    args = parser.parse_args()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(args.timeout)
+    start = time.perf_counter()
+    packets, pages = fetch_packets(sock, args.test, args.limit, args.retries)
+    elapsed = time.perf_counter() - start
+    print("{} packets in {} pages, {:.1f} ms".format(len(packets), pages, elapsed * 1000))
+    if args.airtime:
+        byte_data = request(sock, lib_base.PROC_MSG["TC_GET_AIRTIME"], {"TestInstID": args.test}, args.retries)
+        print_airtime(json.loads(byte_data[4:].decode()))
+    sock.close()
+
+    fetched = sorted((packet["time"], packet["direction"], packet["stat"]) for packet in packets)
+    rows = read_rows(args.test)  # the rows of the db writer lag by up to DB_WRITER_INTERVAL
+    if fetched != rows:
+        missing = sorted(set(rows) - set(fetched))
+        extra = sorted(set(fetched) - set(rows))
+        print("pages and rows differ: {} rows, {} missing from the pages, {} not in the db".format(
+            len(rows), len(missing), len(extra)))
+        for row in (missing + extra)[:10]:
+            print("  {:.6f} {} stat {}".format(*row))
+        sys.exit(1)
+    print("pages match the {} rows of the databases".format(len(rows)))
+
+
+if __name__ == "__main__":
+    main()
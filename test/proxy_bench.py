@@ -0,0 +1,366 @@
+#file      proxy_bench.py
+
+#brief      load generator for the proxy with a local packet forwarder, test controller and network server
+
+#Revised BSD License
+
+#Copyright Semtech Corporation 2021. All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#Redistributions of source code must retain the above copyright
+#notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright
+#notice, this list of conditions and the following disclaimer in the
+#documentation and/or other materials provided with the distribution.
+#Neither the name of the Semtech corporation nor the
+#names of its contributors may be used to endorse or promote products
+#derived from this software without specific prior written permission.
+
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL SEMTECH CORPORATION. BE LIABLE FOR ANY DIRECT,
+#INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The proxy is started in a scratch directory with its own config.json, so the bench
+# databases and the real network server are left alone. Run from the repository root:
+#   python test/proxy_bench.py --rate 200 --duration 10 --gateways 2
+#   python test/proxy_bench.py --rate 400 --devices 8 --workers 4
+
+import os
+import sys
+import base64
+import json
+import time
+import shutil
+import socket
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEV_EUI = "00112233445566{:02x}"  # as stored in the database, sent reversed over the air
+NWK_KEY = "2B7E151628AED2A6ABF7158809CF4F3C"
+DEV_ADDR = "010203{:02x}"
+JOIN_NONCE = "000001"
+HOME_NETID = "000013"
+DEV_NONCE = "0100"
+FIRST_TEST_INST_ID = 1
+FIRST_GW_EUI = 0xAA555A0000000000
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def make_workdir(workers):
+    workdir = tempfile.mkdtemp(prefix="ctb_bench_")
+    config = json.load(open(os.path.join(REPO_DIR, "config.json")))
+    ports = {"test_controller": free_port(), "packet_forwarder": free_port(), "network_server": free_port()}
+    for name, port in ports.items():
+        config["network_address"][name] = {"ip": "127.0.0.1", "port": port}
+    config["network_address"]["error_report"] = {"ip": "127.0.0.1", "port": free_port()}
+    config["proxy_workers"] = workers
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump(config, f, indent=2)
+    for folder in ("tmp", "db", "log", "cache", "pcap", os.path.join("tmp", "power")):
+        os.makedirs(os.path.join(workdir, folder), exist_ok=True)
+    return workdir, ports
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class Recorder():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stamps = {}
+
+    def stamp(self, point, key):
+        now = time.time()
+        with self.lock:
+            self.stamps.setdefault(point, {})[key] = now
+
+    def count(self, point):
+        return len(self.stamps.get(point, {}))
+
+    def hop(self, start, end):
+        first = self.stamps.get(start, {})
+        second = self.stamps.get(end, {})
+        return [second[key] - first[key] for key in second if key in first]
+
+
+class Bench():
+    def __init__(self, args):
+        self.args = args
+        self.workdir, self.ports = make_workdir(args.workers)
+        os.chdir(self.workdir)
+        sys.path.insert(0, REPO_DIR)
+
+        # lib_base reads config.json from the working directory, import only now
+        global lib_base, lib_db, lib_ipc, Codec, encrypt_aes, calc_cmac, pad16
+        import lib_base
+        import lib_db
+        import lib_ipc
+        from lib_packet import Codec
+        from lib_crypto import encrypt_aes, calc_cmac, pad16
+
+        self.addr_proxy = ("127.0.0.1", self.ports["packet_forwarder"])
+        self.devices = []
+        self.by_deveui = {}
+        self.by_devaddr = {}
+        for index in range(args.devices):
+            device = {"DevEui": lib_base.reverse_eui(DEV_EUI.format(index)), "NwkKey": NWK_KEY, "region": "US"}
+            codec = Codec(None, 0, device)
+            codec.session = self.session_keys(DEV_ADDR.format(index))
+            self.devices.append({"index": index, "device": device, "codec": codec, "fcnt_down": 0})
+            self.by_deveui[device["DevEui"]] = self.devices[-1]
+            self.by_devaddr[DEV_ADDR.format(index)] = self.devices[-1]
+        self.rec = Recorder()
+        self.running = True
+        self.joined = threading.Event()
+        self.proxy = None
+
+        self.tc = self.udp_socket(self.ports["test_controller"])
+        self.ns = self.udp_socket(self.ports["network_server"])
+        self.gws = [self.udp_socket(0) for _ in range(args.gateways)]
+
+    def udp_socket(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.bind(("127.0.0.1", port))
+        sock.settimeout(0.2)
+        return sock
+
+    def session_keys(self, devaddr):
+        keys = {"DevAddr": devaddr}
+        keys["AppSKey"] = encrypt_aes(NWK_KEY, pad16("02" + JOIN_NONCE + HOME_NETID + DEV_NONCE))
+        keys["FNwkSIntKey"] = encrypt_aes(NWK_KEY, pad16("01" + JOIN_NONCE + HOME_NETID + DEV_NONCE))
+        keys["NwkSEncKey"] = keys["SNwkSIntKey"] = keys["FNwkSIntKey"]
+        return keys
+
+    def provision(self):
+        lib_db.create_db_tables_backup()
+        conn = sqlite3.connect(lib_base.DB_FILE_BACKUP)
+        conn.execute("INSERT INTO regionSKU (SkuID, ProductID, PartNumber, Region) VALUES (1, 1, 'bench', 'US')")
+        conn.executemany("INSERT INTO device (DevEui, SkuID, AppKey, NwkKey) VALUES (?,?,?,?)",
+                         [(DEV_EUI.format(index), 1, NWK_KEY, NWK_KEY) for index in range(self.args.devices)])
+        conn.commit()
+        conn.close()
+
+    def start_proxy(self):
+        env = dict(os.environ, PYTHONPATH=REPO_DIR)
+        log = open(os.path.join(self.workdir, "log", "proxy.out"), "w")
+        self.proxy = subprocess.Popen([sys.executable, "-c", "import proxy; proxy.run_proxy()"],
+                                      cwd=self.workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        time.sleep(1.5)
+        if self.proxy.poll() is not None:
+            raise RuntimeError("proxy exited, see {}".format(log.name))
+
+    def rxpk(self, data, gw_index, size):
+        return {"tmst": int(time.time() * 1e6) & 0xffffffff, "chan": 0, "rfch": 0, "freq": 902.3, "stat": 1,
+                "modu": "LORA", "datr": self.args.datr, "codr": "4/5", "lsnr": 9.5, "rssi": -40 - 10 * gw_index,
+                "size": size, "data": data}
+
+    def push_data(self, token, data, size):
+        for index, gw in enumerate(self.gws):
+            gw_eui = (FIRST_GW_EUI + index).to_bytes(8, "big")
+            gw.sendto(bytes([2, token >> 8, token & 0xff, 0]) + gw_eui +
+                      json.dumps({"rxpk": [self.rxpk(data, index, size)]}).encode(), self.addr_proxy)
+
+    def pull_data(self):
+        for index, gw in enumerate(self.gws):
+            gw.sendto(bytes([2, 0, index, 2]) + (FIRST_GW_EUI + index).to_bytes(8, "big"), self.addr_proxy)
+
+    def join_request(self, device):
+        body = "00" + "0000000000000000" + device["device"]["DevEui"] + DEV_NONCE
+        return bytes.fromhex(body + calc_cmac(NWK_KEY, body))
+
+    def join_accept(self, device):
+        return device["codec"].encode_join_accept({"MType": "001", "Major": "0", "OptNeg": "0", "RX1DRoffset": 0,
+                                                   "RX2DataRate": 8, "JoinNonce": JOIN_NONCE,
+                                                   "Home_NetID": HOME_NETID, "DevAddr": DEV_ADDR.format(device["index"]),
+                                                   "RxDelay": 1, "CFList": "", "mic": ""})
+
+    def data_frame(self, device, fcnt, mtype):
+        return device["codec"].encode_data({"MType": mtype, "Major": "0", "DevAddr": DEV_ADDR.format(device["index"]),
+                                            "ADR": "0", "ADRACKReq": "0", "ClassB": "0", "FPending": "0",
+                                            "FCnt": fcnt, "FPort": 1, "FRMPayload": "00" * self.args.payload,
+                                            "FOpts": "", "mic": ""})
+
+    def pull_rsp(self, data, size, tmst):
+        txpk = {"imme": False, "tmst": tmst & 0xffffffff, "freq": 923.3, "rfch": 0, "powe": 14, "modu": "LORA",
+                "datr": "SF10BW500", "codr": "4/5", "ipol": True, "size": size, "data": data}
+        self.ns.sendto(bytes([2, 0, 0, 3]) + json.dumps({"txpk": txpk}).encode(), self.addr_proxy)
+
+    def run_tc(self):
+        # stands in for conftest, every frame is sent back to the proxy unchanged
+        while self.running:
+            try:
+                byte_data, addr = self.tc.recvfrom(65535)
+            except socket.timeout:
+                continue
+            if len(byte_data) < 4 or byte_data[3] != 6:
+                continue
+            kind, pkt = lib_ipc.unpack_tc_data(byte_data)
+            direction = "up" if kind == "rxpk" else "down"
+            self.rec.stamp("tc_rx_" + direction, pkt["data"])
+            self.tc.sendto(byte_data, addr)
+            self.rec.stamp("tc_tx_" + direction, pkt["data"])
+
+    def run_ns(self):
+        while self.running:
+            try:
+                byte_data, addr = self.ns.recvfrom(65535)
+            except socket.timeout:
+                continue
+            msg_type = byte_data[3]
+            if msg_type == 0:
+                self.ns.sendto(byte_data[0:3] + bytes([1]), addr)
+                rxpk = json.loads(byte_data[12:].decode()).get("rxpk", [])
+                for pkt in rxpk:
+                    self.rec.stamp("ns_rx_up", pkt["data"])
+                    phy_payload = base64.b64decode(pkt["data"])
+                    if phy_payload[0] >> 5 == 0:
+                        data, size = self.join_accept(self.by_deveui[phy_payload[9:17].hex()])
+                        self.pull_rsp(data, size, pkt["tmst"] + 5000000)
+                    elif self.args.downlink_every and self.rec.count("ns_rx_up") % self.args.downlink_every == 0:
+                        device = self.by_devaddr[phy_payload[1:5].hex()]
+                        device["fcnt_down"] += 1
+                        data, size = self.data_frame(device, device["fcnt_down"], "011")
+                        self.rec.stamp("ns_tx_down", data)
+                        self.pull_rsp(data, size, pkt["tmst"] + 1000000)  # RX1 with RxDelay 1
+            elif msg_type == 2:
+                self.ns.sendto(byte_data[0:3] + bytes([4]), addr)
+
+    def run_gw(self, gw):
+        while self.running:
+            try:
+                byte_data, addr = gw.recvfrom(65535)
+            except socket.timeout:
+                continue
+            if byte_data[3] == 3:
+                txpk = json.loads(byte_data[4:].decode())["txpk"]
+                if base64.b64decode(txpk["data"])[0] >> 5 == 1:
+                    self.joined.set()
+                else:
+                    self.rec.stamp("gw_rx_down", txpk["data"])
+
+    def request(self, msg_type, body=None):
+        sock = self.udp_socket(0)
+        sock.settimeout(2)
+        try:
+            sock.sendto(bytes([0, 1, 2, msg_type]) + (json.dumps(body).encode() if body else b""), self.addr_proxy)
+            return sock.recvfrom(65535)[0]
+        finally:
+            sock.close()
+
+    def run(self):
+        self.provision()
+        self.start_proxy()
+        threads = [threading.Thread(target=self.run_tc), threading.Thread(target=self.run_ns)]
+        threads += [threading.Thread(target=self.run_gw, args=(gw,)) for gw in self.gws]
+        for thread in threads:
+            thread.start()
+
+        try:
+            self.pull_data()
+            for device in self.devices:
+                # one join at a time, the gateway stand-in cannot tell the join accepts apart
+                self.joined.clear()
+                self.tc.sendto(bytes([0, 1, 2, lib_base.PROC_MSG["TC_SETUP_TEST"]]) +
+                               json.dumps({"DevEui": DEV_EUI.format(device["index"]),
+                                           "TestInstID": FIRST_TEST_INST_ID + device["index"],
+                                           "ipc": 0 if self.args.ipc == "json" else lib_ipc.TC_FRAME_VERSION,
+                                           "decoded": self.args.ipc != "raw"}).encode(), self.addr_proxy)
+                time.sleep(0.2)
+                join_request = self.join_request(device)
+                self.push_data(device["index"], base64.b64encode(join_request).decode(), len(join_request))
+                if not self.joined.wait(5):
+                    raise RuntimeError("device {} did not join, see the proxy log in {}".format(
+                        device["index"], self.workdir))
+
+            print("sending {} uplinks/s of {} device(s) through {} gateway(s) for {} s".format(
+                self.args.rate, self.args.devices, self.args.gateways, self.args.duration))
+            start = time.monotonic()
+            sent = 0
+            while time.monotonic() - start < self.args.duration:
+                due = int((time.monotonic() - start) * self.args.rate)
+                while sent < due:
+                    sent += 1
+                    device = self.devices[sent % len(self.devices)]
+                    data, size = self.data_frame(device, sent // len(self.devices) + 1, "010")
+                    self.rec.stamp("gw_tx_up", data)
+                    self.push_data(sent & 0xffff, data, size)
+                    if sent % self.args.rate == 0:
+                        self.pull_data()
+                time.sleep(0.001)
+            elapsed = time.monotonic() - start
+            time.sleep(self.args.drain)
+            stats = json.loads(self.request(lib_base.PROC_MSG["TC_GET_STATS"])[4:].decode())
+            for device in self.devices:
+                self.tc.sendto(bytes([0, 1, 2, lib_base.PROC_MSG["TC_TEARDOWN_TEST"]]) +
+                               json.dumps({"TestInstID": FIRST_TEST_INST_ID + device["index"]}).encode(),
+                               self.addr_proxy)
+        finally:
+            self.running = False
+            for thread in threads:
+                thread.join()
+            self.proxy.terminate()
+            self.proxy.wait()
+        self.report(sent, elapsed, stats)
+        if not self.args.keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def report(self, sent, elapsed, stats):
+        received = self.rec.count("ns_rx_up") - len(self.devices)  # without the join requests
+        downlinks = self.rec.count("ns_tx_down")
+        print("uplinks   sent {} received {} loss {:.2%} throughput {:.1f}/s".format(
+            sent, received, 1 - received / sent if sent else 0, received / elapsed))
+        print("downlinks sent {} received {} loss {:.2%}".format(
+            downlinks, self.rec.count("gw_rx_down"),
+            1 - self.rec.count("gw_rx_down") / downlinks if downlinks else 0))
+        print("{:10} {:>8} {:>10} {:>10} {:>10}".format("hop", "count", "p50 ms", "p99 ms", "max ms"))
+        for name, start, end in (("gw->tc", "gw_tx_up", "tc_rx_up"), ("tc->ns", "tc_tx_up", "ns_rx_up"),
+                                 ("ns->tc", "ns_tx_down", "tc_rx_down"), ("tc->gw", "tc_tx_down", "gw_rx_down"),
+                                 ("gw->ns", "gw_tx_up", "ns_rx_up"), ("ns->gw", "ns_tx_down", "gw_rx_down")):
+            values = self.rec.hop(start, end)
+            print("{:10} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+                name, len(values), percentile(values, 50) * 1000, percentile(values, 99) * 1000,
+                max(values, default=float("nan")) * 1000))
+        print("proxy: {}".format(json.dumps({"counters": stats["counters"], "gauges": stats["gauges"]})))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="proxy load generator")
+    parser.add_argument("--rate", type=int, default=100, help="uplinks per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--devices", type=int, default=1, help="devices under test, sending in turn")
+    parser.add_argument("--workers", type=int, default=0, help="proxy worker processes, 0 for one process")
+    parser.add_argument("--gateways", type=int, default=1, help="gateways hearing every uplink")
+    parser.add_argument("--downlink-every", type=int, default=10, help="NS answers one uplink out of N, 0 for none")
+    parser.add_argument("--payload", type=int, default=10, help="FRMPayload bytes")
+    parser.add_argument("--datr", default="SF7BW125", help="data rate of the uplinks")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for frames in flight")
+    parser.add_argument("--ipc", choices=("json", "binary", "raw"), default="binary",
+                        help="TC_DATA framing: json, binary frames, or binary frames without the decoded fields")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory with the proxy log")
+    Bench(parser.parse_args()).run()
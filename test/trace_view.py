@@ -0,0 +1,140 @@
+#file      trace_view.py
+
+#brief      where the latency of each packet went, from the trace table of the proxy
+
+#Revised BSD License
+
+#Copyright Semtech Corporation 2021. All rights reserved.
+
+#Redistribution and use in source and binary forms, with or without
+#modification, are permitted provided that the following conditions are met:
+#Redistributions of source code must retain the above copyright
+#notice, this list of conditions and the following disclaimer.
+#Redistributions in binary form must reproduce the above copyright
+#notice, this list of conditions and the following disclaimer in the
+#documentation and/or other materials provided with the distribution.
+#Neither the name of the Semtech corporation nor the
+#names of its contributors may be used to endorse or promote products
+#derived from this software without specific prior written permission.
+
+
+#THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+#AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+#IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+#ARE DISCLAIMED. IN NO EVENT SHALL SEMTECH CORPORATION. BE LIABLE FOR ANY DIRECT,
+#INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Reads the trace table of the proxy and of the backup database. Run from the repository root:
+#   python test/trace_view.py --test 12 --slowest 20
+# Segments of a trace, in ms:
+#   in   first receipt -> sent to the test controller (deduplication window and decoding)
+#   tc   sent to the test controller -> back from it
+#   out  back from the test controller -> forwarded to the NS or the gateway
+#   ack  forwarded -> acked by the NS or the gateway
+
+import os
+import sys
+import sqlite3
+import argparse
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import lib_base  # reads config.json from the working directory
+
+SEGMENTS = (("in", None, "tc_tx"), ("tc", "tc_tx", "tc_rx"), ("out", "tc_rx", "fwd"), ("ack", "fwd", "ack"))
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def read_traces(db_files, test_inst_id, limit):
+    traces = []
+    for db_file in db_files:
+        if not os.path.exists(db_file):
+            continue
+        conn = sqlite3.connect(db_file, timeout=60)
+        conn.row_factory = sqlite3.Row
+        try:
+            if test_inst_id is None:
+                rows = conn.execute("SELECT * FROM trace ORDER BY time DESC LIMIT (?)", (limit,)).fetchall()
+            else:
+                rows = conn.execute("SELECT * FROM trace WHERE TestInstID=(?) ORDER BY time DESC LIMIT (?)",
+                                    (test_inst_id, limit)).fetchall()
+        except sqlite3.OperationalError:  # database older than the trace table
+            rows = []
+        traces += [dict(row) for row in rows]
+        conn.close()
+    return sorted(traces, key=lambda trace: trace["time"])
+
+
+def segments(trace):
+    spans = {None: 0.0, "tc_tx": trace["tc_tx"], "tc_rx": trace["tc_rx"], "fwd": trace["fwd"], "ack": trace["ack"]}
+    if trace["origin"] == "tc":  # made up by the test controller, it was never sent to it
+        spans["tc_tx"] = spans["tc_rx"] = 0.0
+    result = {}
+    for name, start, end in SEGMENTS:
+        if spans[start] is not None and spans[end] is not None:
+            result[name] = spans[end] - spans[start]
+    last = max((value for value in spans.values() if value is not None), default=0.0)
+    result["total"] = last
+    return result
+
+
+def summary(traces):
+    print("{:5} {:6} {:>7} {:>10} {:>10} {:>10}".format("dir", "hop", "count", "p50 ms", "p99 ms", "max ms"))
+    for direction in ("up", "down"):
+        selected = [segments(trace) for trace in traces if trace["direction"] == direction]
+        for name in [segment[0] for segment in SEGMENTS] + ["total"]:
+            values = [spans[name] for spans in selected if name in spans]
+            if values:
+                print("{:5} {:6} {:>7} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+                    direction, name, len(values), percentile(values, 50) * 1000, percentile(values, 99) * 1000,
+                    max(values) * 1000))
+    lost = {}
+    for trace in traces:
+        for span in ("tc_rx", "fwd", "ack"):
+            if trace[span] is None:
+                lost[span] = lost.get(span, 0) + 1
+                break
+    if lost:
+        print("stopped before: " + ", ".join("{} {}".format(span, count) for span, count in lost.items()))
+
+
+def details(traces):
+    print("{:>18} {:>17} {:4} {:3} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+        "trace", "time", "dir", "org", "in", "tc", "out", "ack", "total"))
+    for trace in traces:
+        spans = segments(trace)
+        print("{:>18x} {:>17.6f} {:4} {:3} ".format(trace["trace"], trace["time"], trace["direction"], trace["origin"]) +
+              " ".join("{:>9}".format("{:.3f}".format(spans[name] * 1000) if name in spans else "-")
+                       for name in ("in", "tc", "out", "ack", "total")))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="per packet latency of the proxy")
+    parser.add_argument("--db", action="append", help="database to read, the proxy and backup ones by default")
+    parser.add_argument("--test", type=int, help="TestInstID, every test by default")
+    parser.add_argument("--limit", type=int, default=100000, help="most recent traces read from each database")
+    parser.add_argument("--slowest", type=int, default=10, help="traces listed with their segments")
+    parser.add_argument("--trace", type=lambda value: int(value, 16), help="list this trace only, hex")
+    args = parser.parse_args()
+
+    traces = read_traces(args.db or [lib_base.DB_FILE_PROXY, lib_base.DB_FILE_BACKUP], args.test, args.limit)
+    if args.trace is not None:
+        details([trace for trace in traces if trace["trace"] == args.trace])
+        sys.exit(0)
+    if not traces:
+        print("no trace")
+        sys.exit(0)
+    summary(traces)
+    print()
+    details(sorted(traces, key=lambda trace: segments(trace)["total"], reverse=True)[:args.slowest])
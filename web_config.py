@@ -41,7 +41,7 @@ import urllib.parse
 from base64 import b64encode
 
 from lib_base import DB_FILE_CONTROLLER, DB_FILE_PROXY, DB_FILE_BACKUP, CACHE_FOLDER, \
-    addr_pc, config_logger, PROC_MSG, device_on, CACHE_STATE, start_pcap
+    addr_pc, addr_pf, config_logger, PROC_MSG, device_on, CACHE_STATE, start_pcap
 from lib_db import backup_db_proxy, backup_db_proxy, backup_db_tc, backup_db_pm, \
     TABLES, merge_db_backup, delete_records, insert_records, TABLE_SETS
 
@@ -76,6 +76,16 @@ def parse_response(responses, table, has_link=False):
 
 
 
+def notify_device_update():
+    # the proxy caches the device and regionSKU tables, it reads them again at the next test setup
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(bytes([0, 1, 2, PROC_MSG["WB_DEVICE_UPDATE"]]), addr_pf)
+    except OSError as e:
+        logging.error("cannot notify the proxy of a device update: {}".format(e))
+    finally:
+        sock.close()
+
 
 @config_api.route('/table/<table>', methods=['POST', 'GET', 'DELETE'])
 def config_table(table):
@@ -92,6 +102,7 @@ def config_table(table):
             insert_records(conn, table, tables)
             conn.commit()
             conn.close()
+            notify_device_update()
             return "ok"
         except Exception as e:
             if conn:
@@ -129,6 +140,7 @@ def config_table(table):
             delete_records(conn, table, 'rowid', rows)
             conn.commit()
             conn.close()
+            notify_device_update()
             return "ok"
         except:
             if conn:
@@ -230,6 +242,7 @@ def configure_device():
                              (device["DevEui"].lower(), device["SkuID"], device["AppKey"], device["NwkKey"]))
             conn.commit()
             conn.close()
+            notify_device_update()
             return "ok"
         except Exception as e:
             return request.data.decode() + "<br>" + str(e)
@@ -292,6 +305,7 @@ def configure_device():
                     conn.execute('DELETE FROM device WHERE rowid=(?)', (row["rowid"],))
                     conn.commit()
             conn.close()
+            notify_device_update()
             return "ok"
         except:
             conn.close()
@@ -312,6 +326,7 @@ def device_delete_row():
         conn.execute('DELETE FROM device WHERE rowid=(?)', (rowid,))
         conn.commit()
         conn.close()
+        notify_device_update()
         return redirect(request.referrer)
     except:
         conn.close()
@@ -331,6 +346,7 @@ def device_add():
 
         conn.commit()
         conn.close()
+        notify_device_update()
         return redirect(request.referrer)
     except:
         conn.close()
@@ -934,6 +950,7 @@ def display_report():
 def merge_file():
     try:
         merge_db_backup()
+        notify_device_update()
         return 'database has been merged successfully'
     except:
         return "merge error happened: {}".format(sys.exc_info()[1])